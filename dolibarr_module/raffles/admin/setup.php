@@ -43,6 +43,11 @@ $langs->load("admin");
 // Configuration parameters
 $conf_RAFFLES_API_URL = GETPOST('RAFFLES_API_URL', 'nohtml');
 $conf_RAFFLES_API_KEY = GETPOST('RAFFLES_API_KEY', 'nohtml');
+$conf_RAFFLES_BATCH_MODE = GETPOSTINT('RAFFLES_BATCH_MODE');
+$conf_RAFFLES_BATCH_SIZE = GETPOSTINT('RAFFLES_BATCH_SIZE');
+$conf_RAFFLES_API_BATCH_URL = GETPOST('RAFFLES_API_BATCH_URL', 'nohtml');
+
+dol_include_once('/raffles/class/rafflesqueue.class.php');
 
 /*
  * Actions
@@ -71,8 +76,11 @@ if ($action == 'set_configuration') {
 		if (!$error) {
 			$res1 = dolibarr_set_const($db, "RAFFLES_API_URL", $conf_RAFFLES_API_URL, 'chaine', 0, '', $conf->entity);
 			$res2 = dolibarr_set_const($db, "RAFFLES_API_KEY", $conf_RAFFLES_API_KEY, 'chaine', 0, '', $conf->entity);
+			$res3 = dolibarr_set_const($db, "RAFFLES_BATCH_MODE", $conf_RAFFLES_BATCH_MODE ? 1 : 0, 'chaine', 0, '', $conf->entity);
+			$res4 = dolibarr_set_const($db, "RAFFLES_BATCH_SIZE", $conf_RAFFLES_BATCH_SIZE > 0 ? $conf_RAFFLES_BATCH_SIZE : 50, 'chaine', 0, '', $conf->entity);
+			$res5 = dolibarr_set_const($db, "RAFFLES_API_BATCH_URL", $conf_RAFFLES_API_BATCH_URL, 'chaine', 0, '', $conf->entity);
 
-			if ($res1 < 0 || $res2 < 0) {
+			if ($res1 < 0 || $res2 < 0 || $res3 < 0 || $res4 < 0 || $res5 < 0) {
 				setEventMessages($langs->trans("Error"), null, 'errors');
 			} else {
 				setEventMessages($langs->trans("SetupSaved"), null, 'mesgs');
@@ -81,6 +89,19 @@ if ($action == 'set_configuration') {
 	}
 }
 
+if ($action == 'flush_queue') {
+	if (function_exists('newTokenCheck') && !newTokenCheck()) {
+		setEventMessages($langs->trans("ErrorBadCsrfToken"), null, 'errors');
+	} else {
+		$queue = new RafflesQueue($db);
+		if ($queue->flush() < 0) {
+			setEventMessages($langs->trans("RafflesQueueFlushError") . ': ' . $queue->error, null, 'errors');
+		} else {
+			setEventMessages(implode(' ', $queue->output), null, 'mesgs');
+		}
+	}
+}
+
 /*
  * View
  */
@@ -126,6 +147,30 @@ print '<input type="text" class="minwidth300" name="RAFFLES_API_KEY" value="' .
 print '</td>';
 print '</tr>';
 
+// Batch mode
+print '<tr class="oddeven">';
+print '<td>' . $langs->trans("RafflesBatchMode") . ' <span class="opacitymedium">(' . $langs->trans("RafflesBatchModeHelp") . ')</span></td>';
+print '<td class="right">';
+print '<input type="checkbox" name="RAFFLES_BATCH_MODE" value="1"' . (getDolGlobalInt('RAFFLES_BATCH_MODE') ? ' checked' : '') . '>';
+print '</td>';
+print '</tr>';
+
+// Batch size
+print '<tr class="oddeven">';
+print '<td>' . $langs->trans("RafflesBatchSize") . '</td>';
+print '<td class="right">';
+print '<input type="number" min="1" max="500" class="width75" name="RAFFLES_BATCH_SIZE" value="' . RafflesQueue::getBatchSize() . '">';
+print '</td>';
+print '</tr>';
+
+// Batch URL
+print '<tr class="oddeven">';
+print '<td>' . $langs->trans("RafflesApiBatchUrl") . ' <span class="opacitymedium">(' . $langs->trans("RafflesApiBatchUrlHelp") . ')</span></td>';
+print '<td class="right">';
+print '<input type="text" class="minwidth300" name="RAFFLES_API_BATCH_URL" value="' . dol_escape_htmltag(getDolGlobalString('RAFFLES_API_BATCH_URL')) . '">';
+print '</td>';
+print '</tr>';
+
 print '</table>';
 
 print '<br>';
@@ -135,5 +180,17 @@ print '</div>';
 
 print '</form>';
 
+// Queue status + manual flush
+$queue = new RafflesQueue($db);
+print '<br>';
+print '<form method="POST" action="' . $_SERVER["PHP_SELF"] . '">';
+print '<input type="hidden" name="token" value="' . newToken() . '">';
+print '<input type="hidden" name="action" value="flush_queue">';
+print '<div class="center">';
+print $langs->trans("RafflesQueuedInvoices") . ': <strong>' . $queue->count() . '</strong> ';
+print '<input type="submit" class="button" value="' . $langs->trans("RafflesFlushQueue") . '">';
+print '</div>';
+print '</form>';
+
 llxFooter();
 $db->close();
@@ -0,0 +1,392 @@
+<?php
+/* Copyright (C) 2024      Jules
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 3 of the License, or
+ * (at your option) any later version.
+ */
+
+/**
+ *  \file       htdocs/raffles/class/rafflesqueue.class.php
+ *  \ingroup    raffles
+ *  \brief      File-backed queue of validated invoices sent to the batch webhook
+ */
+
+/**
+ * Class RafflesQueue
+ *
+ * When RAFFLES_BATCH_MODE is on, the trigger appends each validated invoice
+ * here (one JSON line per invoice) instead of POSTing it right away. The
+ * scheduled job and the setup page flush the whole queue to the batch
+ * endpoint; when the queue reaches RAFFLES_BATCH_SIZE the trigger sends one
+ * batch with a short timeout.
+ */
+class RafflesQueue
+{
+	/** CURL timeout (seconds) of the single batch sent from the trigger */
+	const TRIGGER_TIMEOUT = 10;
+
+	/** @var DoliDB */
+	public $db;
+
+	/** @var string */
+	public $error = '';
+
+	/** @var string[] */
+	public $output = array();
+
+	/**
+	 * Constructor
+	 *
+	 * @param DoliDB $db Database handler
+	 */
+	public function __construct($db)
+	{
+		$this->db = $db;
+	}
+
+	/**
+	 * Path of the queue file inside the Dolibarr documents directory.
+	 *
+	 * @return string
+	 */
+	public static function getQueueFile()
+	{
+		$dir = DOL_DATA_ROOT . '/raffles';
+		if (!is_dir($dir)) {
+			dol_mkdir($dir);
+		}
+		return $dir . '/invoice_queue.jsonl';
+	}
+
+	/**
+	 * Path of the file holding the timestamp until which the server asked us
+	 * to stop sending (429 Too Many Requests + Retry-After).
+	 *
+	 * @return string
+	 */
+	public static function getBackoffFile()
+	{
+		return dirname(self::getQueueFile()) . '/backoff_until';
+	}
+
+	/**
+	 * Remember a 429 from the server: nothing is sent until Retry-After elapses.
+	 *
+	 * @param int $seconds Retry-After value (defaults to 60 when missing)
+	 * @return void
+	 */
+	public static function setBackoff($seconds)
+	{
+		$seconds = (int) $seconds > 0 ? (int) $seconds : 60;
+		@file_put_contents(self::getBackoffFile(), (string) (dol_now() + $seconds), LOCK_EX);
+		dol_syslog("RafflesQueue: server rate limit, backing off " . $seconds . "s", LOG_WARNING);
+	}
+
+	/**
+	 * Seconds left before the server accepts invoices again (0 = send now).
+	 *
+	 * @return int
+	 */
+	public static function backoffRemaining()
+	{
+		$file = self::getBackoffFile();
+		if (!file_exists($file)) {
+			return 0;
+		}
+		$until = (int) @file_get_contents($file);
+		return max(0, $until - dol_now());
+	}
+
+	/**
+	 * Batch endpoint URL: RAFFLES_API_BATCH_URL, or RAFFLES_API_URL + "batch/".
+	 *
+	 * @return string
+	 */
+	public static function getBatchUrl()
+	{
+		$batchUrl = getDolGlobalString('RAFFLES_API_BATCH_URL');
+		if (!empty($batchUrl)) {
+			return $batchUrl;
+		}
+		$apiUrl = getDolGlobalString('RAFFLES_API_URL');
+		if (empty($apiUrl)) {
+			return '';
+		}
+		return rtrim($apiUrl, '/') . '/batch/';
+	}
+
+	/**
+	 * Configured batch size (invoices per POST), clamped to what the server accepts.
+	 *
+	 * @return int
+	 */
+	public static function getBatchSize()
+	{
+		$size = getDolGlobalInt('RAFFLES_BATCH_SIZE');
+		if ($size <= 0) {
+			$size = 50;
+		}
+		return min($size, 500);
+	}
+
+	/**
+	 * Append one invoice payload to the queue.
+	 *
+	 * @param array $data Payload as built by the trigger
+	 * @return int        Number of invoices queued after the append, <0 if KO
+	 */
+	public function push($data)
+	{
+		$fh = @fopen(self::getQueueFile(), 'c+');
+		if ($fh === false) {
+			$this->error = 'Cannot open queue file';
+			return -1;
+		}
+		flock($fh, LOCK_EX);
+		fseek($fh, 0, SEEK_END);
+		fwrite($fh, json_encode($data) . "\n");
+		fflush($fh);
+		$count = count($this->readLines($fh));
+		flock($fh, LOCK_UN);
+		fclose($fh);
+		return $count;
+	}
+
+	/**
+	 * Number of invoices waiting in the queue.
+	 *
+	 * @return int
+	 */
+	public function count()
+	{
+		$file = self::getQueueFile();
+		if (!file_exists($file)) {
+			return 0;
+		}
+		$fh = @fopen($file, 'r');
+		if ($fh === false) {
+			return 0;
+		}
+		flock($fh, LOCK_SH);
+		$count = count($this->readLines($fh));
+		flock($fh, LOCK_UN);
+		fclose($fh);
+		return $count;
+	}
+
+	/**
+	 * Send queued invoices to the batch endpoint, RAFFLES_BATCH_SIZE per request.
+	 * Invoices the server could not process (connection error, 429, 5xx, or
+	 * missing from a short response) stay queued. While the server's
+	 * Retry-After is running nothing is sent.
+	 *
+	 * The queue file is only locked to copy the lines and, after the POSTs,
+	 * to remove the delivered ones, so push() from the trigger never waits on
+	 * the network. A separate lock file keeps a single flush at a time.
+	 *
+	 * @param int $maxChunks Stop after this many requests (0 = whole queue)
+	 * @param int $timeout   CURL timeout per request, in seconds
+	 * @return int           Number of invoices delivered, <0 if KO
+	 */
+	public function flush($maxChunks = 0, $timeout = 60)
+	{
+		$wait = self::backoffRemaining();
+		if ($wait > 0) {
+			$this->output[] = "Servidor saturado, reintento en " . $wait . " s (" . $this->count() . " en cola)";
+			return 0;
+		}
+
+		$batchUrl = self::getBatchUrl();
+		$apiKey = getDolGlobalString('RAFFLES_API_KEY');
+		if (empty($batchUrl) || empty($apiKey)) {
+			$this->error = 'API URL or API Key not configured';
+			return -1;
+		}
+
+		$flushLock = @fopen(self::getQueueFile() . '.flush', 'c');
+		if ($flushLock === false) {
+			$this->error = 'Cannot open queue lock file';
+			return -1;
+		}
+		if (!flock($flushLock, LOCK_EX | LOCK_NB)) {
+			// Another process is already flushing.
+			fclose($flushLock);
+			return 0;
+		}
+
+		$fh = @fopen(self::getQueueFile(), 'c+');
+		if ($fh === false) {
+			$this->error = 'Cannot open queue file';
+			fclose($flushLock);
+			return -1;
+		}
+		flock($fh, LOCK_EX);
+		$lines = $this->readLines($fh);
+		flock($fh, LOCK_UN);
+
+		$remaining = array();
+		$delivered = 0;
+		$tickets = 0;
+		$sent = 0;
+		$stop = false;
+
+		foreach (array_chunk($lines, self::getBatchSize()) as $chunk) {
+			if ($stop || ($maxChunks > 0 && $sent >= $maxChunks)) {
+				$remaining = array_merge($remaining, $chunk);
+				continue;
+			}
+			$sent++;
+
+			$invoices = array();
+			foreach ($chunk as $line) {
+				$invoices[] = json_decode($line, true);
+			}
+
+			$result = $this->post($batchUrl, $apiKey, array('invoices' => $invoices), $timeout);
+			if ($result['httpcode'] == 429) {
+				self::setBackoff($result['retry_after']);
+				$this->output[] = "Servidor saturado (429), reintento en " . self::backoffRemaining() . " s";
+				$remaining = array_merge($remaining, $chunk);
+				$stop = true;
+				continue;
+			}
+			if ($result['httpcode'] == 202) {
+				// Server-side inbox: accepted as a whole, tickets are generated later.
+				$delivered += count($chunk);
+				continue;
+			}
+			if ($result['httpcode'] != 200 || !isset($result['data']['results'])) {
+				dol_syslog("RafflesQueue: batch POST failed [" . $result['httpcode'] . "] " . $result['error'], LOG_ERR);
+				$this->error = $result['error'] ? $result['error'] : 'HTTP ' . $result['httpcode'];
+				$remaining = array_merge($remaining, $chunk);
+				$stop = true;
+				continue;
+			}
+
+			$acknowledged = array();
+			foreach ($result['data']['results'] as $item) {
+				$index = isset($item['index']) ? (int) $item['index'] : -1;
+				$status = isset($item['status']) ? (int) $item['status'] : 0;
+				if (!isset($chunk[$index]) || isset($acknowledged[$index]) || $status >= 500 || $status == 429) {
+					continue;
+				}
+				$acknowledged[$index] = true;
+				$delivered++;
+				if (!empty($item['tickets_generated'])) {
+					$tickets += (int) $item['tickets_generated'];
+				}
+				dol_syslog("RafflesQueue: invoice " . (isset($item['ref']) ? $item['ref'] : '?') . " -> [" . $status . "]", LOG_DEBUG);
+			}
+			// Failed items and the ones a short response left out are sent again.
+			foreach ($chunk as $index => $line) {
+				if (!isset($acknowledged[$index])) {
+					$remaining[] = $line;
+				}
+			}
+		}
+
+		// push() only appends and no other flush runs, so the lines read above
+		// are still the head of the file: keep the undelivered ones and
+		// whatever was queued meanwhile.
+		flock($fh, LOCK_EX);
+		$current = $this->readLines($fh);
+		$remaining = array_merge($remaining, array_slice($current, count($lines)));
+		ftruncate($fh, 0);
+		rewind($fh);
+		foreach ($remaining as $line) {
+			fwrite($fh, $line . "\n");
+		}
+		fflush($fh);
+		flock($fh, LOCK_UN);
+		fclose($fh);
+		flock($flushLock, LOCK_UN);
+		fclose($flushLock);
+
+		$this->output[] = $delivered . " factura(s) enviadas, " . $tickets . " boleto(s) generados, " . count($remaining) . " en cola";
+		dol_syslog("RafflesQueue: " . end($this->output), LOG_INFO);
+		return $delivered;
+	}
+
+	/**
+	 * Entry point for the scheduled job declared in modRaffles.
+	 *
+	 * @return int 0 if OK, <>0 if KO (Dolibarr cron convention)
+	 */
+	public function cronFlush()
+	{
+		$res = $this->flush();
+		if ($res < 0) {
+			$this->output = $this->error;
+			return 1;
+		}
+		$this->output = implode("\n", $this->output);
+		return 0;
+	}
+
+	/**
+	 * Non-empty lines of an open, locked queue file.
+	 *
+	 * @param resource $fh File handle
+	 * @return string[]
+	 */
+	private function readLines($fh)
+	{
+		rewind($fh);
+		$content = stream_get_contents($fh);
+		fseek($fh, 0, SEEK_END);
+		$lines = array();
+		foreach (explode("\n", (string) $content) as $line) {
+			if (trim($line) !== '') {
+				$lines[] = $line;
+			}
+		}
+		return $lines;
+	}
+
+	/**
+	 * POST a JSON body with the Bearer API key.
+	 *
+	 * @param string $url     Endpoint
+	 * @param string $apiKey  API key
+	 * @param array  $body    Body to JSON-encode
+	 * @param int    $timeout CURL timeout in seconds
+	 * @return array          httpcode, data (decoded JSON or null), error, retry_after (seconds, 0 if absent)
+	 */
+	private function post($url, $apiKey, $body, $timeout = 60)
+	{
+		$ch = curl_init($url);
+		if ($ch === false) {
+			return array('httpcode' => 0, 'data' => null, 'error' => 'Failed to initialize CURL');
+		}
+		curl_setopt($ch, CURLOPT_RETURNTRANSFER, true);
+		curl_setopt($ch, CURLOPT_POST, true);
+		curl_setopt($ch, CURLOPT_POSTFIELDS, json_encode($body));
+		curl_setopt($ch, CURLOPT_HTTPHEADER, array(
+			'Content-Type: application/json',
+			'Authorization: Bearer ' . $apiKey
+		));
+		curl_setopt($ch, CURLOPT_TIMEOUT, $timeout);
+		curl_setopt($ch, CURLOPT_CONNECTTIMEOUT, 5);
+		$retryAfter = 0;
+		curl_setopt($ch, CURLOPT_HEADERFUNCTION, function ($ch, $header) use (&$retryAfter) {
+			if (stripos($header, 'Retry-After:') === 0) {
+				$retryAfter = (int) trim(substr($header, 12));
+			}
+			return strlen($header);
+		});
+
+		$response = curl_exec($ch);
+		$httpcode = curl_getinfo($ch, CURLINFO_HTTP_CODE);
+		$error = curl_errno($ch) ? curl_error($ch) : '';
+		curl_close($ch);
+
+		return array(
+			'httpcode' => $httpcode,
+			'data' => $error ? null : json_decode($response, true),
+			'error' => $error,
+			'retry_after' => $retryAfter,
+		);
+	}
+}
@@ -80,6 +80,23 @@ class modRaffles extends DolibarrModules
 		$this->langfiles = array("raffles@raffles");
 
 		// Constants
-		$this->dirs = array();
+		$this->dirs = array("/raffles");
+
+		// Scheduled job: flush the batch-mode invoice queue (RAFFLES_BATCH_MODE)
+		$this->cronjobs = array(
+			0 => array(
+				'label' => 'RafflesFlushQueue',
+				'jobtype' => 'method',
+				'class' => '/raffles/class/rafflesqueue.class.php',
+				'objectname' => 'RafflesQueue',
+				'method' => 'cronFlush',
+				'parameters' => '',
+				'comment' => 'Envía al sistema de rifas las facturas encoladas (modo lote o rechazadas con 429)',
+				'frequency' => 5,
+				'unitfrequency' => 60,
+				'status' => 1,
+				'test' => 'isModEnabled("raffles")',
+			),
+		);
 	}
 }
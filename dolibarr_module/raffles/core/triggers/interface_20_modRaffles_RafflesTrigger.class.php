@@ -116,6 +116,41 @@ class InterfaceRafflesTrigger extends DolibarrTriggers
                         'total_amount' => isset($object->total_ttc) ? $object->total_ttc : 0,
                     );
 
+                    dol_include_once('/raffles/class/rafflesqueue.class.php');
+
+                    // El servidor pidió esperar (429): encolar sin enviar, la tarea programada reintenta
+                    $wait = RafflesQueue::backoffRemaining();
+                    if ($wait > 0) {
+                        $queue = new RafflesQueue($this->db);
+                        if ($queue->push($data) < 0) {
+                            setEventMessages("Rifas: No se pudo encolar la factura - " . $queue->error, null, 'errors');
+                        } else {
+                            setEventMessages("Rifas: Servidor de rifas saturado, la factura se enviará automáticamente en unos " . $wait . " s", null, 'warnings');
+                        }
+                        break;
+                    }
+
+                    // Modo lote: encolar; con la cola llena se envía un solo lote con timeout corto
+                    // (la tarea programada envía el resto, sin bloquear la validación)
+                    if (getDolGlobalInt('RAFFLES_BATCH_MODE') > 0) {
+                        $queue = new RafflesQueue($this->db);
+                        $queued = $queue->push($data);
+                        if ($queued < 0) {
+                            dol_syslog("RafflesTrigger Error: could not queue invoice - " . $queue->error, LOG_ERR);
+                            setEventMessages("Rifas: No se pudo encolar la factura - " . $queue->error, null, 'errors');
+                        } elseif ($queued >= RafflesQueue::getBatchSize()) {
+                            $sent = $queue->flush(1, RafflesQueue::TRIGGER_TIMEOUT);
+                            if ($sent < 0) {
+                                setEventMessages("Rifas: Error al enviar el lote - " . $queue->error, null, 'warnings');
+                            } else {
+                                setEventMessages("Rifas: Lote enviado - " . implode(' ', $queue->output), null, 'mesgs');
+                            }
+                        } else {
+                            setEventMessages("Rifas: Factura encolada para envío por lotes (" . $queued . " en cola)", null, 'mesgs');
+                        }
+                        break;
+                    }
+
                     // Enviar petición CURL
                     $ch = curl_init($apiUrl);
                     if ($ch === false) {
@@ -133,6 +168,13 @@ class InterfaceRafflesTrigger extends DolibarrTriggers
 
                     curl_setopt($ch, CURLOPT_TIMEOUT, 10);
                     curl_setopt($ch, CURLOPT_CONNECTTIMEOUT, 5);
+                    $retryAfter = 0;
+                    curl_setopt($ch, CURLOPT_HEADERFUNCTION, function ($ch, $header) use (&$retryAfter) {
+                        if (stripos($header, 'Retry-After:') === 0) {
+                            $retryAfter = (int) trim(substr($header, 12));
+                        }
+                        return strlen($header);
+                    });
 
                     $response = curl_exec($ch);
                     $httpcode = curl_getinfo($ch, CURLINFO_HTTP_CODE);
@@ -147,10 +189,30 @@ class InterfaceRafflesTrigger extends DolibarrTriggers
                         
                         if ($httpcode == 200 || $httpcode == 201) {
                             $ticketCount = isset($responseData['tickets_generated']) ? $responseData['tickets_generated'] : 0;
-                            $ticketNumbers = isset($responseData['ticket_numbers']) ? implode(', ', $responseData['ticket_numbers']) : '';
+                            $ticketNumbers = '';
+                            if (isset($responseData['ticket_ranges'])) {
+                                // [[1001, 1500], [1507, 1507]] -> "1001-1500, 1507"
+                                $parts = array();
+                                foreach ($responseData['ticket_ranges'] as $range) {
+                                    $parts[] = ($range[0] == $range[1]) ? $range[0] : $range[0] . '-' . $range[1];
+                                }
+                                $ticketNumbers = implode(', ', $parts);
+                            } elseif (isset($responseData['ticket_numbers'])) {
+                                $ticketNumbers = implode(', ', $responseData['ticket_numbers']);
+                            }
                             setEventMessages("Rifas: Se generaron " . $ticketCount . " boleto(s) gratis. Números: " . $ticketNumbers, null, 'mesgs');
+                        } elseif ($httpcode == 202) {
+                            setEventMessages("Rifas: Factura recibida, los boletos se generarán en segundo plano", null, 'mesgs');
                         } elseif ($httpcode == 401) {
                             setEventMessages("Rifas: Error de autenticación - Verifique el API Key en la configuración", null, 'errors');
+                        } elseif ($httpcode == 429) {
+                            RafflesQueue::setBackoff($retryAfter);
+                            $queue = new RafflesQueue($this->db);
+                            if ($queue->push($data) < 0) {
+                                setEventMessages("Rifas: Servidor saturado y no se pudo encolar la factura - " . $queue->error, null, 'errors');
+                            } else {
+                                setEventMessages("Rifas: Servidor de rifas saturado, la factura se enviará automáticamente en unos " . RafflesQueue::backoffRemaining() . " s", null, 'warnings');
+                            }
                         } elseif ($httpcode == 409) {
                             $existingCount = isset($responseData['tickets_previously_generated']) ? $responseData['tickets_previously_generated'] : 0;
                             setEventMessages("Rifas: Esta factura ya generó " . $existingCount . " boleto(s) anteriormente", null, 'warnings');
@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.shortcuts import render
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.html import format_html
 
 from .models import (
@@ -8,14 +9,18 @@ from .models import (
     DolibarrIntegration,
     DolibarrInstance,
     DolibarrTransaction,
+    DrawPoolSnapshot,
+    InvoicePaymentStatus,
     Prize,
     Raffle,
     SiteSettings,
     SocialLink,
     Ticket,
     TicketTemplate,
+    WebhookInboxItem,
     WinnerDiscard,
 )
+from .ticket_numbers import allocate_ticket_numbers, sync_ticket_counter
 from .version import __version__
 
 admin.site.site_header = f"Administración de Rifas v{__version__}"
@@ -81,6 +86,23 @@ class TicketAdmin(admin.ModelAdmin):
     autocomplete_fields = ('raffle', 'customer', 'dolibarr_transaction')
     actions = ['download_selected_tickets']
 
+    def get_form(self, request, obj=None, **kwargs):
+        form = super().get_form(request, obj, **kwargs)
+        if obj is None and 'ticket_number' in form.base_fields:
+            field = form.base_fields['ticket_number']
+            field.required = False
+            field.help_text = "Dejar vacío para asignar el siguiente número libre de la rifa."
+        return form
+
+    def save_model(self, request, obj, form, change):
+        # changeform_view runs inside transaction.atomic(), as the allocator requires.
+        if obj.ticket_number is None:
+            obj.ticket_number = allocate_ticket_numbers(obj.raffle_id, 1).start
+            super().save_model(request, obj, form, change)
+        else:
+            super().save_model(request, obj, form, change)
+            sync_ticket_counter(obj.raffle_id, obj.ticket_number)
+
     def view_ticket_link(self, obj):
         url = reverse('raffles:generate_ticket', args=[obj.id])
         return format_html('<a href="{}" target="_blank" class="button">Ver Boleto</a>', url)
@@ -118,12 +140,16 @@ class DolibarrInstanceAdmin(admin.ModelAdmin):
             'description': 'La key que el módulo Raffles de esta Dolibarr envía en el header Authorization. Debe ser única por instancia para evitar colisiones de facture_id entre empresas.',
         }),
         ('Credenciales salientes (para consultar pagos)', {
-            'fields': ('outbound_api_url', 'outbound_api_key'),
-            'description': 'Necesarias para que el panel de sorteo pueda verificar el estado de pago de cada factura contra esta Dolibarr.',
+            'fields': ('outbound_api_url', 'outbound_api_key', 'verification_concurrency'),
+            'description': 'Necesarias para que el panel de sorteo pueda verificar el estado de pago de cada factura contra esta Dolibarr. Las consultas simultáneas limitan la carga sobre este servidor; las demás instancias se consultan en paralelo.',
         }),
         ('Política de boletos', {
             'fields': ('tickets_per_amount', 'amount_step', 'default_ticket_price'),
         }),
+        ('Procesamiento de webhooks', {
+            'fields': ('use_inbox', 'rate_limit_burst', 'rate_limit_per_minute'),
+            'description': 'Con la bandeja de entrada activada, Dolibarr recibe 202 sin esperar la generación de boletos. Requiere un worker <code>manage.py process_webhook_inbox --loop</code> corriendo. Con una ráfaga mayor a 0, los webhooks que superen el límite reciben 429 y el módulo Dolibarr los reintenta más tarde.',
+        }),
     )
 
 
@@ -136,6 +162,68 @@ class DolibarrTransactionAdmin(admin.ModelAdmin):
     autocomplete_fields = ('instance',)
 
 
+@admin.register(InvoicePaymentStatus)
+class InvoicePaymentStatusAdmin(admin.ModelAdmin):
+    list_display = ('instance', 'facture_id', 'is_paid', 'checked_at', 'attempted_at', 'last_error')
+    list_filter = ('instance', 'is_paid')
+    search_fields = ('facture_id', 'last_error')
+    readonly_fields = ('instance', 'facture_id', 'is_paid', 'checked_at', 'attempted_at', 'last_error')
+    actions = ['mark_stale']
+
+    def has_add_permission(self, request):
+        return False
+
+    def mark_stale(self, request, queryset):
+        updated = queryset.update(checked_at=None)
+        self.message_user(request, f"{updated} factura(s) se verificarán en la próxima pasada de refresh_invoice_status.")
+
+    mark_stale.short_description = "Volver a verificar en la próxima pasada"
+
+
+@admin.register(DrawPoolSnapshot)
+class DrawPoolSnapshotAdmin(admin.ModelAdmin):
+    list_display = ('raffle', 'ticket_count', 'exclude_unpaid', 'sha256', 'created_by', 'created_at', 'released_at')
+    list_filter = ('raffle',)
+    search_fields = ('sha256',)
+    exclude = ('ticket_ids',)
+    readonly_fields = (
+        'raffle', 'exclude_unpaid', 'ticket_count', 'id_width', 'sha256', 'created_by', 'created_at', 'released_at',
+    )
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(WebhookInboxItem)
+class WebhookInboxItemAdmin(admin.ModelAdmin):
+    list_display = ('id', 'instance', 'status', 'attempts', 'result_status', 'next_attempt_at', 'created_at', 'processed_at')
+    list_filter = ('status', 'instance', 'created_at')
+    search_fields = ('payload', 'last_error')
+    readonly_fields = (
+        'instance', 'payload', 'status', 'attempts', 'next_attempt_at', 'claimed_by', 'claimed_at',
+        'result_status', 'result', 'last_error', 'created_at', 'processed_at',
+    )
+    actions = ['requeue_items']
+
+    def has_add_permission(self, request):
+        return False
+
+    def requeue_items(self, request, queryset):
+        updated = queryset.exclude(status=WebhookInboxItem.Status.DONE).update(
+            status=WebhookInboxItem.Status.PENDING,
+            attempts=0,
+            next_attempt_at=timezone.now(),
+            claimed_by='',
+            claimed_at=None,
+        )
+        self.message_user(request, f"{updated} webhook(s) reencolados.")
+
+    requeue_items.short_description = "Reencolar (reintentar ahora)"
+
+
 @admin.register(Prize)
 class PrizeAdmin(admin.ModelAdmin):
     list_display = ('raffle', 'position', 'name', 'winning_ticket', 'drawn_at')
@@ -8,6 +8,11 @@ class RafflesConfig(AppConfig):
     name = "raffles"
 
     def ready(self):
+        from . import checks  # noqa: F401 (registers the system checks)
+        from . import recent_invoices, resolver
+        resolver.connect_signals()
+        recent_invoices.connect_signals()
+
         # Ensure media directory exists to prevent 500 errors on file upload
         media_root = settings.MEDIA_ROOT
         if not os.path.exists(media_root):
@@ -0,0 +1,93 @@
+"""Helpers shared by the ``bench_*`` management commands.
+
+Benchmarks never write to the configured database: they run against a
+throw-away test database of the same engine (SQLite or PostgreSQL) that is
+created on entry and destroyed on exit, exactly like ``manage.py test``.
+"""
+import contextlib
+import math
+import os
+import shutil
+import tempfile
+
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+
+@contextlib.contextmanager
+def bench_database(verbosity=0):
+    """Create a disposable test database and point the default connection at it.
+
+    SQLite gets an on-disk file instead of the shared in-memory database so
+    several threads can open their own connections to it.
+    """
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    original_test_name = test_settings.get('NAME')
+    tmpdir = None
+    if connection.vendor == 'sqlite' and not original_test_name:
+        tmpdir = tempfile.mkdtemp(prefix='raffles-bench-')
+        test_settings['NAME'] = os.path.join(tmpdir, 'bench.sqlite3')
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(
+        verbosity=verbosity, autoclobber=True, serialize=False,
+    )
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+        teardown_test_environment()
+        test_settings['NAME'] = original_test_name
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of ``samples`` (0 when empty)."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def latency_summary(samples_ms):
+    """p50/p99/mean/max of a list of millisecond samples, rounded for display."""
+    if not samples_ms:
+        return {'p50': 0.0, 'p99': 0.0, 'mean': 0.0, 'max': 0.0}
+    return {
+        'p50': round(percentile(samples_ms, 50), 2),
+        'p99': round(percentile(samples_ms, 99), 2),
+        'mean': round(sum(samples_ms) / len(samples_ms), 2),
+        'max': round(max(samples_ms), 2),
+    }
+
+
+def number_anomalies(numbers):
+    """``(duplicates, gaps)`` of a collection of ticket numbers: numbers issued
+    more than once, and numbers missing between the lowest and highest."""
+    seen = set()
+    duplicates = set()
+    for number in numbers:
+        if number in seen:
+            duplicates.add(number)
+        seen.add(number)
+    if not seen:
+        return [], []
+    gaps = [n for n in range(min(seen), max(seen) + 1) if n not in seen]
+    return sorted(duplicates), gaps
+
+
+def parse_server_timing(header):
+    """``{'lock': 1.23, ...}`` from a Server-Timing header value."""
+    durations = {}
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip() == 'dur':
+                try:
+                    durations[name] = float(value)
+                except ValueError:
+                    pass
+    return durations
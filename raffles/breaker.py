@@ -0,0 +1,81 @@
+"""Per-instance circuit breaker for calls to the Dolibarr REST API.
+
+When an ERP is down every request to it waits the full HTTP timeout, so a
+refresh of the draw panel could take minutes. After
+``RAFFLES_BREAKER_FAILURES`` consecutive failures (default 3: connection
+errors, timeouts, 5xx) the breaker of that instance opens and calls fail
+fast for ``RAFFLES_BREAKER_COOLDOWN`` seconds (default 60). After the
+cooldown it is half-open: one request is let through as a probe; success
+closes the breaker, failure opens it for another cooldown.
+
+State lives in Django's cache like the rate limiter's, so with a shared
+backend every worker sees the same breaker. Updates are not locked: two
+failures racing may count as one, which only delays opening by a request.
+"""
+import logging
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_STATE_KEY = 'raffles:breaker:{}'
+_PROBE_KEY = 'raffles:breaker:{}:probe'
+
+
+def allow(instance):
+    """Whether a request to the instance may be sent now."""
+    state = cache.get(_STATE_KEY.format(instance.id))
+    if not state or state['opened_at'] is None:
+        return True
+    if time.time() < state['opened_at'] + _cooldown():
+        return False
+    # Half-open: the first caller after the cooldown is the probe.
+    return cache.add(_PROBE_KEY.format(instance.id), 1, _cooldown())
+
+
+def record_success(instance):
+    cache.delete_many([_STATE_KEY.format(instance.id), _PROBE_KEY.format(instance.id)])
+
+
+def record_failure(instance):
+    key = _STATE_KEY.format(instance.id)
+    state = cache.get(key) or {'failures': 0, 'opened_at': None}
+    state['failures'] += 1
+    if state['opened_at'] is not None or state['failures'] >= _threshold():
+        if state['opened_at'] is None:
+            logger.warning(
+                "Dolibarr API circuit opened for instance=%s after %s failures",
+                instance.slug, state['failures'],
+            )
+        state['opened_at'] = time.time()
+    cache.set(key, state, None)
+    cache.delete(_PROBE_KEY.format(instance.id))
+
+
+def status(instance):
+    """``{'state', 'failures', 'retry_in'}`` for display; ``retry_in`` is the
+    number of seconds until the next probe while open."""
+    state = cache.get(_STATE_KEY.format(instance.id))
+    if not state:
+        return {'state': CLOSED, 'failures': 0, 'retry_in': 0}
+    if state['opened_at'] is None:
+        return {'state': CLOSED, 'failures': state['failures'], 'retry_in': 0}
+    retry_in = state['opened_at'] + _cooldown() - time.time()
+    if retry_in > 0:
+        return {'state': OPEN, 'failures': state['failures'], 'retry_in': math.ceil(retry_in)}
+    return {'state': HALF_OPEN, 'failures': state['failures'], 'retry_in': 0}
+
+
+def _threshold():
+    return max(getattr(settings, 'RAFFLES_BREAKER_FAILURES', 3), 1)
+
+
+def _cooldown():
+    return getattr(settings, 'RAFFLES_BREAKER_COOLDOWN', 60)
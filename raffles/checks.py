@@ -0,0 +1,29 @@
+"""System checks for the deployment the raffles app assumes."""
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+# Backends whose data lives inside one process: each gunicorn worker would
+# get its own copy.
+PROCESS_LOCAL_CACHES = {
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+}
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """The webhook config cache (resolver), the recent-invoice filter, the
+    rate limiter and the circuit breaker coordinate the gunicorn workers
+    through the default cache, so it must be shared between processes."""
+    backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+    if backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Error(
+        f"CACHES['default'] usa {backend}, que es local a cada proceso.",
+        hint=(
+            "Con varios workers de gunicorn una API key revocada o una transacción borrada siguen "
+            "vigentes en los demás workers. Configure Redis/Memcached o, como mínimo, "
+            "django.core.cache.backends.db.DatabaseCache (python manage.py createcachetable)."
+        ),
+        id='raffles.E001',
+    )]
@@ -3,33 +3,53 @@
 Used by the draw panel to filter out tickets whose source invoice is still
 unpaid. Each `DolibarrInstance` carries its own `outbound_api_url` and
 `outbound_api_key` so this client works across N parallel Dolibarr installs.
+
+Page requests read the last known answer from `InvoicePaymentStatus`
+(`is_invoice_paid`, `ticket_payment_statuses`), joined to the tickets through
+``DolibarrTransaction.payment_status``; that table is the store of record.
+``manage.py refresh_invoice_status`` keeps it current with
+`refresh_invoice_statuses`, and the panel's refresh button runs a
+background job (``raffles.payment_refresh``). Dolibarr is asked with one
+``GET /invoices?sqlfilters=(t.rowid:in:...)`` per chunk of invoices
+(`invoice_statuses`).
+
+Verification fans out: a refresh job checks every instance in its
+own thread, and within one instance `invoice_statuses` sends up to
+``verification_concurrency`` list requests at a time. Each instance has its
+own `requests.Session` whose connection pool matches that limit, so one slow
+ERP neither delays the others nor gets more parallel requests than it was
+configured for. An ERP that keeps failing trips its circuit breaker
+(``raffles.breaker``) and is skipped until it answers a probe again.
 """
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from django.core.cache import cache
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+
+from . import breaker
+from .models import InvoicePaymentStatus
 
 logger = logging.getLogger(__name__)
 
-_CACHE_TTL_SECONDS = 600  # 10 minutes
 _HTTP_TIMEOUT_SECONDS = 5
+_BATCH_SIZE = 100  # invoices per list request; keeps the URL short
 
-_session = requests.Session()
-
+_sessions = {}  # instance id -> (pool size, Session)
+_sessions_lock = threading.Lock()
 
-def _cache_key(instance_id, facture_id):
-    return f"dolinvoice_{instance_id}_{facture_id}"
 
-
-def is_invoice_paid(ticket, force_refresh=False):
+def is_invoice_paid(ticket):
     """Return True if the ticket's source invoice is paid in Dolibarr,
     False if explicitly unpaid, or None when the answer is unknown
     (no transaction, no facture_id, instance has no outbound creds,
-    or the API call fails). Callers MUST treat None as "unverified" and
-    decide whether to include or exclude such tickets.
+    or Dolibarr has not answered for it yet). Callers MUST treat None as
+    "unverified" and decide whether to include or exclude such tickets.
 
-    Set ``force_refresh=True`` to bypass the 10-minute cache and re-query
-    Dolibarr — used by the "refrescar verificación de pagos" button.
+    The answer comes from the stored `InvoicePaymentStatus` row, which
+    refresh_invoice_status and the panel's refresh job keep current.
     """
     tx = getattr(ticket, 'dolibarr_transaction', None)
     if tx is None or tx.facture_id is None or tx.instance_id is None:
@@ -39,43 +59,198 @@ def is_invoice_paid(ticket, force_refresh=False):
     if not instance.outbound_api_url or not instance.outbound_api_key:
         return None
 
-    key = _cache_key(instance.id, tx.facture_id)
-    if not force_refresh:
-        cached = cache.get(key)
-        if cached is not None:
-            return cached
+    stored = _stored_status(tx)
+    return stored.is_paid if stored is not None else None
 
-    url = f"{instance.outbound_api_url.rstrip('/')}/invoices/{tx.facture_id}"
-    headers = {
-        'DOLAPIKEY': instance.outbound_api_key,
-        'Accept': 'application/json',
-    }
-    try:
-        response = _session.get(url, headers=headers, timeout=_HTTP_TIMEOUT_SECONDS)
-    except requests.RequestException as exc:
-        logger.warning(
-            "Dolibarr API unreachable for instance=%s facture_id=%s: %s",
-            instance.slug, tx.facture_id, exc,
+
+def invoice_statuses(instance, facture_ids, errors=None):
+    """Payment status of many invoices of one instance: ``{facture_id: True |
+    False | None}`` with the same meaning as `is_invoice_paid`, straight from
+    Dolibarr (this does not read or write `InvoicePaymentStatus`).
+
+    The invoices are fetched from the list endpoint in chunks of
+    ``_BATCH_SIZE``, at most ``instance.verification_concurrency`` at a time.
+    A failed chunk leaves its invoices as None; an invoice missing from the
+    answer (deleted in Dolibarr) too. While the instance's circuit breaker is
+    open nothing is sent.
+    Pass a dict as ``errors`` to get the reason for each None.
+    """
+    facture_ids = list(dict.fromkeys(facture_ids))
+    if not instance.outbound_api_url or not instance.outbound_api_key:
+        return dict.fromkeys(facture_ids)
+
+    statuses = {}
+    chunks = [facture_ids[start:start + _BATCH_SIZE] for start in range(0, len(facture_ids), _BATCH_SIZE)]
+    for chunk, (fetched, error) in zip(chunks, _map_bounded(
+        lambda chunk: _fetch_statuses(instance, chunk),
+        chunks,
+        instance.verification_concurrency,
+        f"dolibarr-{instance.slug}",
+    )):
+        for facture_id in chunk:
+            statuses[facture_id] = fetched.get(facture_id)
+            if statuses[facture_id] is None and errors is not None:
+                errors[facture_id] = error or 'not found in Dolibarr'
+    return statuses
+
+
+def refresh_invoice_statuses(instance, facture_ids):
+    """Re-query Dolibarr for ``facture_ids`` and store the answers in
+    `InvoicePaymentStatus`. Returns what `invoice_statuses` returned."""
+    errors = {}
+    statuses = invoice_statuses(instance, facture_ids, errors=errors)
+    record_statuses(instance, statuses, errors)
+    return statuses
+
+
+def record_statuses(instance, statuses, errors):
+    """Upsert one `InvoicePaymentStatus` per invoice: answers replace the
+    stored flag; failures only note the attempt and keep the last answer."""
+    if not instance.outbound_api_url or not instance.outbound_api_key:
+        return
+    now = timezone.now()
+    answered = [
+        InvoicePaymentStatus(
+            instance=instance, facture_id=facture_id, is_paid=paid,
+            checked_at=now, attempted_at=now, last_error='',
+        )
+        for facture_id, paid in statuses.items() if paid is not None
+    ]
+    failed = [
+        InvoicePaymentStatus(
+            instance=instance, facture_id=facture_id,
+            attempted_at=now, last_error=errors.get(facture_id, ''),
         )
+        for facture_id, paid in statuses.items() if paid is None
+    ]
+    for rows, fields in (
+        (answered, ['is_paid', 'checked_at', 'attempted_at', 'last_error']),
+        (failed, ['attempted_at', 'last_error']),
+    ):
+        if rows:
+            InvoicePaymentStatus.objects.bulk_create(
+                rows,
+                batch_size=500,
+                update_conflicts=True,
+                unique_fields=['instance', 'facture_id'],
+                update_fields=fields,
+            )
+
+
+def ticket_payment_statuses(tickets):
+    """`is_invoice_paid` for many tickets: ``{ticket.id: True | False | None}``.
+
+    Reads the stored statuses; expects ``dolibarr_transaction__instance``
+    and ``dolibarr_transaction__payment_status`` to be select_related, so
+    the whole pool costs no extra query."""
+    return {ticket.id: is_invoice_paid(ticket) for ticket in tickets}
+
+
+def _stored_status(tx):
+    try:
+        return tx.payment_status
+    except InvoicePaymentStatus.DoesNotExist:
         return None
 
+
+def _map_bounded(func, items, workers, name):
+    """``list(map(func, items))`` on at most ``workers`` threads; inline when
+    one thread would do, so a single chunk never starts a pool."""
+    workers = min(max(workers, 1), len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name) as pool:
+        return list(pool.map(func, items))
+
+
+def _fetch_statuses(instance, facture_ids):
+    """One list request for ``facture_ids``: ``({facture_id: bool}, None)``
+    for the invoices Dolibarr returned, or ``({}, error)`` when the call fails."""
+    url = f"{instance.outbound_api_url.rstrip('/')}/invoices"
+    params = {
+        'sqlfilters': f"(t.rowid:in:{','.join(str(int(facture_id)) for facture_id in facture_ids)})",
+        'limit': len(facture_ids),
+    }
+    response, error = _get(instance, url, f"({len(facture_ids)} invoices)", params=params)
+    if error:
+        return {}, error
+
+    if response.status_code == 404:
+        # The list endpoint answers 404 when no invoice matched the filter.
+        return {}, None
     if not response.ok:
         logger.warning(
-            "Dolibarr API returned %s for instance=%s facture_id=%s",
-            response.status_code, instance.slug, tx.facture_id,
+            "Dolibarr API returned %s for instance=%s (%s invoices)",
+            response.status_code, instance.slug, len(facture_ids),
         )
-        return None
+        return {}, f'HTTP {response.status_code}'
 
     try:
         payload = response.json()
     except ValueError:
+        payload = None
+    if not isinstance(payload, list):
         logger.warning(
-            "Dolibarr API returned non-JSON for instance=%s facture_id=%s",
-            instance.slug, tx.facture_id,
+            "Dolibarr API returned an unexpected invoice list for instance=%s (%s invoices)",
+            instance.slug, len(facture_ids),
         )
-        return None
+        return {}, 'unexpected response'
+
+    wanted = {str(facture_id): facture_id for facture_id in facture_ids}
+    statuses = {}
+    for invoice in payload:
+        facture_id = wanted.get(str(invoice.get('id')))
+        if facture_id is not None:
+            statuses[facture_id] = _is_paid(invoice)
+    return statuses, None
+
+
+def _get(instance, url, what, params=None):
+    """GET through the instance's circuit breaker: ``(response, None)`` or
+    ``(None, error)``. Connection errors, timeouts and 5xx count as
+    failures; any other answer proves the ERP is up."""
+    if not breaker.allow(instance):
+        return None, 'circuit open'
+    try:
+        response = _session_for(instance).get(
+            url, headers=_headers(instance), params=params, timeout=_HTTP_TIMEOUT_SECONDS,
+        )
+    except requests.RequestException as exc:
+        logger.warning("Dolibarr API unreachable for instance=%s %s: %s", instance.slug, what, exc)
+        breaker.record_failure(instance)
+        return None, f'unreachable: {exc}'
+    if response.status_code >= 500:
+        breaker.record_failure(instance)
+    else:
+        breaker.record_success(instance)
+    return response, None
+
+
+def _session_for(instance):
+    """The instance's Session, its connection pool sized to
+    ``verification_concurrency`` so parallel chunks reuse their sockets.
+    Replaced when the limit changes in the admin; a request still running on
+    the old Session finishes normally."""
+    size = max(instance.verification_concurrency, 1)
+    with _sessions_lock:
+        current = _sessions.get(instance.id)
+        if current is not None and current[0] == size:
+            return current[1]
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _sessions[instance.id] = (size, session)
+    return session
+
+
+def _headers(instance):
+    return {
+        'DOLAPIKEY': instance.outbound_api_key,
+        'Accept': 'application/json',
+    }
+
 
+def _is_paid(invoice):
     # Dolibarr serializes `paye` as the string "1" or "0".
-    paid = str(payload.get('paye', '')) == '1'
-    cache.set(key, paid, _CACHE_TTL_SECONDS)
-    return paid
+    return str(invoice.get('paye', '')) == '1'
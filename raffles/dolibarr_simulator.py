@@ -0,0 +1,160 @@
+"""Local fake of the Dolibarr REST ``/invoices`` API.
+
+Tests and benchmarks point a DolibarrInstance's ``outbound_api_url`` at a
+running simulator so the real HTTP path of `dolibarr_client` (sessions and
+connection pooling, timeouts, status codes, the circuit breaker) is
+exercised offline. It answers the two endpoints the client uses:
+
+- ``GET /invoices/{id}``: the invoice, or 404 when it does not exist.
+- ``GET /invoices?sqlfilters=(t.rowid:in:1,2,3)&limit=N``: the matching
+  invoices (``(t.rowid:=:5)`` is accepted too), or 404 when none matched,
+  as Dolibarr does. ``limit`` defaults to Dolibarr's 100.
+
+Every request waits ``latency`` seconds and fails with ``error_status``
+with probability ``error_rate``. An invoice is paid with probability
+``paid_ratio``, decided once per id from ``seed``, so the answers are stable
+across requests; ``statuses`` overrides that for given ids. With
+``invoices`` set, only ids 1..invoices exist. A wrong ``DOLAPIKEY`` header
+gets a 401 when ``api_key`` is set.
+
+Use it as a context manager (or ``start()``/``stop()``)::
+
+    with DolibarrSimulator(latency=0.05, paid_ratio=0.8) as simulator:
+        instance.outbound_api_url = simulator.url
+
+or standalone with ``manage.py simulate_dolibarr``.
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+_INVOICE_PATH = re.compile(r'^(?P<prefix>.*)/invoices(?:/(?P<id>\d+))?/?$')
+_SQLFILTERS = re.compile(r'^\(t\.rowid:(?:in|=):(?P<ids>\d+(?:,\d+)*)\)$')
+_DEFAULT_LIMIT = 100
+
+
+class DolibarrSimulator:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, error_status=500,
+                 paid_ratio=1.0, invoices=None, statuses=None, api_key=None, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.paid_ratio = paid_ratio
+        self.invoices = invoices
+        self.statuses = dict(statuses or {})
+        self.api_key = api_key
+        self.seed = seed
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.simulator = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """Base URL to use as ``outbound_api_url``."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/index.php"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='dolibarr-simulator', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """Serve on the calling thread until interrupted."""
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def invoice(self, facture_id):
+        """The invoice as Dolibarr serializes it, or None if it does not exist."""
+        if facture_id <= 0 or (self.invoices is not None and facture_id > self.invoices):
+            return None
+        paid = self.statuses.get(facture_id)
+        if paid is None:
+            paid = random.Random(f"{self.seed}:{facture_id}").random() < self.paid_ratio
+        return {
+            'id': str(facture_id),
+            'ref': f"FA-{facture_id}",
+            'paye': '1' if paid else '0',
+            'statut': '2' if paid else '1',
+        }
+
+    def _should_fail(self):
+        with self._lock:
+            self.requests += 1
+            failed = self.error_rate > 0 and self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+            return failed
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, so client connection pools matter
+
+    def do_GET(self):
+        simulator = self.server.simulator
+        if simulator.latency:
+            time.sleep(simulator.latency)
+        if simulator._should_fail():
+            error = {'code': simulator.error_status, 'message': 'Simulated error'}
+            return self._reply(simulator.error_status, {'error': error})
+        if simulator.api_key is not None and self.headers.get('DOLAPIKEY') != simulator.api_key:
+            return self._reply(401, {'error': {'code': 401, 'message': 'Access unauthorized'}})
+
+        parts = urlsplit(self.path)
+        match = _INVOICE_PATH.match(parts.path)
+        if not match:
+            return self._reply(404, {'error': {'code': 404, 'message': 'Not Found'}})
+        if match['id']:
+            invoice = simulator.invoice(int(match['id']))
+            if invoice is None:
+                return self._reply(404, {'error': {'code': 404, 'message': 'Bill not found'}})
+            return self._reply(200, invoice)
+
+        query = parse_qs(parts.query)
+        filters = _SQLFILTERS.match(query.get('sqlfilters', [''])[0])
+        if not filters:
+            return self._reply(400, {'error': {'code': 400, 'message': 'Error when validating parameter sqlfilters'}})
+        try:
+            limit = int(query.get('limit', [_DEFAULT_LIMIT])[0])
+        except ValueError:
+            limit = _DEFAULT_LIMIT
+        ids = sorted({int(facture_id) for facture_id in filters['ids'].split(',')})
+        invoices = [invoice for invoice in map(simulator.invoice, ids) if invoice is not None][:limit]
+        if not invoices:
+            return self._reply(404, {'error': {'code': 404, 'message': 'No invoice found'}})
+        return self._reply(200, invoices)
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
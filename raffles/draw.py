@@ -0,0 +1,255 @@
+"""Draw engine: picks winners in the database, without loading the pool.
+
+The pool of a raffle is every ticket that is neither a winner of one of its
+prizes nor discarded from one (`pool`). Both exclusions are NOT EXISTS
+anti-joins, so the database plans them as such whatever their size. With
+``exclude_unpaid`` only tickets whose stored invoice status is paid are
+eligible (`eligible`), the same rule as `ticket_payment_statuses`: unknown
+and unverifiable count as not paid.
+
+`pick` draws a primary key between the smallest and largest eligible one
+with ``secrets`` and looks that key up among the eligible tickets; a key that
+is not eligible (a gap, another raffle's ticket, an unpaid invoice) is
+redrawn, and this rejection keeps every eligible ticket equally likely. Each
+attempt is a primary key lookup, so the time the prize stays locked does not
+grow with the raffle as long as its ids are reasonably dense. After
+``_KEYSET_ATTEMPTS`` misses it falls back to a count and an OFFSET scan,
+which is linear in the pool. `pick_many` draws several distinct winners (a
+whole prize list) from a single pass over the pool, also linear.
+
+For a draw event staff can `freeze` the eligible set into a
+`DrawPoolSnapshot`: the sorted ids as a compact array plus its SHA-256,
+which can be published before the first draw. While it is active,
+`pick_from_snapshot` draws from the array (decoded once per process, the
+snapshot never changes), skipping tickets that have won or been discarded
+since, and only fetches the winning row.
+"""
+import hashlib
+import secrets
+import sys
+import threading
+from array import array
+
+from django.db import transaction
+from django.db.models import Exists, Max, Min, OuterRef
+from django.utils import timezone
+
+from .models import DrawPoolSnapshot, Prize, Ticket, WinnerDiscard
+
+_PICK_ATTEMPTS = 3
+_KEYSET_ATTEMPTS = 32
+_STREAM_CHUNK = 10000
+_decoded = {}  # (snapshot id, sha256) -> array of ticket ids; ids can be reused
+_decoded_lock = threading.Lock()
+_DECODED_MAX = 8
+
+
+def pool(raffle):
+    """Tickets of the raffle that are neither a winner nor discarded."""
+    return (
+        Ticket.objects
+        .filter(raffle=raffle)
+        .exclude(Exists(Prize.objects.filter(raffle=raffle, winning_ticket=OuterRef('pk'))))
+        .exclude(Exists(WinnerDiscard.objects.filter(prize__raffle=raffle, ticket=OuterRef('pk'))))
+    )
+
+
+def eligible(raffle, exclude_unpaid=True):
+    """The pool, restricted to paid invoices when ``exclude_unpaid``."""
+    tickets = pool(raffle)
+    if exclude_unpaid:
+        tickets = (
+            tickets
+            .filter(dolibarr_transaction__payment_status__is_paid=True)
+            .exclude(dolibarr_transaction__instance__outbound_api_url='')
+            .exclude(dolibarr_transaction__instance__outbound_api_key='')
+        )
+    return tickets
+
+
+def pick(tickets):
+    """A uniformly random ticket of the queryset, or None when it is empty.
+
+    One query for the primary key range, then one lookup per drawn key until
+    one is eligible (see the module docstring). If the pool is too sparse
+    for that, the count and the row at a CSPRNG index in primary key order;
+    if tickets disappear between those two the draw is retried."""
+    tickets = tickets.select_related('customer', 'dolibarr_transaction__instance')
+    bounds = tickets.aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['low'] is None:
+        return None
+    for _ in range(_KEYSET_ATTEMPTS):
+        candidate = bounds['low'] + secrets.randbelow(bounds['high'] - bounds['low'] + 1)  # CSPRNG
+        for ticket in tickets.filter(pk=candidate):
+            return ticket
+
+    for _ in range(_PICK_ATTEMPTS):
+        count = tickets.count()
+        if not count:
+            return None
+        index = secrets.randbelow(count)  # CSPRNG, not Mersenne Twister
+        winner = tickets.order_by('pk')[index:index + 1]
+        for ticket in winner:
+            return ticket
+    return None
+
+
+def pick_many(tickets, k):
+    """``k`` distinct uniformly random tickets of the queryset, in draw order,
+    or None when it has fewer than ``k``.
+
+    One count, one streamed pass over the ids to the drawn indexes (memory
+    stays flat) and one query for the winning rows."""
+    count = tickets.count()
+    if count < k:
+        return None
+    indexes = _sample_indexes(count, k)
+    wanted = {index: position for position, index in enumerate(indexes)}
+    ids = [None] * k
+    last = max(indexes, default=-1)
+    ordered_ids = tickets.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=_STREAM_CHUNK)
+    for index, ticket_id in enumerate(ordered_ids):
+        if index in wanted:
+            ids[wanted[index]] = ticket_id
+        if index >= last:
+            break
+    if None in ids:
+        return None  # tickets disappeared mid-draw; the caller's transaction decides
+    rows = Ticket.objects.select_related('customer', 'dolibarr_transaction__instance').in_bulk(ids)
+    return [rows[ticket_id] for ticket_id in ids]
+
+
+def freeze(raffle, exclude_unpaid=True, user=None):
+    """Store the raffle's eligible ticket ids as its active snapshot,
+    releasing the previous one."""
+    ids = array('Q', eligible(raffle, exclude_unpaid).order_by('pk').values_list('pk', flat=True).iterator(
+        chunk_size=_STREAM_CHUNK,
+    ))
+    if (not ids or ids[-1] < 2 ** 32) and array('I').itemsize == 4:
+        ids = array('I', ids)  # half the size while the ids allow it
+    blob = _to_little_endian(ids)
+    with transaction.atomic():
+        release(raffle)
+        return DrawPoolSnapshot.objects.create(
+            raffle=raffle,
+            exclude_unpaid=exclude_unpaid,
+            ticket_count=len(ids),
+            id_width=ids.itemsize,
+            ticket_ids=blob,
+            sha256=hashlib.sha256(blob).hexdigest(),
+            created_by=user,
+        )
+
+
+def release(raffle):
+    """Deactivate the raffle's snapshot, if any; draws use the live pool again."""
+    return DrawPoolSnapshot.objects.filter(raffle=raffle, released_at__isnull=True).update(released_at=timezone.now())
+
+
+def active_snapshot(raffle):
+    """The raffle's active snapshot without its id blob, or None."""
+    return DrawPoolSnapshot.objects.defer('ticket_ids').filter(raffle=raffle, released_at__isnull=True).first()
+
+
+def snapshot_ids(snapshot):
+    """The snapshot's sorted ticket ids as an array."""
+    key = (snapshot.pk, snapshot.sha256)
+    with _decoded_lock:
+        ids = _decoded.get(key)
+    if ids is not None:
+        return ids
+    blob = bytes(DrawPoolSnapshot.objects.values_list('ticket_ids', flat=True).get(pk=snapshot.pk))
+    ids = array('I' if snapshot.id_width == 4 else 'Q')
+    ids.frombytes(blob)
+    if sys.byteorder == 'big':
+        ids.byteswap()
+    with _decoded_lock:
+        if len(_decoded) >= _DECODED_MAX:
+            _decoded.pop(next(iter(_decoded)))
+        _decoded[key] = ids
+    return ids
+
+
+def pick_from_snapshot(snapshot):
+    """A uniformly random ticket of the snapshot that has not won or been
+    discarded since it was frozen, or None when none is left."""
+    ids = snapshot_ids(snapshot)
+    excluded = _snapshot_exclusions(snapshot)
+    while True:
+        candidate = _sample_excluding(ids, excluded)
+        if candidate is None:
+            return None
+        ticket = (
+            Ticket.objects
+            .select_related('customer', 'dolibarr_transaction__instance')
+            .filter(pk=candidate, raffle_id=snapshot.raffle_id)
+            .first()
+        )
+        if ticket is not None:
+            return ticket
+        excluded.add(candidate)  # deleted since the freeze
+
+
+def pick_many_from_snapshot(snapshot, k):
+    """`pick_from_snapshot` for ``k`` distinct tickets, or None when fewer
+    than ``k`` are left."""
+    ids = snapshot_ids(snapshot)
+    excluded = _snapshot_exclusions(snapshot)
+    winners = []
+    while len(winners) < k:
+        candidates = []
+        for _ in range(k - len(winners)):
+            candidate = _sample_excluding(ids, excluded)
+            if candidate is None:
+                return None
+            excluded.add(candidate)
+            candidates.append(candidate)
+        rows = (
+            Ticket.objects
+            .select_related('customer', 'dolibarr_transaction__instance')
+            .filter(raffle_id=snapshot.raffle_id)
+            .in_bulk(candidates)
+        )
+        # Tickets deleted since the freeze stay excluded and are redrawn.
+        winners.extend(rows[candidate] for candidate in candidates if candidate in rows)
+    return winners
+
+
+def _snapshot_exclusions(snapshot):
+    winners = (
+        Prize.objects.filter(raffle_id=snapshot.raffle_id, winning_ticket__isnull=False)
+        .values_list('winning_ticket_id', flat=True).order_by()
+    )
+    discarded = WinnerDiscard.objects.filter(prize__raffle_id=snapshot.raffle_id).values_list('ticket_id', flat=True)
+    return set(winners.union(discarded.order_by()))
+
+
+def _sample_indexes(count, k):
+    """``k`` distinct indexes below ``count`` in random order, from ``secrets``."""
+    chosen = []
+    seen = set()
+    while len(chosen) < k:
+        index = secrets.randbelow(count)
+        if index not in seen:
+            seen.add(index)
+            chosen.append(index)
+    return chosen
+
+
+def _sample_excluding(ids, excluded):
+    """Uniform pick from ``ids`` minus ``excluded``: rejection sampling while
+    the exclusions are a small part of the array, a filtered list after."""
+    if len(excluded) * 2 < len(ids):
+        while True:
+            candidate = ids[secrets.randbelow(len(ids))]
+            if candidate not in excluded:
+                return candidate
+    remaining = [ticket_id for ticket_id in ids if ticket_id not in excluded]
+    return remaining[secrets.randbelow(len(remaining))] if remaining else None
+
+
+def _to_little_endian(ids):
+    if sys.byteorder == 'big':
+        ids = array(ids.typecode, ids)
+        ids.byteswap()
+    return ids.tobytes()
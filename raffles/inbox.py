@@ -0,0 +1,152 @@
+"""Durable inbox for Dolibarr webhooks.
+
+Instances with ``use_inbox`` enabled get their payloads stored as
+``WebhookInboxItem`` rows and an immediate 202, so a slow database never
+holds up invoice validation in the ERP. ``process_webhook_inbox`` drains the
+inbox through the same pipeline as the synchronous webhook
+(``raffles.webhook.process_invoices``), so the DolibarrTransaction
+idempotency rules are unchanged: a payload processed twice simply ends as a
+409 duplicate.
+
+Claiming is safe across several workers: rows are picked with
+``SELECT ... FOR UPDATE SKIP LOCKED`` where the backend supports it
+(PostgreSQL) and taken with a conditional UPDATE everywhere, so two workers
+never process the same row at the same time.
+"""
+import datetime as dt
+import json
+import logging
+import os
+import socket
+import uuid
+from itertools import groupby
+
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import resolver
+from .models import WebhookInboxItem
+from .webhook import InvoiceItem, process_invoices
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_LEASE_SECONDS = 300
+_BACKOFF_BASE_SECONDS = 30
+_BACKOFF_MAX_SECONDS = 3600
+
+# Pipeline outcomes that are final for an inbox row. 5xx results are retried.
+_DONE_STATUSES = {200, 201, 409}
+_DEAD_STATUSES = {400}
+
+
+def enqueue(instance, payloads):
+    """Store raw JSON payloads (str) for ``instance``; returns the new rows."""
+    return WebhookInboxItem.objects.bulk_create([
+        WebhookInboxItem(instance_id=instance.id, payload=payload)
+        for payload in payloads
+    ])
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def backoff_delay(attempts):
+    """Exponential backoff after the ``attempts``-th failed try."""
+    return dt.timedelta(seconds=min(_BACKOFF_BASE_SECONDS * 2 ** max(attempts - 1, 0), _BACKOFF_MAX_SECONDS))
+
+
+def claim_batch(worker, batch_size, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """Take up to ``batch_size`` due rows for ``worker``.
+
+    Due rows are pending ones whose ``next_attempt_at`` has passed, plus rows
+    left in ``processing`` by a worker that died more than ``lease_seconds``
+    ago.
+    """
+    now = timezone.now()
+    claimable = (
+        Q(status=WebhookInboxItem.Status.PENDING, next_attempt_at__lte=now)
+        | Q(status=WebhookInboxItem.Status.PROCESSING, claimed_at__lt=now - dt.timedelta(seconds=lease_seconds))
+    )
+    with transaction.atomic():
+        candidates = WebhookInboxItem.objects.filter(claimable).order_by('id')
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        ids = list(candidates.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return []
+        # Re-checking the claim condition makes the UPDATE the real arbiter on
+        # backends without SKIP LOCKED (SQLite serializes the writes).
+        WebhookInboxItem.objects.filter(claimable, id__in=ids).update(
+            status=WebhookInboxItem.Status.PROCESSING,
+            claimed_by=worker,
+            claimed_at=now,
+            attempts=F('attempts') + 1,
+        )
+    return list(
+        WebhookInboxItem.objects
+        .filter(id__in=ids, claimed_by=worker, claimed_at=now)
+        .select_related('instance')
+        .order_by('id')
+    )
+
+
+def process_batch(rows, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Run claimed rows through the webhook pipeline, one group per instance,
+    and record each outcome. Returns a dict of counters by final state."""
+    counters = {'done': 0, 'retry': 0, 'dead': 0}
+    rows = sorted(rows, key=lambda row: (row.instance_id, row.id))
+    for _, group in groupby(rows, key=lambda row: row.instance_id):
+        group = list(group)
+        instance = group[0].instance
+
+        items = {}
+        for row in group:
+            try:
+                items[row.id] = InvoiceItem(json.loads(row.payload))
+            except ValueError as e:
+                _finish(row, WebhookInboxItem.Status.DEAD, 400, {'error': 'Invalid JSON'}, f"Invalid JSON - {e}")
+                counters['dead'] += 1
+
+        if items:
+            process_invoices(instance, list(items.values()), resolver.generation())
+
+        for row in group:
+            item = items.get(row.id)
+            if item is None:
+                continue
+            if item.status in _DONE_STATUSES:
+                _finish(row, WebhookInboxItem.Status.DONE, item.status, item.body)
+                counters['done'] += 1
+            elif item.status in _DEAD_STATUSES or row.attempts >= max_attempts:
+                _finish(row, WebhookInboxItem.Status.DEAD, item.status, item.body, item.body.get('error', ''))
+                counters['dead'] += 1
+            else:
+                row.status = WebhookInboxItem.Status.PENDING
+                row.result_status = item.status
+                row.result = item.body
+                row.last_error = item.body.get('error', '')
+                row.next_attempt_at = timezone.now() + backoff_delay(row.attempts)
+                counters['retry'] += 1
+
+    WebhookInboxItem.objects.bulk_update(
+        rows,
+        ['status', 'result_status', 'result', 'last_error', 'next_attempt_at', 'processed_at'],
+    )
+    for row in rows:
+        if row.status == WebhookInboxItem.Status.DEAD:
+            logger.error(
+                "WebhookInbox: Item #%s moved to dead-letter after %s attempt(s) - instance=%s error=%s",
+                row.id, row.attempts, row.instance.slug, row.last_error,
+            )
+    return counters
+
+
+def _finish(row, status, result_status, result, error=''):
+    row.status = status
+    row.result_status = result_status
+    row.result = result
+    row.last_error = error
+    row.processed_at = timezone.now()
@@ -0,0 +1,146 @@
+"""Mide el panel de sorteo y el sorteo con un pool grande y estados guardados.
+
+Crea en una base de prueba descartable una rifa con --tickets boletos
+repartidos en --instances instancias (--per-invoice boletos por factura),
+con el estado de pago de todas las facturas ya guardado y reciente, y mide:
+
+- panel: GET del panel de sorteo completo (contadores agregados en la base),
+- sorteo: elegir un ganador entre los pagados (conteo + una fila),
+- pool en memoria: cargar el pool como objetos Ticket y clasificarlo en
+  Python, que era lo que hacían el panel y el sorteo antes.
+
+No consulta Dolibarr ni toca datos reales.
+
+Uso:
+    python manage.py bench_draw_dashboard
+    python manage.py bench_draw_dashboard --tickets 200000 --instances 3 --per-invoice 5 --iterations 10
+"""
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from raffles import draw
+from raffles.benchmarks import bench_database, latency_summary
+from raffles.dolibarr_client import ticket_payment_statuses
+from raffles.models import Customer, DolibarrInstance, DolibarrTransaction, InvoicePaymentStatus, Raffle, Ticket
+
+_BATCH = 5000
+
+
+def _pool_in_memory(raffle):
+    """Pre-aggregation implementation: load the pool, classify it in Python."""
+    tickets = list(
+        draw.pool(raffle)
+        .select_related('customer', 'dolibarr_transaction__instance', 'dolibarr_transaction__payment_status')
+    )
+    statuses = ticket_payment_statuses(tickets)
+    return [ticket for ticket in tickets if statuses[ticket.id] is True]
+
+
+class Command(BaseCommand):
+    help = "Benchmark p50/p99 del panel de sorteo y del sorteo con un pool grande y estados de pago guardados."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tickets', type=int, default=200000, help='Boletos en la rifa (default 200000).')
+        parser.add_argument('--instances', type=int, default=3, help='Instancias Dolibarr (default 3).')
+        parser.add_argument('--per-invoice', type=int, default=5, help='Boletos por factura (default 5).')
+        parser.add_argument('--iterations', type=int, default=10, help='Cargas medidas (default 10).')
+
+    def handle(self, *args, **options):
+        if min(options['tickets'], options['instances'], options['per_invoice'], options['iterations']) <= 0:
+            raise CommandError("--tickets, --instances, --per-invoice e --iterations deben ser positivos.")
+
+        with bench_database() as conn:
+            started = time.perf_counter()
+            raffle = self._populate(options)
+            self.stdout.write(
+                f"Motor: {conn.vendor} · {options['tickets']} boletos · {options['instances']} instancias · "
+                f"datos en {time.perf_counter() - started:.1f} s"
+            )
+
+            user = get_user_model().objects.create_user(username='bench', password='bench', is_staff=True)
+            client = Client()
+            client.force_login(user)
+            url = reverse('raffles:raffle_draw_dashboard', args=[raffle.id])
+            response = client.get(url)  # warm-up
+            if response.status_code != 200:
+                raise CommandError(f"Respuesta inesperada {response.status_code}.")
+            self.stdout.write(
+                f"Elegibles {response.context['eligible_count']} · no verificados "
+                f"{response.context['unverified_count']} · pool {response.context['total_pool_count']}"
+            )
+
+            samples = []
+            for _ in range(options['iterations']):
+                started = time.perf_counter()
+                client.get(url)
+                samples.append((time.perf_counter() - started) * 1000)
+            self._report("panel", samples)
+
+            samples = []
+            for _ in range(options['iterations']):
+                started = time.perf_counter()
+                draw.pick(draw.eligible(raffle))
+                samples.append((time.perf_counter() - started) * 1000)
+            self._report("sorteo", samples)
+
+            samples = []
+            for _ in range(options['iterations']):
+                started = time.perf_counter()
+                _pool_in_memory(raffle)
+                samples.append((time.perf_counter() - started) * 1000)
+            self._report("pool en memoria", samples)
+
+    def _populate(self, options):
+        raffle = Raffle.objects.create(name="Bench panel", year=2024, is_active=True)
+        customer = Customer.objects.create(first_name="Bench", identification="bench")
+        instances = [
+            DolibarrInstance.objects.create(
+                name=f"bench-{n}", slug=f"bench-{n}", inbound_api_key=f"bench-{n}",
+                outbound_api_url=f"http://bench-{n}.invalid/api/index.php", outbound_api_key="bench",
+            )
+            for n in range(options['instances'])
+        ]
+        invoices = -(-options['tickets'] // options['per_invoice'])
+        now = timezone.now()
+        DolibarrTransaction.objects.bulk_create(
+            [
+                DolibarrTransaction(
+                    instance=instances[n % len(instances)], ref=f"FA-{n}", facture_id=n + 1,
+                    amount=options['per_invoice'], tickets_count=options['per_invoice'],
+                )
+                for n in range(invoices)
+            ],
+            batch_size=_BATCH,
+        )
+        InvoicePaymentStatus.objects.bulk_create(
+            [
+                # Four in five invoices paid, the rest unpaid; every answer fresh.
+                InvoicePaymentStatus(
+                    instance=instances[n % len(instances)], facture_id=n + 1, is_paid=n % 5 != 0,
+                    checked_at=now, attempted_at=now,
+                )
+                for n in range(invoices)
+            ],
+            batch_size=_BATCH,
+        )
+        transaction_ids = list(
+            DolibarrTransaction.objects.order_by('facture_id').values_list('id', flat=True)
+        )
+        for start in range(0, options['tickets'], _BATCH):
+            Ticket.objects.bulk_create([
+                Ticket(
+                    raffle=raffle, customer=customer, ticket_number=number + 1, price=0,
+                    dolibarr_transaction_id=transaction_ids[number // options['per_invoice']],
+                )
+                for number in range(start, min(start + _BATCH, options['tickets']))
+            ])
+        return raffle
+
+    def _report(self, label, samples):
+        stats = latency_summary(samples)
+        self.stdout.write(f"{label:<16} p50 {stats['p50']:>9} ms · p99 {stats['p99']:>9} ms")
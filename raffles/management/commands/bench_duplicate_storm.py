@@ -0,0 +1,116 @@
+"""Mide el throughput del webhook Dolibarr ante una tormenta de reintentos:
+facturas ya procesadas que el módulo vuelve a enviar y que deben recibir 409.
+
+Compara la verificación de duplicados sólo contra la base de datos (db) con
+el filtro en memoria de facturas recientes delante (filter).
+
+Corre contra una base de datos de prueba descartable del mismo motor que
+settings.DATABASES; no toca datos reales.
+
+Uso:
+    python manage.py bench_duplicate_storm
+    python manage.py bench_duplicate_storm --invoices 500 --requests 10000
+    python manage.py bench_duplicate_storm --mode filter
+"""
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+
+from raffles import recent_invoices
+from raffles.benchmarks import bench_database, latency_summary
+from raffles.models import DolibarrInstance, Raffle
+
+MODES = ('db', 'filter')
+
+
+class Command(BaseCommand):
+    help = "Benchmark de reintentos duplicados del webhook Dolibarr: base de datos vs filtro en memoria."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--invoices',
+            type=int,
+            default=200,
+            help='Facturas distintas procesadas antes de la tormenta (default 200).',
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=2000,
+            help='Reintentos duplicados enviados por modo (default 2000).',
+        )
+        parser.add_argument(
+            '--mode',
+            choices=MODES + ('both',),
+            default='both',
+            help='db = sólo consulta a DolibarrTransaction, filter = filtro en memoria delante. Default: ambos.',
+        )
+
+    def handle(self, *args, **options):
+        invoices, requests = options['invoices'], options['requests']
+        if invoices <= 0 or requests <= 0:
+            raise CommandError("--invoices y --requests deben ser positivos.")
+        modes = MODES if options['mode'] == 'both' else (options['mode'],)
+
+        with bench_database() as conn:
+            self.stdout.write(f"Motor: {conn.vendor} · {invoices} facturas · {requests} reintentos por modo")
+            self.stdout.write(f"{'modo':<8} {'req/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'media ms':>10}")
+            for mode in modes:
+                stats, throughput = self._run(mode, invoices, requests)
+                self.stdout.write(
+                    f"{mode:<8} {throughput:>10} {stats['p50']:>10} {stats['p99']:>10} {stats['mean']:>10}"
+                )
+
+    def _run(self, mode, invoices, requests):
+        Raffle.objects.all().delete()
+        Raffle.objects.create(name=f"Bench {mode}", year=2024, is_active=True)
+        key = f"bench-{uuid.uuid4().hex}"
+        DolibarrInstance.objects.create(
+            name=key, slug=key, inbound_api_key=key, tickets_per_amount=1, amount_step=1,
+        )
+
+        client = Client()
+        url = reverse('raffles:dolibarr_webhook')
+        payloads = [
+            {
+                'customer_identification': f"bench-{i % 50}",
+                'customer_name': 'Bench',
+                'total_amount': 1,
+                'ref': f"{key}-{i}",
+                'facture_id': i + 1,
+            }
+            for i in range(invoices)
+        ]
+
+        original = recent_invoices.recent
+        if mode == 'db':
+            # A zero-capacity filter never remembers anything.
+            recent_invoices.recent = recent_invoices.RecentInvoices(capacity=0)
+        else:
+            recent_invoices.recent = recent_invoices.RecentInvoices()
+        samples = []
+        try:
+            for payload in payloads:
+                self._post(client, url, key, payload, 201)
+
+            rng = random.Random(0)
+            started_all = time.perf_counter()
+            for _ in range(requests):
+                payload = payloads[rng.randrange(invoices)]
+                started = time.perf_counter()
+                self._post(client, url, key, payload, 409)
+                samples.append((time.perf_counter() - started) * 1000)
+            elapsed = time.perf_counter() - started_all
+        finally:
+            recent_invoices.recent = original
+
+        return latency_summary(samples), round(requests / elapsed, 1)
+
+    def _post(self, client, url, key, payload, expected):
+        response = client.post(url, payload, content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {key}')
+        if response.status_code != expected:
+            raise CommandError(f"Respuesta inesperada {response.status_code}: {response.content[:200]!r}")
@@ -0,0 +1,119 @@
+"""Mide la verificación de pagos en frío: en serie vs en paralelo por instancia.
+
+Levanta un Dolibarr simulado por instancia (raffles/dolibarr_simulator.py,
+HTTP real en localhost) con una latencia fija por petición, una de ellas
+lenta, sin base de datos. Reporta el tiempo total de:
+
+- serie: una instancia tras otra, un lote de facturas a la vez (el
+  comportamiento anterior),
+- paralelo: un hilo por instancia (como el refresco del panel) y hasta
+  --concurrency lotes simultáneos por instancia.
+
+Uso:
+    python manage.py bench_payment_checks
+    python manage.py bench_payment_checks --instances 4 --invoices 3000 --latency-ms 80 --slow-latency-ms 800 --concurrency 4
+    python manage.py bench_payment_checks --error-rate 0.05
+"""
+import time
+from contextlib import ExitStack
+
+from django.core.management.base import BaseCommand, CommandError
+
+from raffles import breaker, dolibarr_client
+from raffles.dolibarr_simulator import DolibarrSimulator
+from raffles.models import DolibarrInstance
+
+
+class Command(BaseCommand):
+    help = "Compara la verificación de pagos en serie contra en paralelo por instancia (Dolibarr simulado)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--instances', type=int, default=3, help='Instancias Dolibarr simuladas (default 3).')
+        parser.add_argument('--invoices', type=int, default=2000, help='Facturas por instancia (default 2000).')
+        parser.add_argument('--latency-ms', type=float, default=50.0, help='Latencia por petición (default 50).')
+        parser.add_argument(
+            '--slow-latency-ms',
+            type=float,
+            default=500.0,
+            help='Latencia de la última instancia, la "lenta" (default 500).',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=4,
+            help='verification_concurrency de cada instancia en la corrida paralela (default 4).',
+        )
+        parser.add_argument(
+            '--error-rate',
+            type=float,
+            default=0.0,
+            help='Proporción de peticiones que el Dolibarr simulado responde con 500 (default 0).',
+        )
+
+    def handle(self, *args, **options):
+        if min(options['instances'], options['invoices'], options['concurrency']) <= 0:
+            raise CommandError("--instances, --invoices y --concurrency deben ser positivos.")
+        if not 0 <= options['error_rate'] <= 1:
+            raise CommandError("--error-rate debe estar entre 0 y 1.")
+
+        with ExitStack() as stack:
+            instances = []
+            for n in range(options['instances']):
+                slow = n == options['instances'] - 1 and options['instances'] > 1
+                latency = (options['slow_latency_ms'] if slow else options['latency_ms']) / 1000
+                simulator = stack.enter_context(DolibarrSimulator(
+                    latency=latency, error_rate=options['error_rate'], paid_ratio=0.75, seed=n,
+                ))
+                instance = DolibarrInstance(
+                    id=-(n + 1),  # never collides with the cache keys of real instances
+                    name=f"bench-{n}",
+                    slug=f"bench-{n}",
+                    outbound_api_url=simulator.url,
+                    outbound_api_key="bench",
+                )
+                instances.append((instance, simulator))
+            self._run(instances, options)
+
+    def _run(self, instances, options):
+        facture_ids = list(range(1, options['invoices'] + 1))
+        self.stdout.write(
+            f"{options['instances']} instancias × {options['invoices']} facturas · lotes de "
+            f"{dolibarr_client._BATCH_SIZE} · latencia {options['latency_ms']} ms "
+            f"(lenta {options['slow_latency_ms']} ms)"
+        )
+
+        self._reset(instances, 1)
+        started = time.perf_counter()
+        for instance, _ in instances:
+            dolibarr_client.invoice_statuses(instance, facture_ids)
+        serial = time.perf_counter() - started
+        self._report("Serie", serial, instances)
+
+        self._reset(instances, options['concurrency'])
+        started = time.perf_counter()
+        # The same fan-out as a payment refresh job, without storing rows.
+        answers = dolibarr_client._map_bounded(
+            lambda instance: dolibarr_client.invoice_statuses(instance, facture_ids),
+            [instance for instance, _ in instances],
+            len(instances),
+            "bench",
+        )
+        parallel = time.perf_counter() - started
+        self._report(f"Paralelo (concurrency {options['concurrency']})", parallel, instances)
+
+        unknown = sum(1 for statuses in answers for status in statuses.values() if status is None)
+        if unknown:
+            self.stdout.write(self.style.WARNING(f"{unknown} facturas sin verificar."))
+        self.stdout.write(self.style.SUCCESS(f"Aceleración: {serial / parallel:.1f}x"))
+
+    def _reset(self, instances, concurrency):
+        for instance, simulator in instances:
+            instance.verification_concurrency = concurrency
+            simulator.requests = simulator.errors = 0
+            # A breaker opened by simulated errors in the previous run would skew this one.
+            breaker.record_success(instance)
+
+    def _report(self, label, elapsed, instances):
+        calls = sum(simulator.requests for _, simulator in instances)
+        errors = sum(simulator.errors for _, simulator in instances)
+        self.stdout.write(f"{label}: {elapsed:.2f} s · {calls} peticiones · {errors} errores")
@@ -0,0 +1,110 @@
+"""Mide la latencia del webhook Dolibarr según cuántos boletos genera una
+factura, comparando la inserción fila por fila (antes) con bulk_create en
+lotes (ahora).
+
+Corre contra una base de datos de prueba descartable del mismo motor que
+settings.DATABASES; no toca datos reales.
+
+Uso:
+    python manage.py bench_ticket_insert
+    python manage.py bench_ticket_insert --sizes 1,10,100,1000 --iterations 30
+    python manage.py bench_ticket_insert --strategy bulk
+"""
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+
+from raffles import webhook
+from raffles.benchmarks import bench_database, latency_summary
+from raffles.models import DolibarrInstance, Raffle, Ticket
+
+STRATEGIES = ('rowwise', 'bulk')
+
+
+def _rowwise_insert_tickets(tickets):
+    """Pre-bulk implementation: one INSERT per ticket."""
+    for ticket in tickets:
+        ticket.save(force_insert=True)
+
+
+class Command(BaseCommand):
+    help = "Benchmark p50/p99 del webhook Dolibarr para 1, 10, 100 y 1000 boletos por factura."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            default='1,10,100,1000',
+            help='Boletos por factura, separados por coma (default 1,10,100,1000).',
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=20,
+            help='Facturas enviadas por cada tamaño (default 20).',
+        )
+        parser.add_argument(
+            '--strategy',
+            choices=STRATEGIES + ('both',),
+            default='both',
+            help='rowwise = antes (create por boleto), bulk = ahora (bulk_create). Default: ambas.',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(s) for s in options['sizes'].split(',') if s.strip()]
+        except ValueError:
+            raise CommandError("--sizes debe ser una lista de enteros separados por coma.")
+        iterations = options['iterations']
+        if iterations <= 0 or not sizes or min(sizes) <= 0:
+            raise CommandError("--sizes e --iterations deben ser positivos.")
+        strategies = STRATEGIES if options['strategy'] == 'both' else (options['strategy'],)
+
+        with bench_database() as conn:
+            self.stdout.write(f"Motor: {conn.vendor} · {iterations} facturas por tamaño")
+            self.stdout.write(f"{'estrategia':<10} {'boletos':>8} {'p50 ms':>10} {'p99 ms':>10} {'media ms':>10}")
+            for strategy in strategies:
+                for size in sizes:
+                    stats = self._run(strategy, size, iterations)
+                    self.stdout.write(
+                        f"{strategy:<10} {size:>8} {stats['p50']:>10} {stats['p99']:>10} {stats['mean']:>10}"
+                    )
+
+    def _run(self, strategy, size, iterations):
+        Raffle.objects.all().delete()
+        raffle = Raffle.objects.create(name=f"Bench {strategy} {size}", year=2024, is_active=True)
+        key = f"bench-{uuid.uuid4().hex}"
+        DolibarrInstance.objects.create(
+            name=key, slug=key, inbound_api_key=key, tickets_per_amount=1, amount_step=1,
+        )
+
+        client = Client()
+        url = reverse('raffles:dolibarr_webhook')
+        original_insert = webhook.insert_tickets
+        if strategy == 'rowwise':
+            webhook.insert_tickets = _rowwise_insert_tickets
+        samples = []
+        try:
+            for i in range(iterations):
+                payload = {
+                    'customer_identification': f"bench-{i % 50}",
+                    'customer_name': 'Bench',
+                    'total_amount': size,
+                    'ref': f"{key}-{i}",
+                    'facture_id': i + 1,
+                }
+                started = time.perf_counter()
+                response = client.post(
+                    url, payload, content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {key}',
+                )
+                samples.append((time.perf_counter() - started) * 1000)
+                if response.status_code != 201:
+                    raise CommandError(f"Respuesta inesperada {response.status_code}: {response.content[:200]!r}")
+        finally:
+            webhook.insert_tickets = original_insert
+
+        if Ticket.objects.filter(raffle=raffle).count() != size * iterations:
+            raise CommandError("El webhook no creó la cantidad esperada de boletos.")
+        return latency_summary(samples)
@@ -0,0 +1,260 @@
+"""Prueba de carga concurrente del webhook Dolibarr.
+
+Dispara POSTs concurrentes (hilos) con facturas de varias instancias y una
+proporción de reintentos duplicados, y reporta:
+
+- throughput (facturas/s) y percentiles de latencia,
+- espera por el lock del contador (etapa ``lock`` del header Server-Timing),
+- cantidad de respuestas por código (201, 409, 5xx, errores de conexión),
+- números de boleto duplicados o huecos en la numeración.
+
+Dos modos:
+
+- En proceso (por defecto): crea una base de prueba descartable del mismo
+  motor que settings.DATABASES (SQLite o PostgreSQL local), sus instancias y
+  una rifa activa, y llama a la vista con el cliente de pruebas de Django.
+  Cada hilo usa su propia conexión, así que los locks son reales. Además
+  verifica la numeración contra la tabla de Tickets.
+- Contra un servidor (--url): envía por HTTP a un gunicorn/uvicorn ya
+  levantado, con las API keys de instancias existentes (--key, repetible).
+  La numeración se verifica con los ticket_ranges de las respuestas.
+
+Uso:
+    python manage.py bench_webhook
+    python manage.py bench_webhook --concurrency 16 --requests 2000 --instances 3 --duplicates 0.2
+    python manage.py bench_webhook --url http://127.0.0.1:8000/raffles/api/dolibarr/webhook/ --key KEY1 --key KEY2
+"""
+import random
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+
+from raffles.benchmarks import bench_database, latency_summary, number_anomalies, parse_server_timing
+from raffles.models import DolibarrInstance, Raffle, Ticket
+from raffles.ticket_numbers import from_ranges
+
+
+class Command(BaseCommand):
+    help = "Prueba de carga concurrente del webhook Dolibarr (en proceso o contra un servidor)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=8, help='Clientes simultáneos (default 8).')
+        parser.add_argument('--requests', type=int, default=500, help='Total de POSTs (default 500).')
+        parser.add_argument(
+            '--instances',
+            type=int,
+            default=3,
+            help='Instancias Dolibarr simuladas en modo en proceso (default 3).',
+        )
+        parser.add_argument(
+            '--duplicates',
+            type=float,
+            default=0.1,
+            help='Proporción de POSTs que reenvían una factura ya enviada (default 0.1).',
+        )
+        parser.add_argument(
+            '--tickets',
+            type=int,
+            default=3,
+            help='Boletos por factura (default 3).',
+        )
+        parser.add_argument('--seed', type=int, default=0, help='Semilla para la mezcla de facturas (default 0).')
+        parser.add_argument('--url', default='', help='URL del webhook de un servidor ya levantado.')
+        parser.add_argument(
+            '--key',
+            action='append',
+            default=[],
+            help='API key entrante de una instancia existente (con --url; repetible).',
+        )
+        parser.add_argument(
+            '--amount-step',
+            type=float,
+            default=1.0,
+            help='amount_step de las instancias (con --url, el configurado en el servidor; default 1).',
+        )
+        parser.add_argument('--timeout', type=float, default=30.0, help='Timeout por POST en segundos (default 30).')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] <= 0 or options['requests'] <= 0 or options['tickets'] <= 0:
+            raise CommandError("--concurrency, --requests y --tickets deben ser positivos.")
+        if not 0 <= options['duplicates'] < 1:
+            raise CommandError("--duplicates debe estar entre 0 y 1.")
+
+        if options['url']:
+            if not options['key']:
+                raise CommandError("Con --url hay que indicar al menos una --key.")
+            self._report(self._run(options, options['key'], self._http_sender(options)), None, options)
+            return
+
+        if options['instances'] <= 0:
+            raise CommandError("--instances debe ser positivo.")
+        with bench_database() as conn:
+            raffle = Raffle.objects.create(name="Bench webhook", year=2024, is_active=True)
+            keys = []
+            for n in range(options['instances']):
+                key = f"bench-{n}-{uuid.uuid4().hex[:8]}"
+                DolibarrInstance.objects.create(
+                    name=key, slug=key, inbound_api_key=key,
+                    tickets_per_amount=1, amount_step=options['amount_step'],
+                )
+                keys.append(key)
+            self.stdout.write(f"Motor: {conn.vendor} (en proceso)")
+            results = self._run(options, keys, self._client_sender())
+            db_numbers = list(Ticket.objects.filter(raffle=raffle).values_list('ticket_number', flat=True))
+            self._report(results, db_numbers, options)
+
+    def _workload(self, options, keys):
+        """List of (key, payload): new invoices round-robin over the keys,
+        with --duplicates of them replaced by an earlier invoice."""
+        rng = random.Random(options['seed'])
+        run = uuid.uuid4().hex[:8]
+        amount = options['tickets'] * options['amount_step']
+        sent = []
+        workload = []
+        for i in range(options['requests']):
+            if sent and rng.random() < options['duplicates']:
+                workload.append(rng.choice(sent))
+                continue
+            key = keys[i % len(keys)]
+            payload = {
+                'customer_identification': f"bench-{rng.randrange(200)}",
+                'customer_name': 'Bench',
+                'total_amount': amount,
+                'ref': f"BENCH-{run}-{i}",
+                'facture_id': i + 1,
+            }
+            sent.append((key, payload))
+            workload.append((key, payload))
+        return workload
+
+    def _client_sender(self):
+        url = reverse('raffles:dolibarr_webhook')
+        local = threading.local()
+
+        def send(key, payload):
+            if not hasattr(local, 'client'):
+                local.client = Client()
+            response = local.client.post(
+                url, payload, content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {key}',
+            )
+            return response.status_code, response.get('Server-Timing', ''), response.json()
+
+        def close():
+            connection.close()
+
+        send.close = close
+        return send
+
+    def _http_sender(self, options):
+        local = threading.local()
+
+        def send(key, payload):
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            response = local.session.post(
+                options['url'], json=payload, timeout=options['timeout'],
+                headers={'Authorization': f'Bearer {key}'},
+            )
+            try:
+                body = response.json()
+            except ValueError:
+                body = {}
+            return response.status_code, response.headers.get('Server-Timing', ''), body
+
+        send.close = lambda: None
+        return send
+
+    def _run(self, options, keys, send):
+        workload = self._workload(options, keys)
+        statuses = Counter()
+        latencies = []
+        lock_waits = []
+        numbers_by_raffle = defaultdict(list)
+        lock = threading.Lock()
+
+        def one(job):
+            key, payload = job
+            started = time.perf_counter()
+            try:
+                status, server_timing, body = send(key, payload)
+            except Exception as e:
+                with lock:
+                    statuses[f"error:{type(e).__name__}"] += 1
+                return
+            elapsed = (time.perf_counter() - started) * 1000
+            stages = parse_server_timing(server_timing)
+            with lock:
+                statuses[status] += 1
+                latencies.append(elapsed)
+                if 'lock' in stages:
+                    lock_waits.append(stages['lock'])
+                if status == 201:
+                    numbers_by_raffle[body.get('raffle')].extend(from_ranges(body.get('ticket_ranges', [])))
+
+        def worker(jobs):
+            try:
+                for job in jobs:
+                    one(job)
+            finally:
+                send.close()
+
+        concurrency = options['concurrency']
+        shards = [workload[i::concurrency] for i in range(concurrency)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(worker, shards))
+        elapsed = time.perf_counter() - started
+
+        return {
+            'elapsed': elapsed,
+            'statuses': statuses,
+            'latency': latency_summary(latencies),
+            'lock': latency_summary(lock_waits),
+            'numbers_by_raffle': numbers_by_raffle,
+        }
+
+    def _report(self, results, db_numbers, options):
+        total = sum(results['statuses'].values())
+        self.stdout.write(
+            f"{total} POSTs · {options['concurrency']} clientes · {results['elapsed']:.2f} s · "
+            f"{total / results['elapsed']:.1f} req/s"
+        )
+        self.stdout.write("Respuestas: " + ", ".join(
+            f"{status}={count}" for status, count in sorted(results['statuses'].items(), key=lambda kv: str(kv[0]))
+        ))
+        latency, lock = results['latency'], results['lock']
+        self.stdout.write(
+            f"Latencia ms: p50 {latency['p50']} · p99 {latency['p99']} · media {latency['mean']} · máx {latency['max']}"
+        )
+        self.stdout.write(
+            f"Espera de lock ms: p50 {lock['p50']} · p99 {lock['p99']} · media {lock['mean']} · máx {lock['max']}"
+        )
+
+        problems = False
+        for raffle, numbers in results['numbers_by_raffle'].items():
+            problems |= self._check_numbers(f"respuestas ({raffle})", numbers)
+        if db_numbers is not None:
+            problems |= self._check_numbers("tabla de boletos", db_numbers)
+        errors = sum(count for status, count in results['statuses'].items() if str(status)[0] not in '24')
+        if problems or errors:
+            self.stdout.write(self.style.WARNING(f"Atención: {errors} respuestas con error."))
+        else:
+            self.stdout.write(self.style.SUCCESS("Sin errores, duplicados ni huecos en la numeración."))
+
+    def _check_numbers(self, label, numbers):
+        duplicates, gaps = number_anomalies(numbers)
+        if not duplicates and not gaps:
+            self.stdout.write(f"Numeración {label}: {len(numbers)} boletos, contigua.")
+            return False
+        self.stdout.write(self.style.ERROR(
+            f"Numeración {label}: {len(duplicates)} duplicados {duplicates[:10]}, {len(gaps)} huecos {gaps[:10]}"
+        ))
+        return True
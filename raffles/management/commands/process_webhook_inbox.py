@@ -0,0 +1,106 @@
+"""Procesa la bandeja de entrada de webhooks Dolibarr (WebhookInboxItem).
+
+Las instancias con "Procesar webhooks en segundo plano" activado sólo
+guardan el payload y responden 202; este comando genera los boletos. Se
+pueden correr varios workers en paralelo: cada fila la toma uno solo
+(SKIP LOCKED en PostgreSQL).
+
+Errores transitorios (sin rifa activa, base caída) se reintentan con backoff
+exponencial; después de --max-attempts la fila queda como dead-letter y se
+puede reencolar desde el admin. En modo --loop un error de base de datos
+(conexión caída, deadlock, failover) se registra en el log y el worker
+sigue tras --sleep segundos.
+
+Uso:
+    python manage.py process_webhook_inbox                 # vacía lo pendiente y termina
+    python manage.py process_webhook_inbox --loop          # worker permanente (systemd)
+    python manage.py process_webhook_inbox --batch-size 200 --max-attempts 5
+"""
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from raffles.inbox import (
+    DEFAULT_LEASE_SECONDS,
+    DEFAULT_MAX_ATTEMPTS,
+    claim_batch,
+    process_batch,
+    worker_name,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Genera los boletos de los webhooks Dolibarr encolados en la bandeja de entrada."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=50,
+            help='Filas tomadas por iteración (default 50).',
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='No terminar al vaciar la bandeja: seguir esperando trabajo.',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=2.0,
+            help='Segundos de espera con la bandeja vacía en modo --loop (default 2).',
+        )
+        parser.add_argument(
+            '--max-attempts',
+            type=int,
+            default=DEFAULT_MAX_ATTEMPTS,
+            help=f'Intentos antes de pasar a dead-letter (default {DEFAULT_MAX_ATTEMPTS}).',
+        )
+        parser.add_argument(
+            '--lease',
+            type=int,
+            default=DEFAULT_LEASE_SECONDS,
+            help=f'Segundos tras los cuales una fila "procesando" de un worker caído se vuelve a tomar (default {DEFAULT_LEASE_SECONDS}).',
+        )
+
+    def handle(self, *args, **options):
+        worker = worker_name()
+        totals = {'done': 0, 'retry': 0, 'dead': 0}
+        self.stdout.write(f"Worker {worker} iniciado.")
+
+        try:
+            while True:
+                close_old_connections()
+                try:
+                    rows = claim_batch(worker, options['batch_size'], options['lease'])
+                    counters = process_batch(rows, max_attempts=options['max_attempts']) if rows else None
+                except Exception:
+                    if not options['loop']:
+                        raise
+                    # Claimed rows go back to the queue when their lease expires.
+                    logger.exception("WebhookInbox: Worker %s iteration failed, retrying in %ss", worker, options['sleep'])
+                    close_old_connections()
+                    time.sleep(options['sleep'])
+                    continue
+                if not rows:
+                    if not options['loop']:
+                        break
+                    time.sleep(options['sleep'])
+                    continue
+
+                for key, value in counters.items():
+                    totals[key] += value
+                self.stdout.write(
+                    f"  lote de {len(rows)}: {counters['done']} procesados, "
+                    f"{counters['retry']} a reintentar, {counters['dead']} dead-letter"
+                )
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING("Interrumpido."))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Resultado: {totals['done']} procesados, {totals['retry']} a reintentar, {totals['dead']} dead-letter."
+        ))
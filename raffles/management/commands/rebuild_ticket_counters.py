@@ -0,0 +1,66 @@
+"""Reconstruye los contadores de numeración (RaffleTicketCounter) a partir
+de los Tickets existentes.
+
+El webhook y el admin toman números del contador de cada rifa en vez de
+calcular Max(ticket_number). Si alguien insertó boletos por fuera de esos
+caminos (SQL directo, restauración de un backup, shell), el contador puede
+quedar atrasado y el próximo webhook chocaría contra unique(raffle,
+ticket_number). Este comando deja cada contador en el número más alto
+emitido.
+
+Uso:
+    python manage.py rebuild_ticket_counters --dry-run
+    python manage.py rebuild_ticket_counters               # aplica
+    python manage.py rebuild_ticket_counters --raffle 5    # acotado
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction as db_transaction
+
+from raffles.ticket_numbers import rebuild_ticket_counters
+
+
+class Command(BaseCommand):
+    help = "Recalcula el contador de numeración de boletos de cada rifa desde la tabla de Tickets."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Solo reporta qué se haría, sin escribir.',
+        )
+        parser.add_argument(
+            '--raffle',
+            type=int,
+            default=None,
+            help='Limitar a una rifa específica por ID.',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        raffle_id = options['raffle']
+        raffle_ids = [raffle_id] if raffle_id is not None else None
+
+        with db_transaction.atomic():
+            changes = rebuild_ticket_counters(raffle_ids)
+            if dry_run:
+                db_transaction.set_rollback(True)
+
+        if not changes:
+            self.stdout.write(self.style.WARNING("No hay rifas para procesar."))
+            return
+
+        fixed = 0
+        for raffle, previous, new_last in changes:
+            if previous == new_last:
+                self.stdout.write(f"  = {raffle} → {new_last}")
+                continue
+            fixed += 1
+            before = 'sin contador' if previous is None else previous
+            self.stdout.write(self.style.WARNING(f"  ↻ {raffle}: {before} → {new_last}"))
+
+        self.stdout.write("")
+        self.stdout.write(self.style.SUCCESS(
+            f"Resultado: {fixed}/{len(changes)} contadores corregidos."
+        ))
+        if dry_run:
+            self.stdout.write(self.style.NOTICE("DRY-RUN: nada fue persistido. Quite --dry-run para aplicar."))
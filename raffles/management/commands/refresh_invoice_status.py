@@ -0,0 +1,130 @@
+"""Actualiza el estado de pago guardado de las facturas Dolibarr.
+
+El panel de sorteo y la lista de ganadores leen el estado de pago de la
+tabla InvoicePaymentStatus, sin consultar Dolibarr durante la petición.
+Este comando mantiene esa tabla al día: toma las facturas con boletos en
+las rifas indicadas (por defecto, las activas) que nunca se verificaron o
+cuya última verificación es más vieja que --max-age, y las consulta en
+lotes contra la API REST de cada instancia.
+
+Las facturas ya pagadas casi nunca cambian, así que se re-verifican con
+menos frecuencia (--paid-max-age). Si Dolibarr no responde se anota el
+error y se conserva el último estado conocido. En modo --loop un error
+inesperado (base de datos caída, respuesta inválida) se registra en el log
+y la pasada se repite tras --sleep segundos.
+
+Uso:
+    python manage.py refresh_invoice_status                       # una pasada y termina (cron)
+    python manage.py refresh_invoice_status --loop --sleep 60     # worker permanente (systemd)
+    python manage.py refresh_invoice_status --raffle 3 --max-age 0
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from raffles.dolibarr_client import refresh_invoice_statuses
+from raffles.models import DolibarrInstance
+from raffles.payment_refresh import due_invoices
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Consulta en Dolibarr el estado de pago de las facturas no verificadas o vencidas."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--raffle',
+            type=int,
+            action='append',
+            default=[],
+            help='ID de rifa a verificar (repetible). Por defecto, las rifas activas.',
+        )
+        parser.add_argument(
+            '--max-age',
+            type=int,
+            default=10,
+            help='Minutos tras los cuales se vuelve a verificar una factura impaga o sin respuesta (default 10).',
+        )
+        parser.add_argument(
+            '--paid-max-age',
+            type=int,
+            default=1440,
+            help='Minutos tras los cuales se vuelve a verificar una factura pagada (default 1440).',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Facturas por lote y por instancia (default 500).',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=20000,
+            help='Máximo de facturas por pasada, las más antiguas primero (default 20000).',
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='No terminar: repetir la pasada cada --sleep segundos.',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=60.0,
+            help='Segundos entre pasadas en modo --loop (default 60).',
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] <= 0 or options['limit'] <= 0:
+            raise CommandError("--batch-size y --limit deben ser positivos.")
+
+        try:
+            while True:
+                close_old_connections()
+                try:
+                    self._refresh(options)
+                except Exception:
+                    if not options['loop']:
+                        raise
+                    logger.exception("Payment status refresh pass failed, retrying in %ss", options['sleep'])
+                    close_old_connections()
+                if not options['loop']:
+                    break
+                time.sleep(options['sleep'])
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING("Interrumpido."))
+
+    def _refresh(self, options):
+        by_instance = due_invoices(
+            options['raffle'],
+            max_age=timedelta(minutes=options['max_age']),
+            paid_max_age=timedelta(minutes=options['paid_max_age']),
+            limit=options['limit'],
+        )
+        if not by_instance:
+            self.stdout.write("Sin facturas por verificar.")
+            return
+
+        totals = {'paid': 0, 'unpaid': 0, 'unknown': 0}
+        for instance in DolibarrInstance.objects.filter(id__in=by_instance).order_by('name'):
+            facture_ids = by_instance[instance.id]
+            counts = {'paid': 0, 'unpaid': 0, 'unknown': 0}
+            for start in range(0, len(facture_ids), options['batch_size']):
+                statuses = refresh_invoice_statuses(instance, facture_ids[start:start + options['batch_size']])
+                for paid in statuses.values():
+                    counts['unknown' if paid is None else 'paid' if paid else 'unpaid'] += 1
+            self.stdout.write(
+                f"  {instance.slug}: {len(facture_ids)} facturas, {counts['paid']} pagadas, "
+                f"{counts['unpaid']} impagas, {counts['unknown']} sin respuesta"
+            )
+            for key, value in counts.items():
+                totals[key] += value
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Resultado: {totals['paid']} pagadas, {totals['unpaid']} impagas, {totals['unknown']} sin respuesta."
+        ))
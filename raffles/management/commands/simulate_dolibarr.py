@@ -0,0 +1,81 @@
+"""Levanta una API REST de Dolibarr simulada (endpoint /invoices).
+
+Sirve para probar el panel de sorteo, refresh_invoice_status o los
+benchmarks sin un ERP real: apunte la "URL API saliente" de una instancia
+Dolibarr a la URL que imprime el comando. Responde GET /invoices/{id} y
+GET /invoices?sqlfilters=(t.rowid:in:...) con latencia, tasa de errores y
+proporción de facturas pagadas configurables. Ver raffles/dolibarr_simulator.py.
+
+Uso:
+    python manage.py simulate_dolibarr
+    python manage.py simulate_dolibarr --port 8090 --latency-ms 80 --error-rate 0.05 --paid-ratio 0.7
+    python manage.py simulate_dolibarr --invoices 5000 --api-key DOLAPIKEY-X --paid 12 --unpaid 13
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from raffles.dolibarr_simulator import DolibarrSimulator
+
+
+class Command(BaseCommand):
+    help = "Levanta una API REST de Dolibarr simulada para pruebas y benchmarks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Dirección de escucha (default 127.0.0.1).')
+        parser.add_argument('--port', type=int, default=8090, help='Puerto (default 8090).')
+        parser.add_argument('--latency-ms', type=float, default=50.0, help='Latencia por petición (default 50).')
+        parser.add_argument(
+            '--error-rate',
+            type=float,
+            default=0.0,
+            help='Proporción de peticiones que fallan con --error-status (default 0).',
+        )
+        parser.add_argument('--error-status', type=int, default=500, help='Código HTTP de los errores (default 500).')
+        parser.add_argument(
+            '--paid-ratio',
+            type=float,
+            default=0.8,
+            help='Proporción de facturas pagadas (default 0.8).',
+        )
+        parser.add_argument(
+            '--invoices',
+            type=int,
+            default=None,
+            help='Solo existen las facturas 1..N (por defecto, cualquier id positivo).',
+        )
+        parser.add_argument('--paid', type=int, action='append', default=[], help='ID de factura pagada (repetible).')
+        parser.add_argument('--unpaid', type=int, action='append', default=[], help='ID de factura impaga (repetible).')
+        parser.add_argument('--api-key', default=None, help='DOLAPIKEY exigida (por defecto, cualquiera).')
+        parser.add_argument('--seed', type=int, default=0, help='Semilla del estado de pago y de los errores.')
+
+    def handle(self, *args, **options):
+        if not 0 <= options['error_rate'] <= 1 or not 0 <= options['paid_ratio'] <= 1:
+            raise CommandError("--error-rate y --paid-ratio deben estar entre 0 y 1.")
+        if options['latency_ms'] < 0:
+            raise CommandError("--latency-ms no puede ser negativo.")
+
+        statuses = dict.fromkeys(options['paid'], True)
+        statuses.update(dict.fromkeys(options['unpaid'], False))
+        try:
+            simulator = DolibarrSimulator(
+                host=options['host'],
+                port=options['port'],
+                latency=options['latency_ms'] / 1000,
+                error_rate=options['error_rate'],
+                error_status=options['error_status'],
+                paid_ratio=options['paid_ratio'],
+                invoices=options['invoices'],
+                statuses=statuses,
+                api_key=options['api_key'],
+                seed=options['seed'],
+            )
+        except OSError as exc:
+            raise CommandError(f"No se pudo abrir {options['host']}:{options['port']}: {exc}")
+
+        self.stdout.write(self.style.SUCCESS(f"Dolibarr simulado en {simulator.url}"))
+        self.stdout.write("Use esa URL como URL API saliente de la instancia · Ctrl+C para terminar.")
+        try:
+            simulator.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stdout.write(f"{simulator.requests} peticiones, {simulator.errors} errores simulados.")
@@ -0,0 +1,56 @@
+"""Muestra los contadores operativos del webhook Dolibarr (raffles.metrics).
+
+Los contadores viven en el cache de Django, compartido por todos los workers.
+Cada worker acumula sus cuentas en memoria y las suma al cache cada
+RAFFLES_METRICS_FLUSH_SECONDS, así que lo más reciente puede tardar ese
+tiempo en aparecer aquí.
+
+También lista, por instancia, los webhooks admitidos y los rechazados con 429
+por el límite de ráfaga (raffles.ratelimit).
+
+Uso:
+    python manage.py webhook_metrics
+    python manage.py webhook_metrics --reset
+"""
+from django.core.management.base import BaseCommand
+
+from raffles import metrics, ratelimit
+from raffles.models import DolibarrInstance
+
+
+class Command(BaseCommand):
+    help = "Muestra (y opcionalmente reinicia) los contadores del webhook Dolibarr."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help='Poner los contadores en cero después de mostrarlos.',
+        )
+
+    def handle(self, *args, **options):
+        values = metrics.read()
+        width = max(len(name) for name in values)
+        for name, value in values.items():
+            self.stdout.write(f"  {name:<{width}} {value:>10}")
+
+        upserts = sum(values[name] for name in (
+            metrics.CUSTOMER_CREATED, metrics.CUSTOMER_UPDATED, metrics.CUSTOMER_NOOP,
+        ))
+        if upserts:
+            ratio = values[metrics.CUSTOMER_NOOP] * 100 / upserts
+            self.stdout.write(f"Upserts de clientes sin escritura: {ratio:.1f}%")
+
+        slugs = list(DolibarrInstance.objects.order_by('name').values_list('slug', flat=True))
+        rate_limits = ratelimit.read_counters(slugs)
+        if slugs:
+            self.stdout.write("Límite por instancia (admitidos / rechazados 429):")
+            for slug, counts in rate_limits.items():
+                self.stdout.write(f"  {slug:<{width}} {counts['admitted']:>10} / {counts['throttled']}")
+
+        if options['reset']:
+            metrics.reset()
+            metrics.reset([
+                ratelimit.counter_name(slug, outcome) for slug in slugs for outcome in ('admitted', 'throttled')
+            ])
+            self.stdout.write(self.style.SUCCESS("Contadores reiniciados."))
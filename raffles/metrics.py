@@ -0,0 +1,146 @@
+"""Operational counters for the webhook, kept in Django's cache.
+
+``incr`` only adds to a per-process buffer, so counting never costs a webhook
+a cache round trip (under the database cache that would be a write and a row
+lock on every request). A daemon thread, started by the first ``incr`` of
+each process, adds the buffered deltas to ``raffles:metric:<name>`` every
+``RAFFLES_METRICS_FLUSH_SECONDS`` (default 10); ``read`` flushes the calling
+process first. ``BaseCache.incr`` is a get followed by a set on most
+backends, so a flush holds a short ``cache.add`` lock and concurrent workers
+do not lose each other's counts; while another worker holds it the deltas
+stay buffered for the next round.
+
+Counters are meant for spotting trends ("how many upserts were no-ops since
+the last reset"), not for accounting: a cache restart resets them and a
+worker killed between flushes loses its buffer.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+_PREFIX = 'raffles:metric:'
+_LOCK_KEY = 'raffles:metric:lock'
+_LOCK_ATTEMPTS = 50
+_LOCK_SLEEP = 0.002
+
+CUSTOMER_CREATED = 'webhook.customer.created'
+CUSTOMER_UPDATED = 'webhook.customer.updated'
+CUSTOMER_NOOP = 'webhook.customer.noop'
+
+COUNTERS = (
+    CUSTOMER_CREATED,
+    CUSTOMER_UPDATED,
+    CUSTOMER_NOOP,
+)
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_pending = {}
+_flusher_pid = None
+
+
+def incr(name, delta=1):
+    incr_many({name: delta})
+
+
+def incr_many(counts):
+    """Increment several counters, e.g. from a ``collections.Counter``."""
+    with _lock:
+        for name, delta in counts.items():
+            if delta:
+                _pending[name] = _pending.get(name, 0) + delta
+    _start_flusher()
+
+
+def flush():
+    """Add this process's buffered deltas to the shared counters. Returns
+    False, keeping them buffered, when another process holds the flush lock."""
+    global _pending
+    # Serialized within the process too, so ``read`` sees a flush the
+    # thread has already started.
+    with _flush_lock:
+        with _lock:
+            pending, _pending = _pending, {}
+        if not pending:
+            return True
+        try:
+            if not _take_lock():
+                return False
+            try:
+                for name in list(pending):
+                    key = _PREFIX + name
+                    try:
+                        cache.incr(key, pending[name])
+                    except ValueError:
+                        cache.set(key, pending[name], None)
+                    del pending[name]
+            finally:
+                cache.delete(_LOCK_KEY)
+        finally:
+            _restore(pending)
+        return True
+
+
+def read(names=COUNTERS):
+    flush()
+    values = cache.get_many([_PREFIX + name for name in names])
+    return {name: values.get(_PREFIX + name, 0) for name in names}
+
+
+def reset(names=COUNTERS):
+    with _lock:
+        for name in names:
+            _pending.pop(name, None)
+    cache.delete_many([_PREFIX + name for name in names])
+
+
+def _take_lock():
+    for _ in range(_LOCK_ATTEMPTS):
+        if cache.add(_LOCK_KEY, 1, 5):
+            return True
+        time.sleep(_LOCK_SLEEP)
+    return False
+
+
+def _restore(pending):
+    if not pending:
+        return
+    with _lock:
+        for name, delta in pending.items():
+            _pending[name] = _pending.get(name, 0) + delta
+
+
+def _start_flusher():
+    # One thread per process; a forked gunicorn worker starts its own.
+    global _flusher_pid
+    pid = os.getpid()
+    if _flusher_pid == pid:
+        return
+    with _lock:
+        if _flusher_pid == pid:
+            return
+        _flusher_pid = pid
+    threading.Thread(target=_flush_forever, name='raffles-metrics', daemon=True).start()
+    atexit.register(_flush_quietly)
+
+
+def _flush_forever():
+    while True:
+        time.sleep(getattr(settings, 'RAFFLES_METRICS_FLUSH_SECONDS', 10))
+        _flush_quietly()
+        close_old_connections()
+
+
+def _flush_quietly():
+    try:
+        flush()
+    except Exception as e:
+        logger.warning("Metrics: Flush failed, keeping the counts for the next one - %s", e)
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.11 on 2026-10-18 16:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def seed_counters(apps, schema_editor):
+    """Start every raffle's counter at its current highest ticket number."""
+    Raffle = apps.get_model('raffles', 'Raffle')
+    Ticket = apps.get_model('raffles', 'Ticket')
+    RaffleTicketCounter = apps.get_model('raffles', 'RaffleTicketCounter')
+
+    max_by_raffle = dict(
+        Ticket.objects.values_list('raffle_id').annotate(max_number=Max('ticket_number'))
+    )
+    RaffleTicketCounter.objects.bulk_create([
+        RaffleTicketCounter(raffle_id=raffle_id, last_number=max_by_raffle.get(raffle_id) or 0)
+        for raffle_id in Raffle.objects.values_list('id', flat=True)
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raffles', '0013_multi_instance_and_draw'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RaffleTicketCounter',
+            fields=[
+                ('raffle', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='ticket_counter', serialize=False, to='raffles.raffle', verbose_name='Rifa')),
+                ('last_number', models.PositiveIntegerField(default=0, verbose_name='Último Número Emitido')),
+            ],
+            options={
+                'verbose_name': 'Contador de Boletos',
+                'verbose_name_plural': 'Contadores de Boletos',
+            },
+        ),
+        migrations.RunPython(seed_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.11 on 2026-10-18 16:32
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raffles', '0014_raffle_ticket_counter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dolibarrinstance',
+            name='use_inbox',
+            field=models.BooleanField(default=False, help_text='Guarda cada factura en la bandeja de entrada y responde 202 al instante; el comando process_webhook_inbox genera los boletos.', verbose_name='Procesar webhooks en segundo plano'),
+        ),
+        migrations.CreateModel(
+            name='WebhookInboxItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.TextField(verbose_name='Payload recibido')),
+                ('status', models.CharField(choices=[('pending', 'Pendiente'), ('processing', 'Procesando'), ('done', 'Procesado'), ('dead', 'Fallido (dead-letter)')], default='pending', max_length=16, verbose_name='Estado')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Intentos')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Próximo intento')),
+                ('claimed_by', models.CharField(blank=True, max_length=100, verbose_name='Tomado por')),
+                ('claimed_at', models.DateTimeField(blank=True, null=True, verbose_name='Tomado el')),
+                ('result_status', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Código de resultado')),
+                ('result', models.JSONField(blank=True, null=True, verbose_name='Resultado')),
+                ('last_error', models.TextField(blank=True, verbose_name='Último error')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Recibido el')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='Procesado el')),
+                ('instance', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='inbox_items', to='raffles.dolibarrinstance', verbose_name='Instancia Dolibarr')),
+            ],
+            options={
+                'verbose_name': 'Webhook en Bandeja de Entrada',
+                'verbose_name_plural': 'Bandeja de Entrada de Webhooks',
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='inbox_status_next_idx')],
+            },
+        ),
+    ]
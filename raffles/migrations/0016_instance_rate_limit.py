@@ -0,0 +1,23 @@
+# Generated by Django 5.2.11 on 2026-10-18 16:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raffles', '0015_webhook_inbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dolibarrinstance',
+            name='rate_limit_burst',
+            field=models.PositiveIntegerField(default=0, help_text='Capacidad del token bucket: facturas que se aceptan seguidas antes de limitar. 0 = sin límite.', verbose_name='Ráfaga máxima de webhooks'),
+        ),
+        migrations.AddField(
+            model_name='dolibarrinstance',
+            name='rate_limit_per_minute',
+            field=models.PositiveIntegerField(default=60, help_text='Ritmo al que se recargan los tokens. Pasado el límite se responde 429 con Retry-After.', verbose_name='Webhooks por minuto'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.11 on 2026-10-18 16:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raffles', '0016_instance_rate_limit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dolibarrinstance',
+            name='verification_concurrency',
+            field=models.PositiveSmallIntegerField(default=4, help_text='Peticiones en paralelo a la API REST de esta Dolibarr al verificar pagos (lotes de 100 facturas). Use 1 para un servidor pequeño.', verbose_name='Consultas de pago simultáneas'),
+        ),
+    ]
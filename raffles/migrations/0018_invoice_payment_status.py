@@ -0,0 +1,43 @@
+# Generated by Django 5.2.11 on 2026-10-18 16:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raffles', '0017_instance_verification_concurrency'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoicePaymentStatus',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facture_id', models.PositiveIntegerField(verbose_name='ID Factura Dolibarr')),
+                ('is_paid', models.BooleanField(blank=True, help_text='Vacío mientras Dolibarr no haya respondido por esta factura.', null=True, verbose_name='Pagada')),
+                ('checked_at', models.DateTimeField(blank=True, null=True, verbose_name='Verificada el')),
+                ('attempted_at', models.DateTimeField(blank=True, null=True, verbose_name='Último intento')),
+                ('last_error', models.TextField(blank=True, verbose_name='Último error')),
+                ('instance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_statuses', to='raffles.dolibarrinstance', verbose_name='Instancia Dolibarr')),
+            ],
+            options={
+                'verbose_name': 'Estado de Pago de Factura',
+                'verbose_name_plural': 'Estados de Pago de Facturas',
+            },
+        ),
+        migrations.AddField(
+            model_name='dolibarrtransaction',
+            name='payment_status',
+            field=models.ForeignObject(from_fields=['instance', 'facture_id'], null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='raffles.invoicepaymentstatus', to_fields=['instance', 'facture_id']),
+        ),
+        migrations.AddIndex(
+            model_name='invoicepaymentstatus',
+            index=models.Index(fields=['checked_at'], name='payment_status_checked_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='invoicepaymentstatus',
+            constraint=models.UniqueConstraint(fields=('instance', 'facture_id'), name='uniq_payment_status_invoice'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.11 on 2026-10-18 17:22
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raffles', '0018_invoice_payment_status'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DrawPoolSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('exclude_unpaid', models.BooleanField(default=True, verbose_name='Excluye impagos')),
+                ('ticket_count', models.PositiveIntegerField(verbose_name='Boletos')),
+                ('id_width', models.PositiveSmallIntegerField(verbose_name='Bytes por ID')),
+                ('ticket_ids', models.BinaryField(verbose_name='IDs de boletos')),
+                ('sha256', models.CharField(max_length=64, verbose_name='SHA-256')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Congelado el')),
+                ('released_at', models.DateTimeField(blank=True, null=True, verbose_name='Liberado el')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='Congelado por')),
+                ('raffle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pool_snapshots', to='raffles.raffle', verbose_name='Rifa')),
+            ],
+            options={
+                'verbose_name': 'Pool Congelado',
+                'verbose_name_plural': 'Pools Congelados',
+                'ordering': ['-created_at'],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('released_at__isnull', True)), fields=('raffle',), name='uniq_active_pool_snapshot')],
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.11 on 2026-10-18 17:51
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raffles', '0019_draw_pool_snapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentRefreshJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('running', 'En curso'), ('done', 'Terminado'), ('failed', 'Fallido')], default='running', max_length=10, verbose_name='Estado')),
+                ('force', models.BooleanField(default=False, verbose_name='Forzado')),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='Facturas')),
+                ('checked', models.PositiveIntegerField(default=0, verbose_name='Verificadas')),
+                ('instances', models.JSONField(default=dict, verbose_name='Avance por instancia')),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Iniciado el')),
+                ('heartbeat_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Última señal')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Terminado el')),
+                ('raffle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_refresh_jobs', to='raffles.raffle', verbose_name='Rifa')),
+            ],
+            options={
+                'verbose_name': 'Refresco de Pagos',
+                'verbose_name_plural': 'Refrescos de Pagos',
+                'constraints': [models.UniqueConstraint(condition=models.Q(('state', 'running')), fields=('raffle',), name='uniq_running_payment_refresh')],
+            },
+        ),
+    ]
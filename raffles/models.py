@@ -142,6 +142,25 @@ class Ticket(models.Model):
         unique_together = ('raffle', 'ticket_number')
 
 
+class RaffleTicketCounter(models.Model):
+    """Last ticket number handed out for a raffle. Maintained by raffles.ticket_numbers."""
+    raffle = models.OneToOneField(
+        Raffle,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='ticket_counter',
+        verbose_name="Rifa",
+    )
+    last_number = models.PositiveIntegerField(default=0, verbose_name="Último Número Emitido")
+
+    def __str__(self):
+        return f"{self.raffle} → {self.last_number}"
+
+    class Meta:
+        verbose_name = "Contador de Boletos"
+        verbose_name_plural = "Contadores de Boletos"
+
+
 class SiteSettings(models.Model):
     """Modelo para la configuración del sitio."""
     favicon = models.ImageField(upload_to='favicons/', blank=True, null=True, verbose_name="Favicon")
@@ -192,10 +211,32 @@ class DolibarrInstance(models.Model):
         verbose_name="DOLAPIKEY (saliente)",
         help_text="Token del usuario API para consultar facturas (lectura de invoices).",
     )
+    verification_concurrency = models.PositiveSmallIntegerField(
+        default=4,
+        verbose_name="Consultas de pago simultáneas",
+        help_text="Peticiones en paralelo a la API REST de esta Dolibarr al verificar pagos "
+                  "(lotes de 100 facturas). Use 1 para un servidor pequeño.",
+    )
     tickets_per_amount = models.PositiveIntegerField(default=1, verbose_name="Boletos por Monto")
     amount_step = models.DecimalField(max_digits=10, decimal_places=2, default=100.00, verbose_name="Monto Base ($)")
     default_ticket_price = models.DecimalField(max_digits=10, decimal_places=2, default=0.00, verbose_name="Precio del Boleto (Registro)")
     is_active = models.BooleanField(default=True, verbose_name="Activa")
+    use_inbox = models.BooleanField(
+        default=False,
+        verbose_name="Procesar webhooks en segundo plano",
+        help_text="Guarda cada factura en la bandeja de entrada y responde 202 al instante; "
+                  "el comando process_webhook_inbox genera los boletos.",
+    )
+    rate_limit_burst = models.PositiveIntegerField(
+        default=0,
+        verbose_name="Ráfaga máxima de webhooks",
+        help_text="Capacidad del token bucket: facturas que se aceptan seguidas antes de limitar. 0 = sin límite.",
+    )
+    rate_limit_per_minute = models.PositiveIntegerField(
+        default=60,
+        verbose_name="Webhooks por minuto",
+        help_text="Ritmo al que se recargan los tokens. Pasado el límite se responde 429 con Retry-After.",
+    )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Fecha de Creación")
 
     def __str__(self):
@@ -222,6 +263,15 @@ class DolibarrTransaction(models.Model):
     amount = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="Monto")
     tickets_count = models.IntegerField(verbose_name="Boletos Generados")
     created_at = models.DateTimeField(auto_now_add=True)
+    # Join to the stored payment status on (instance, facture_id); no column of its own.
+    payment_status = models.ForeignObject(
+        'InvoicePaymentStatus',
+        on_delete=models.DO_NOTHING,
+        from_fields=['instance', 'facture_id'],
+        to_fields=['instance', 'facture_id'],
+        null=True,
+        related_name='+',
+    )
 
     def __str__(self):
         prefix = f"[{self.instance.slug}] " if self.instance_id else ""
@@ -240,6 +290,115 @@ class DolibarrTransaction(models.Model):
         ]
 
 
+class InvoicePaymentStatus(models.Model):
+    """Last known payment status of one Dolibarr invoice, kept up to date by
+    refresh_invoice_status so the draw panel never waits on Dolibarr."""
+    instance = models.ForeignKey(
+        DolibarrInstance,
+        on_delete=models.CASCADE,
+        related_name='payment_statuses',
+        verbose_name="Instancia Dolibarr",
+    )
+    facture_id = models.PositiveIntegerField(verbose_name="ID Factura Dolibarr")
+    is_paid = models.BooleanField(
+        null=True,
+        blank=True,
+        verbose_name="Pagada",
+        help_text="Vacío mientras Dolibarr no haya respondido por esta factura.",
+    )
+    checked_at = models.DateTimeField(null=True, blank=True, verbose_name="Verificada el")
+    attempted_at = models.DateTimeField(null=True, blank=True, verbose_name="Último intento")
+    last_error = models.TextField(blank=True, verbose_name="Último error")
+
+    def __str__(self):
+        return f"[{self.instance.slug}] factura {self.facture_id}"
+
+    class Meta:
+        verbose_name = "Estado de Pago de Factura"
+        verbose_name_plural = "Estados de Pago de Facturas"
+        constraints = [
+            UniqueConstraint(fields=['instance', 'facture_id'], name='uniq_payment_status_invoice'),
+        ]
+        indexes = [
+            models.Index(fields=['checked_at'], name='payment_status_checked_idx'),
+        ]
+
+
+class PaymentRefreshJob(models.Model):
+    """A background refresh of a raffle's invoice payment statuses (see
+    raffles/payment_refresh.py). Kept in the database so every gunicorn
+    worker sees the same job and its progress."""
+    class State(models.TextChoices):
+        RUNNING = 'running', 'En curso'
+        DONE = 'done', 'Terminado'
+        FAILED = 'failed', 'Fallido'
+
+    raffle = models.ForeignKey(
+        Raffle, on_delete=models.CASCADE, related_name='payment_refresh_jobs', verbose_name="Rifa",
+    )
+    state = models.CharField(max_length=10, choices=State.choices, default=State.RUNNING, verbose_name="Estado")
+    force = models.BooleanField(default=False, verbose_name="Forzado")
+    total = models.PositiveIntegerField(default=0, verbose_name="Facturas")
+    checked = models.PositiveIntegerField(default=0, verbose_name="Verificadas")
+    instances = models.JSONField(default=dict, verbose_name="Avance por instancia")
+    started_at = models.DateTimeField(default=timezone.now, verbose_name="Iniciado el")
+    heartbeat_at = models.DateTimeField(default=timezone.now, verbose_name="Última señal")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="Terminado el")
+
+    def __str__(self):
+        return f"{self.raffle_id}: {self.state} {self.checked}/{self.total}"
+
+    class Meta:
+        verbose_name = "Refresco de Pagos"
+        verbose_name_plural = "Refrescos de Pagos"
+        constraints = [
+            # One running job per raffle, whichever worker starts it.
+            UniqueConstraint(
+                fields=['raffle'],
+                condition=Q(state='running'),
+                name='uniq_running_payment_refresh',
+            ),
+        ]
+
+
+class WebhookInboxItem(models.Model):
+    """Raw invoice payload accepted by the webhook and waiting for process_webhook_inbox."""
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'Pendiente'
+        PROCESSING = 'processing', 'Procesando'
+        DONE = 'done', 'Procesado'
+        DEAD = 'dead', 'Fallido (dead-letter)'
+
+    instance = models.ForeignKey(
+        DolibarrInstance,
+        on_delete=models.PROTECT,
+        related_name='inbox_items',
+        verbose_name="Instancia Dolibarr",
+    )
+    payload = models.TextField(verbose_name="Payload recibido")
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING, verbose_name="Estado")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="Intentos")
+    next_attempt_at = models.DateTimeField(default=timezone.now, verbose_name="Próximo intento")
+    claimed_by = models.CharField(max_length=100, blank=True, verbose_name="Tomado por")
+    claimed_at = models.DateTimeField(null=True, blank=True, verbose_name="Tomado el")
+    result_status = models.PositiveSmallIntegerField(null=True, blank=True, verbose_name="Código de resultado")
+    result = models.JSONField(null=True, blank=True, verbose_name="Resultado")
+    last_error = models.TextField(blank=True, verbose_name="Último error")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Recibido el")
+    processed_at = models.DateTimeField(null=True, blank=True, verbose_name="Procesado el")
+
+    def __str__(self):
+        return f"[{self.instance.slug}] #{self.pk} ({self.get_status_display()})"
+
+    class Meta:
+        verbose_name = "Webhook en Bandeja de Entrada"
+        verbose_name_plural = "Bandeja de Entrada de Webhooks"
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='inbox_status_next_idx'),
+        ]
+
+
 class Prize(models.Model):
     """One prize slot inside a Raffle (1°, 2°, 3°...). Holds the current winner."""
     raffle = models.ForeignKey(Raffle, on_delete=models.CASCADE, related_name='prizes', verbose_name="Rifa")
@@ -296,3 +455,44 @@ class WinnerDiscard(models.Model):
         verbose_name = "Descarte de Ganador"
         verbose_name_plural = "Descartes de Ganadores"
         ordering = ['-created_at']
+
+
+class DrawPoolSnapshot(models.Model):
+    """Eligible ticket ids of a raffle frozen for a draw event.
+
+    ``ticket_ids`` is the sorted id set as unsigned little-endian integers of
+    ``id_width`` bytes each; ``sha256`` is the hex digest of exactly those
+    bytes, so it can be published before the draw and checked afterwards.
+    While a snapshot is active (not released) the draws of its raffle pick
+    from it, minus the tickets that have won or been discarded since.
+    """
+    raffle = models.ForeignKey(Raffle, on_delete=models.CASCADE, related_name='pool_snapshots', verbose_name="Rifa")
+    exclude_unpaid = models.BooleanField(default=True, verbose_name="Excluye impagos")
+    ticket_count = models.PositiveIntegerField(verbose_name="Boletos")
+    id_width = models.PositiveSmallIntegerField(verbose_name="Bytes por ID")
+    ticket_ids = models.BinaryField(verbose_name="IDs de boletos")
+    sha256 = models.CharField(max_length=64, verbose_name="SHA-256")
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name="Congelado por",
+    )
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Congelado el")
+    released_at = models.DateTimeField(null=True, blank=True, verbose_name="Liberado el")
+
+    def __str__(self):
+        return f"{self.raffle.name}: {self.ticket_count} boletos ({self.sha256[:12]})"
+
+    class Meta:
+        verbose_name = "Pool Congelado"
+        verbose_name_plural = "Pools Congelados"
+        ordering = ['-created_at']
+        constraints = [
+            UniqueConstraint(
+                fields=['raffle'],
+                condition=Q(released_at__isnull=True),
+                name='uniq_active_pool_snapshot',
+            ),
+        ]
@@ -0,0 +1,290 @@
+"""Background refresh of the stored invoice payment statuses.
+
+The draw panel renders from `InvoicePaymentStatus` whatever its age and says
+how old the oldest answer is (stale-while-revalidate). When part of the pool
+is due for a check the page starts a refresh job for the raffle and follows
+it over server-sent events (`views.payment_refresh_stream`); the
+"refrescar verificación de pagos" button starts a forced job (every invoice
+of the raffle) instead of holding the request until Dolibarr has answered
+for all of them.
+
+A job runs on a daemon thread of the web process that started it. One
+producer thread per instance asks Dolibarr (`invoice_statuses`, so each
+instance's verification_concurrency and circuit breaker apply) and the job
+thread stores the answers. The job itself is a `PaymentRefreshJob` row, so
+every gunicorn worker sees the same one: a partial unique constraint allows
+one running job per raffle, and the job thread writes its progress and a
+heartbeat there at least every ``_HEARTBEAT_SECONDS``. A worker that is
+killed or recycled leaves its job running with a stopped heartbeat; after
+``RAFFLES_PAYMENT_JOB_STALE_SECONDS`` (default 60) `status` reports it as
+failed and `start` replaces it.
+
+Due means never answered, unpaid/unknown and older than
+``RAFFLES_PAYMENT_STALE_SECONDS`` (default 600), or paid and older than
+``RAFFLES_PAYMENT_PAID_STALE_SECONDS`` (default 86400). Page loads do not
+retry an invoice Dolibarr failed to answer within
+``RAFFLES_PAYMENT_RETRY_SECONDS`` (default 60).
+"""
+import logging
+import queue
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Exists, F, Min, OuterRef, Q
+from django.utils import timezone
+
+from .dolibarr_client import invoice_statuses, record_statuses
+from .models import DolibarrInstance, DolibarrTransaction, PaymentRefreshJob, Ticket
+
+logger = logging.getLogger(__name__)
+
+RUNNING = PaymentRefreshJob.State.RUNNING
+DONE = PaymentRefreshJob.State.DONE
+FAILED = PaymentRefreshJob.State.FAILED
+
+_CHUNK = 500  # invoices stored and reported at a time
+_HEARTBEAT_SECONDS = 10
+
+
+def due_invoices(raffle_ids=None, max_age=None, paid_max_age=None, retry_after=None, limit=None):
+    """``{instance_id: [facture_id, ...]}`` of the invoices due for a check
+    among the tickets of ``raffle_ids`` (default: the active raffles),
+    never-checked first, then the oldest check. Ages are timedeltas and
+    default to the settings above; ``retry_after`` skips invoices attempted
+    more recently than that."""
+    now = timezone.now()
+    due = _due_q(
+        now,
+        max_age if max_age is not None else _stale_age(),
+        paid_max_age if paid_max_age is not None else _paid_stale_age(),
+    )
+    if retry_after is not None:
+        due &= Q(payment_status__attempted_at__isnull=True) | Q(payment_status__attempted_at__lt=now - retry_after)
+    transactions = _checkable().filter(due)
+    if raffle_ids:
+        transactions = transactions.filter(tickets__raffle_id__in=raffle_ids)
+    else:
+        transactions = transactions.filter(tickets__raffle__is_active=True)
+    rows = (
+        transactions
+        .order_by(F('payment_status__checked_at').asc(nulls_first=True), 'id')
+        .values_list('instance_id', 'facture_id')
+        .distinct()
+    )
+    if limit is not None:
+        rows = rows[:limit]
+    invoices = defaultdict(list)
+    for instance_id, facture_id in rows:
+        invoices[instance_id].append(facture_id)
+    return dict(invoices)
+
+
+def raffle_freshness(raffle_id):
+    """What the page knows about the raffle's stored statuses, in one
+    aggregate query: ``{'oldest_check', 'stale', 'refresh_due'}``. ``stale``
+    counts invoices due for a check; ``refresh_due`` is whether a page load
+    should start a job (some of them were not attempted in the last retry
+    window)."""
+    now = timezone.now()
+    due = _due_q(now, _stale_age(), _paid_stale_age())
+    retry = Q(payment_status__attempted_at__isnull=True) | Q(payment_status__attempted_at__lt=now - _retry_after())
+    freshness = (
+        _checkable()
+        .filter(Exists(Ticket.objects.filter(raffle_id=raffle_id, dolibarr_transaction=OuterRef('pk'))))
+        .aggregate(
+            oldest_check=Min('payment_status__checked_at'),
+            stale=Count('pk', filter=due),
+            retry=Count('pk', filter=due & retry),
+        )
+    )
+    return {
+        'oldest_check': freshness['oldest_check'],
+        'stale': freshness['stale'],
+        'refresh_due': freshness['retry'] > 0,
+    }
+
+
+def start(raffle_id, force=False):
+    """Start a refresh job for the raffle unless one is running; returns the
+    running or new job as a dict (see `status`)."""
+    current = _latest(raffle_id)
+    if current is not None and current.state == RUNNING:
+        return _as_dict(current)
+    # Only the last job is ever shown.
+    PaymentRefreshJob.objects.filter(raffle_id=raffle_id).exclude(state=RUNNING).delete()
+    try:
+        with transaction.atomic():
+            job = PaymentRefreshJob.objects.create(raffle_id=raffle_id, force=force)
+    except IntegrityError:
+        # Another worker started one in between.
+        return status(raffle_id)
+    _spawn(lambda: _run(job))
+    return _as_dict(job)
+
+
+def status(raffle_id):
+    """The raffle's current or last job, or None: ``{'id', 'state', 'force',
+    'started_at', 'finished_at', 'total', 'checked', 'instances'}`` with
+    ``instances`` as ``{slug: {'total', 'checked', 'paid', 'unpaid',
+    'errors'}}`` and the times as Unix timestamps."""
+    job = _latest(raffle_id)
+    return _as_dict(job) if job is not None else None
+
+
+def _latest(raffle_id):
+    """The raffle's last job; a running one whose heartbeat stopped is marked
+    failed first."""
+    job = PaymentRefreshJob.objects.filter(raffle_id=raffle_id).order_by('-started_at', '-id').first()
+    if job is not None and job.state == RUNNING and job.heartbeat_at < timezone.now() - _job_stale_age():
+        logger.warning("Payment refresh job %s for raffle=%s lost its worker, marking it failed", job.pk, raffle_id)
+        job.state = FAILED
+        job.finished_at = timezone.now()
+        PaymentRefreshJob.objects.filter(pk=job.pk, state=RUNNING).update(state=FAILED, finished_at=job.finished_at)
+    return job
+
+
+def _as_dict(job):
+    return {
+        'id': job.pk,
+        'state': job.state,
+        'force': job.force,
+        'started_at': job.started_at.timestamp(),
+        'finished_at': job.finished_at.timestamp() if job.finished_at else None,
+        'total': job.total,
+        'checked': job.checked,
+        'instances': job.instances,
+    }
+
+
+def _spawn(target):
+    def run():
+        try:
+            target()
+        finally:
+            connection.close()
+
+    threading.Thread(target=run, name='payment-refresh', daemon=True).start()
+
+
+def _run(job):
+    try:
+        if job.force:
+            invoices = due_invoices([job.raffle_id], max_age=timedelta(0), paid_max_age=timedelta(0))
+        else:
+            invoices = due_invoices(
+                [job.raffle_id],
+                retry_after=_retry_after(),
+            )
+        instances = DolibarrInstance.objects.in_bulk(list(invoices))
+        job.total = sum(len(ids) for ids in invoices.values())
+        for instance_id, facture_ids in invoices.items():
+            job.instances[instances[instance_id].slug] = {
+                'total': len(facture_ids), 'checked': 0, 'paid': 0, 'unpaid': 0, 'errors': 0,
+            }
+        _save(job)
+
+        for result in _fetch_all(instances, invoices):
+            if result is not None:
+                instance, statuses, errors = result
+                record_statuses(instance, statuses, errors)
+                progress = job.instances[instance.slug]
+                for paid in statuses.values():
+                    progress['checked'] += 1
+                    progress['paid' if paid else 'unpaid' if paid is False else 'errors'] += 1
+                job.checked += len(statuses)
+            _save(job)  # None: Dolibarr is slow, the heartbeat still goes out
+        job.state = DONE
+    except Exception:
+        logger.exception("Payment refresh job failed for raffle=%s", job.raffle_id)
+        job.state = FAILED
+    finally:
+        job.finished_at = timezone.now()
+        _save(job)
+
+
+def _fetch_all(instances, invoices):
+    """Yield ``(instance, statuses, errors)`` per chunk as each instance's
+    producer thread gets them, or None every ``_HEARTBEAT_SECONDS`` without
+    one; only this generator's thread touches the DB."""
+    results = queue.Queue()
+    chunks = 0
+
+    def produce(instance, facture_ids):
+        for start in range(0, len(facture_ids), _CHUNK):
+            chunk = facture_ids[start:start + _CHUNK]
+            errors = {}
+            try:
+                statuses = invoice_statuses(instance, chunk, errors=errors)
+            except Exception as exc:
+                logger.exception("Payment refresh failed for instance=%s", instance.slug)
+                statuses, errors = dict.fromkeys(chunk), dict.fromkeys(chunk, f'error: {exc}')
+            results.put((instance, statuses, errors))
+
+    for facture_ids in invoices.values():
+        chunks += (len(facture_ids) + _CHUNK - 1) // _CHUNK
+    if not chunks:
+        return
+    with ThreadPoolExecutor(max_workers=len(invoices), thread_name_prefix='payment-refresh') as pool:
+        for instance_id, facture_ids in invoices.items():
+            pool.submit(produce, instances[instance_id], facture_ids)
+        while chunks:
+            try:
+                result = results.get(timeout=_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield None
+                continue
+            chunks -= 1
+            yield result
+
+
+def _save(job):
+    job.heartbeat_at = timezone.now()
+    # A job already marked failed as lost keeps that state.
+    PaymentRefreshJob.objects.filter(pk=job.pk, state=RUNNING).update(
+        state=job.state,
+        total=job.total,
+        checked=job.checked,
+        instances=job.instances,
+        heartbeat_at=job.heartbeat_at,
+        finished_at=job.finished_at,
+    )
+
+
+def _checkable():
+    """Transactions whose invoice can be asked for: an id and an active
+    instance with outbound credentials. One per invoice."""
+    return (
+        DolibarrTransaction.objects
+        .filter(facture_id__isnull=False, instance__is_active=True)
+        .exclude(instance__outbound_api_url='')
+        .exclude(instance__outbound_api_key='')
+    )
+
+
+def _due_q(now, max_age, paid_max_age):
+    return (
+        Q(payment_status__isnull=True)
+        | Q(payment_status__checked_at__isnull=True)
+        | Q(payment_status__is_paid=True, payment_status__checked_at__lt=now - paid_max_age)
+        | (~Q(payment_status__is_paid=True) & Q(payment_status__checked_at__lt=now - max_age))
+    )
+
+
+def _stale_age():
+    return timedelta(seconds=getattr(settings, 'RAFFLES_PAYMENT_STALE_SECONDS', 600))
+
+
+def _paid_stale_age():
+    return timedelta(seconds=getattr(settings, 'RAFFLES_PAYMENT_PAID_STALE_SECONDS', 86400))
+
+
+def _retry_after():
+    return timedelta(seconds=getattr(settings, 'RAFFLES_PAYMENT_RETRY_SECONDS', 60))
+
+
+def _job_stale_age():
+    return timedelta(seconds=getattr(settings, 'RAFFLES_PAYMENT_JOB_STALE_SECONDS', 60))
@@ -0,0 +1,100 @@
+"""Per-instance admission control for the Dolibarr webhook.
+
+Each DolibarrInstance with ``rate_limit_burst > 0`` gets a token bucket of
+that capacity, refilled at ``rate_limit_per_minute``. One invoice costs one
+token; a batch costs one per invoice (capped at the burst, so a full batch is
+still admitted once the bucket is full). Requests over the limit get 429 with
+``Retry-After`` and never reach the raffle's counter lock, so a Dolibarr
+re-validating its whole backlog cannot starve the other instances.
+
+The bucket is stored GCRA-style as one "theoretical arrival time" per
+instance in Django's cache, updated under a short ``cache.add`` lock; the
+cache is shared by all gunicorn workers (see `checks`), so the limit holds
+across them. If the lock cannot be taken quickly the request is admitted:
+the limiter must never be the thing that fails.
+
+Admitted/throttled counts per instance go to ``raffles.metrics``.
+"""
+import logging
+import math
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_STATE_KEY = 'raffles:ratelimit:{}:tat'
+_LOCK_KEY = 'raffles:ratelimit:{}:lock'
+_LOCK_ATTEMPTS = 20
+_LOCK_SLEEP = 0.001
+
+
+def admit(instance, cost=1):
+    """Take ``cost`` tokens from the instance's bucket.
+
+    Returns ``(True, 0)`` when admitted or ``(False, retry_after_seconds)``.
+    Instances without a limit (``rate_limit_burst <= 0``) are always admitted."""
+    burst = instance.rate_limit_burst
+    if burst <= 0:
+        return True, 0
+    cost = max(1, min(cost, burst))
+    interval = 60.0 / max(instance.rate_limit_per_minute, 1)
+
+    lock_key = _LOCK_KEY.format(instance.id)
+    for _ in range(_LOCK_ATTEMPTS):
+        if cache.add(lock_key, 1, 5):
+            break
+        time.sleep(_LOCK_SLEEP)
+    else:
+        logger.warning("DolibarrWebhook: Rate limiter lock busy, admitting - instance=%s", instance.slug)
+        metrics.incr(counter_name(instance.slug, 'admitted'))
+        return True, 0
+
+    try:
+        state_key = _STATE_KEY.format(instance.id)
+        now = time.time()
+        tat = max(cache.get(state_key) or now, now)
+        new_tat = tat + cost * interval
+        excess = new_tat - now - burst * interval
+        if excess > 0:
+            admitted, retry_after = False, max(1, math.ceil(excess))
+        else:
+            # Keep the state a little past the moment the bucket is full again.
+            cache.set(state_key, new_tat, math.ceil(new_tat - now) + 60)
+            admitted, retry_after = True, 0
+    finally:
+        cache.delete(lock_key)
+
+    if admitted:
+        metrics.incr(counter_name(instance.slug, 'admitted'))
+    else:
+        logger.warning(
+            "DolibarrWebhook: Rate limited - instance=%s cost=%s retry_after=%ss",
+            instance.slug, cost, retry_after,
+        )
+        metrics.incr(counter_name(instance.slug, 'throttled'))
+    return admitted, retry_after
+
+
+async def aadmit(instance, cost=1):
+    """``admit`` for async views; unlimited instances skip the thread hop."""
+    if instance.rate_limit_burst <= 0:
+        return True, 0
+    return await sync_to_async(admit)(instance, cost)
+
+
+def counter_name(slug, outcome):
+    return f'ratelimit.{slug}.{outcome}'
+
+
+def read_counters(slugs):
+    """``{slug: {'admitted': n, 'throttled': n}}``."""
+    names = [counter_name(slug, outcome) for slug in slugs for outcome in ('admitted', 'throttled')]
+    values = metrics.read(names)
+    return {
+        slug: {outcome: values[counter_name(slug, outcome)] for outcome in ('admitted', 'throttled')}
+        for slug in slugs
+    }
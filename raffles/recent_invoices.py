@@ -0,0 +1,108 @@
+"""Per-instance memory of invoices this process recently saw processed.
+
+The Dolibarr module retries a webhook whenever it does not get a clean answer
+in time, so most duplicates are exact repeats arriving seconds apart. Before
+``webhook.mark_duplicates`` queries DolibarrTransaction it asks this filter;
+a hit is answered with the same 409 body without touching the database.
+
+Only facts that are already committed are remembered (a transaction found in
+the database, or one recorded by a webhook whose transaction committed), so a
+hit is never a false duplicate. Entries expire after
+``RAFFLES_RECENT_INVOICES_TTL`` seconds (default 600) and each instance keeps
+at most ``RAFFLES_RECENT_INVOICES_PER_INSTANCE`` refs/facture_ids (default
+5000, least recently used evicted first).
+
+Deleting a DolibarrTransaction (to let Dolibarr resend an invoice), or saving
+or deleting a DolibarrInstance, clears the filter and bumps the
+``resolver`` generation number, so the other workers clear theirs once their
+webhooks see the new number (within ``RAFFLES_CONFIG_GENERATION_SECONDS``).
+The cache must be shared between processes for that (see `checks`);
+otherwise a resent invoice would get a false 409 from a worker that still
+remembers it.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+from . import resolver
+from .models import DolibarrInstance, DolibarrTransaction
+
+
+class RecentInvoices:
+    """LRU of ``(ref, tickets_count)`` keyed by ref and by facture_id, per instance."""
+
+    def __init__(self, capacity=None, ttl=None):
+        self.capacity = capacity if capacity is not None else getattr(
+            settings, 'RAFFLES_RECENT_INVOICES_PER_INSTANCE', 5000)
+        self.ttl = ttl if ttl is not None else getattr(settings, 'RAFFLES_RECENT_INVOICES_TTL', 600)
+        self._lock = threading.Lock()
+        self._by_instance = {}
+        self._seen_generation = None
+
+    def lookup(self, instance_id, ref, facture_id):
+        """``(ref, tickets_count)`` of the processed invoice matching ``ref``
+        (preferred) or ``facture_id``, or None."""
+        entries = self._by_instance.get(instance_id)
+        if not entries:
+            return None
+        keys = []
+        if ref:
+            keys.append(('ref', ref))
+        if facture_id is not None:
+            keys.append(('facture', facture_id))
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] <= now:
+                    del entries[key]
+                    continue
+                entries.move_to_end(key)
+                return entry[1], entry[2]
+        return None
+
+    def remember(self, instance_id, ref, facture_id, tickets_count):
+        if self.capacity <= 0:
+            return
+        entry = (time.monotonic() + self.ttl, ref, tickets_count)
+        with self._lock:
+            entries = self._by_instance.setdefault(instance_id, OrderedDict())
+            if ref:
+                entries[('ref', ref)] = entry
+                entries.move_to_end(('ref', ref))
+            if facture_id is not None:
+                entries[('facture', facture_id)] = entry
+                entries.move_to_end(('facture', facture_id))
+            while len(entries) > self.capacity:
+                entries.popitem(last=False)
+
+    def sync(self, generation):
+        """Drop everything if another process deleted a transaction meanwhile
+        (``generation`` comes from ``resolver.generation``)."""
+        if generation != self._seen_generation:
+            self.clear()
+            self._seen_generation = generation
+
+    def clear(self):
+        with self._lock:
+            self._by_instance.clear()
+
+
+recent = RecentInvoices()
+
+
+def invalidate(**kwargs):
+    """Signal receiver for DolibarrTransaction deletes and DolibarrInstance changes."""
+    recent.clear()
+    resolver.bump_generation()
+
+
+def connect_signals():
+    post_delete.connect(invalidate, sender=DolibarrTransaction, dispatch_uid='recent_invoices_delete')
+    post_save.connect(invalidate, sender=DolibarrInstance, dispatch_uid='recent_invoices_instance_save')
+    post_delete.connect(invalidate, sender=DolibarrInstance, dispatch_uid='recent_invoices_instance_delete')
@@ -0,0 +1,215 @@
+"""In-process cache of the configuration every webhook needs.
+
+Each webhook used to query ``DolibarrInstance`` by API key and then the active
+``Raffle``. Both change a handful of times per raffle, so this module keeps
+immutable snapshots of them per worker process:
+
+- instances keyed by the SHA-256 of their inbound API key (raw keys are never
+  held in memory),
+- the active raffle (or the fact that there is none).
+
+Entries expire after ``RAFFLES_CONFIG_CACHE_SECONDS`` (default 30). Saving or
+deleting a ``DolibarrInstance`` or ``Raffle`` drops them right away in the
+process that made the change and bumps a generation number in Django's cache
+(``recent_invoices`` bumps the same number). A webhook reads that number once,
+through ``generation()``, and hands it to every lookup it makes; the read
+itself hits the cache at most once every ``RAFFLES_CONFIG_GENERATION_SECONDS``
+(default 2) per process, so a warm webhook makes no configuration query at
+all and an admin change reaches every gunicorn worker within that delay.
+That needs a cache shared between processes (Redis, Memcached or the database
+cache): with a per-process ``LocMemCache`` a revoked key would keep working in
+the other workers until the TTL, which is why ``check --deploy`` rejects it
+(`checks`).
+"""
+import hashlib
+import threading
+import time
+from dataclasses import dataclass
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from .models import DolibarrInstance, Raffle
+
+_GENERATION_KEY = 'raffles:config_generation'
+_NO_RAFFLE = object()
+
+_lock = threading.Lock()
+_instances = {}
+_active_raffle = None
+_seen_generation = None
+_generation = None
+_generation_expiry = 0.0
+
+
+@dataclass(frozen=True)
+class InstanceSnapshot:
+    """Read-only view of the DolibarrInstance fields the webhook uses."""
+    id: int
+    slug: str
+    tickets_per_amount: int
+    amount_step: Decimal
+    default_ticket_price: Decimal
+    use_inbox: bool
+    rate_limit_burst: int
+    rate_limit_per_minute: int
+
+    @classmethod
+    def from_model(cls, instance):
+        return cls(
+            id=instance.id,
+            slug=instance.slug,
+            tickets_per_amount=instance.tickets_per_amount,
+            amount_step=instance.amount_step,
+            default_ticket_price=instance.default_ticket_price,
+            use_inbox=instance.use_inbox,
+            rate_limit_burst=instance.rate_limit_burst,
+            rate_limit_per_minute=instance.rate_limit_per_minute,
+        )
+
+
+@dataclass(frozen=True)
+class RaffleSnapshot:
+    id: int
+    name: str
+
+
+def generation():
+    """The shared configuration generation, for ``instance_for_key``,
+    ``active_raffle`` and ``recent_invoices.recent.sync``. Between cache reads
+    the last value read is returned."""
+    if time.monotonic() < _generation_expiry:
+        return _generation
+    return _remember_generation(cache.get(_GENERATION_KEY))
+
+
+async def ageneration():
+    """``generation`` for async views."""
+    if time.monotonic() < _generation_expiry:
+        return _generation
+    return _remember_generation(await cache.aget(_GENERATION_KEY))
+
+
+def instance_for_key(token, generation):
+    """Active DolibarrInstance snapshot for an inbound API key, or None."""
+    key_hash = _key_hash(token)
+    _apply_generation(generation)
+    snapshot = _cached_instance(key_hash)
+    if snapshot is not None:
+        return snapshot
+    return _store_instance(
+        key_hash, DolibarrInstance.objects.filter(inbound_api_key=token, is_active=True).first(),
+    )
+
+
+async def ainstance_for_key(token, generation):
+    """``instance_for_key`` for async views."""
+    key_hash = _key_hash(token)
+    _apply_generation(generation)
+    snapshot = _cached_instance(key_hash)
+    if snapshot is not None:
+        return snapshot
+    return _store_instance(
+        key_hash, await DolibarrInstance.objects.filter(inbound_api_key=token, is_active=True).afirst(),
+    )
+
+
+def active_raffle(generation):
+    """Snapshot of the raffle currently receiving webhook tickets, or None."""
+    _apply_generation(generation)
+    entry = _active_raffle
+    if entry is not None and entry[0] > time.monotonic():
+        return None if entry[1] is _NO_RAFFLE else entry[1]
+    return _store_raffle(Raffle.objects.filter(is_active=True).only('id', 'name').first())
+
+
+async def aactive_raffle(generation):
+    """``active_raffle`` for async views."""
+    _apply_generation(generation)
+    entry = _active_raffle
+    if entry is not None and entry[0] > time.monotonic():
+        return None if entry[1] is _NO_RAFFLE else entry[1]
+    return _store_raffle(await Raffle.objects.filter(is_active=True).only('id', 'name').afirst())
+
+
+def bump_generation():
+    """Tell every process that the configuration changed."""
+    global _generation_expiry
+    try:
+        cache.incr(_GENERATION_KEY)
+    except ValueError:
+        cache.set(_GENERATION_KEY, 1, None)
+    # Read the new number on the next webhook instead of after the delay.
+    _generation_expiry = 0.0
+
+
+def invalidate(**kwargs):
+    """Signal receiver: forget every snapshot here and tell the other workers."""
+    _clear_local()
+    bump_generation()
+    # Readers inside a still-open transaction may have re-cached the old row.
+    transaction.on_commit(_clear_local)
+
+
+def connect_signals():
+    for model in (DolibarrInstance, Raffle):
+        post_save.connect(invalidate, sender=model, dispatch_uid=f'resolver_save_{model.__name__}')
+        post_delete.connect(invalidate, sender=model, dispatch_uid=f'resolver_delete_{model.__name__}')
+
+
+def _key_hash(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _cached_instance(key_hash):
+    entry = _instances.get(key_hash)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+
+def _store_instance(key_hash, instance):
+    if instance is None:
+        # Unknown keys are not cached: they are either typos being fixed or
+        # noise, and caching them would let anyone grow this dict.
+        return None
+    snapshot = InstanceSnapshot.from_model(instance)
+    with _lock:
+        _instances[key_hash] = (_expiry(), snapshot)
+    return snapshot
+
+
+def _store_raffle(raffle):
+    global _active_raffle
+    snapshot = RaffleSnapshot(id=raffle.id, name=raffle.name) if raffle else None
+    with _lock:
+        _active_raffle = (_expiry(), snapshot if snapshot else _NO_RAFFLE)
+    return snapshot
+
+
+def _remember_generation(generation):
+    global _generation, _generation_expiry
+    _generation = generation
+    _generation_expiry = time.monotonic() + getattr(settings, 'RAFFLES_CONFIG_GENERATION_SECONDS', 2)
+    return generation
+
+
+def _apply_generation(generation):
+    global _seen_generation
+    if generation != _seen_generation:
+        _clear_local()
+        _seen_generation = generation
+
+
+def _clear_local():
+    global _active_raffle
+    with _lock:
+        _instances.clear()
+        _active_raffle = None
+
+
+def _expiry():
+    return time.monotonic() + getattr(settings, 'RAFFLES_CONFIG_CACHE_SECONDS', 30)
@@ -0,0 +1,76 @@
+"""AsyncDolibarrWebhookView under ASGI (AsyncClient) and WSGI (Client)."""
+from django.test import AsyncClient, Client, TestCase
+from django.urls import reverse
+
+from raffles.models import DolibarrInstance, DolibarrTransaction, Raffle, Ticket, WebhookInboxItem
+
+
+class AsyncWebhookTest(TestCase):
+    def setUp(self):
+        self.url = reverse('raffles:dolibarr_webhook_async')
+        self.raffle = Raffle.objects.create(name="Rifa Async", year=2024, is_active=True)
+        self.instance = DolibarrInstance.objects.create(
+            name="Hellbam", slug="hellbam", inbound_api_key="key-hellbam",
+            tickets_per_amount=1, amount_step=100.00,
+        )
+
+    def _payload(self, n, amount=300.00):
+        return {
+            'customer_identification': f'09{n:08d}',
+            'customer_name': f'Cliente {n}',
+            'total_amount': amount,
+            'ref': f'FA-{n}',
+            'facture_id': n,
+        }
+
+    async def _apost(self, payload, key='key-hellbam'):
+        return await AsyncClient().post(
+            self.url, payload, content_type='application/json', headers={'Authorization': f'Bearer {key}'},
+        )
+
+    async def test_asgi_generates_tickets_and_rejects_duplicates(self):
+        r = await self._apost(self._payload(1))
+        self.assertEqual(r.status_code, 201)
+        body = r.json()
+        self.assertEqual(body['ticket_ranges'], [[1, 3]])
+        self.assertEqual(body['instance'], 'hellbam')
+        self.assertIn('lock;', r['Server-Timing'])
+        self.assertEqual(await Ticket.objects.filter(raffle=self.raffle).acount(), 3)
+
+        r = await self._apost(self._payload(1))
+        self.assertEqual(r.status_code, 409)
+        self.assertEqual(r.json()['tickets_previously_generated'], 3)
+
+    async def test_asgi_rejects_bad_key_and_bad_json(self):
+        r = await self._apost(self._payload(1), key='nope')
+        self.assertEqual(r.status_code, 401)
+        r = await self._apost('x')
+        self.assertEqual(r.status_code, 400)
+        self.assertFalse(await DolibarrTransaction.objects.aexists())
+
+    async def test_asgi_inbox_mode_queues(self):
+        self.instance.use_inbox = True
+        await self.instance.asave()
+        r = await self._apost(self._payload(1))
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual((await WebhookInboxItem.objects.aget()).id, r.json()['inbox_id'])
+
+    def test_wsgi_matches_sync_view(self):
+        client = Client()
+        sync_url = reverse('raffles:dolibarr_webhook')
+        r_async = client.post(
+            self.url, self._payload(1), content_type='application/json', HTTP_AUTHORIZATION='Bearer key-hellbam',
+        )
+        r_sync = client.post(
+            sync_url, self._payload(2), content_type='application/json', HTTP_AUTHORIZATION='Bearer key-hellbam',
+        )
+        self.assertEqual(r_async.status_code, 201)
+        self.assertEqual(r_sync.status_code, 201)
+        self.assertEqual(set(r_async.json()), set(r_sync.json()))
+        self.assertEqual(r_sync.json()['ticket_ranges'], [[4, 6]])
+
+        # Idempotency is shared between both endpoints.
+        r = client.post(
+            sync_url, self._payload(1), content_type='application/json', HTTP_AUTHORIZATION='Bearer key-hellbam',
+        )
+        self.assertEqual(r.status_code, 409)
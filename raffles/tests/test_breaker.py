@@ -0,0 +1,89 @@
+"""Per-instance circuit breaker on the Dolibarr client: fail fast while an
+ERP is down, probe it again after the cooldown."""
+from unittest import mock
+
+import requests
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+
+from raffles import breaker
+from raffles.dolibarr_client import invoice_statuses
+from raffles.models import Customer, DolibarrInstance, DolibarrTransaction, Raffle, Ticket
+
+
+@override_settings(RAFFLES_BREAKER_FAILURES=2, RAFFLES_BREAKER_COOLDOWN=60)
+class CircuitBreakerTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.down = DolibarrInstance.objects.create(
+            name="Hellbam", slug="hellbam", inbound_api_key="key-hellbam",
+            outbound_api_url="https://erp.hellbam.test/api/index.php", outbound_api_key="K1",
+        )
+        self.up = DolibarrInstance.objects.create(
+            name="Bambino", slug="bambino", inbound_api_key="key-bambino",
+            outbound_api_url="https://erp.bambino.test/api/index.php", outbound_api_key="K2",
+        )
+
+    def _get(self, url, params=None, **kwargs):
+        if 'hellbam' in url:
+            raise requests.ConnectTimeout("timed out")
+        response = mock.MagicMock(ok=True, status_code=200)
+        response.json.return_value = [{'id': '1', 'paye': '1'}]
+        return response
+
+    @mock.patch('raffles.dolibarr_client.requests.Session.get')
+    def test_opens_fails_fast_and_recovers_after_probe(self, mock_get):
+        mock_get.side_effect = self._get
+        now = 1_000_000.0
+        with mock.patch('raffles.breaker.time.time', return_value=now):
+            for _ in range(2):
+                errors = {}
+                self.assertEqual(invoice_statuses(self.down, [1], errors=errors), {1: None})
+            self.assertEqual(breaker.status(self.down)['state'], breaker.OPEN)
+            self.assertEqual(mock_get.call_count, 2)
+
+            # Open: no request, and the other instance is not affected.
+            errors = {}
+            self.assertEqual(invoice_statuses(self.down, [1], errors=errors), {1: None})
+            self.assertEqual(errors, {1: 'circuit open'})
+            self.assertEqual(invoice_statuses(self.up, [1]), {1: True})
+            self.assertEqual(mock_get.call_count, 3)
+
+        with mock.patch('raffles.breaker.time.time', return_value=now + 61):
+            self.assertEqual(breaker.status(self.down)['state'], breaker.HALF_OPEN)
+            # Only one probe goes out; a failed probe reopens at once.
+            self.assertTrue(breaker.allow(self.down))
+            self.assertFalse(breaker.allow(self.down))
+            breaker.record_failure(self.down)
+            self.assertEqual(breaker.status(self.down)['retry_in'], 60)
+
+        with mock.patch('raffles.breaker.time.time', return_value=now + 122):
+            mock_get.side_effect = None
+            mock_get.return_value.ok = True
+            mock_get.return_value.status_code = 200
+            mock_get.return_value.json.return_value = [{'id': '1', 'paye': '0'}]
+            self.assertEqual(invoice_statuses(self.down, [1]), {1: False})
+            self.assertEqual(breaker.status(self.down), {'state': breaker.CLOSED, 'failures': 0, 'retry_in': 0})
+
+    @mock.patch('raffles.payment_refresh._spawn', lambda target: target())
+    @mock.patch('raffles.dolibarr_client.requests.Session.get')
+    def test_dashboard_shows_open_breaker(self, mock_get):
+        mock_get.side_effect = self._get
+        raffle = Raffle.objects.create(name="Rifa", year=2024, is_active=True)
+        tx = DolibarrTransaction.objects.create(instance=self.down, ref='R', facture_id=1, amount=100, tickets_count=1)
+        Ticket.objects.create(
+            raffle=raffle, customer=Customer.objects.create(first_name="X"), ticket_number=1, price=0,
+            dolibarr_transaction=tx,
+        )
+        get_user_model().objects.create_user(username='staffer', password='pwd1234', is_staff=True)
+        client = Client()
+        client.login(username='staffer', password='pwd1234')
+        url = reverse('raffles:raffle_draw_dashboard', args=[raffle.id])
+
+        client.get(url + '?refresh=1')
+        client.get(url + '?refresh=1')
+        r = client.get(url)
+        self.assertEqual([row['instance'].slug for row in r.context['breakers']], ['hellbam'])
+        self.assertContains(r, 'Próximo intento en')
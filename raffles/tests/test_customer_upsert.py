@@ -0,0 +1,101 @@
+"""The webhook only writes a returning customer's row when its data changed."""
+from io import StringIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from raffles import metrics
+from raffles.models import Customer, DolibarrInstance, Raffle
+
+
+class CustomerUpsertTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.url = reverse('raffles:dolibarr_webhook')
+        Raffle.objects.create(name="Rifa Clientes", year=2024, is_active=True)
+        DolibarrInstance.objects.create(
+            name="Hellbam", slug="hellbam", inbound_api_key="key-hellbam",
+            tickets_per_amount=1, amount_step=100.00,
+        )
+        metrics.reset()
+
+    def _post(self, n, **customer):
+        payload = {
+            'customer_identification': '0912345678',
+            'customer_name': 'Juan Pérez',
+            'customer_email': 'juan@example.com',
+            'customer_phone': '0999999999',
+            'total_amount': 100.00,
+            'ref': f'FA-{n}',
+            'facture_id': n,
+        }
+        payload.update(customer)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(
+                self.url, payload, content_type='application/json', HTTP_AUTHORIZATION='Bearer key-hellbam',
+            )
+        self.assertEqual(response.status_code, 201)
+        return [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE "raffles_customer"')]
+
+    def test_repeat_buyer_with_same_data_is_not_written(self):
+        self._post(1)
+        self.assertEqual(self._post(2), [])
+        self.assertEqual(self._post(3), [])
+        self.assertEqual(metrics.read()[metrics.CUSTOMER_CREATED], 1)
+        self.assertEqual(metrics.read()[metrics.CUSTOMER_NOOP], 2)
+
+    def test_changed_fields_are_the_only_columns_written(self):
+        self._post(1)
+        updates = self._post(2, customer_phone='0988888888')
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"phone"', updates[0])
+        self.assertNotIn('"first_name"', updates[0])
+        self.assertNotIn('"email"', updates[0])
+        self.assertEqual(Customer.objects.get().phone, '0988888888')
+        self.assertEqual(metrics.read()[metrics.CUSTOMER_UPDATED], 1)
+
+    def test_metrics_command_reports_noop_ratio(self):
+        self._post(1)
+        self._post(2)
+        out = StringIO()
+        call_command('webhook_metrics', '--reset', stdout=out)
+        self.assertIn('50.0%', out.getvalue())
+        self.assertEqual(metrics.read()[metrics.CUSTOMER_NOOP], 0)
+
+
+class MetricsBufferTest(TestCase):
+    """Counters are buffered per process and added to the cache off the request."""
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_webhook_does_not_touch_the_cache_for_counters(self):
+        Raffle.objects.create(name="Rifa Clientes", year=2024, is_active=True)
+        DolibarrInstance.objects.create(
+            name="Hellbam", slug="hellbam", inbound_api_key="key-hellbam",
+            tickets_per_amount=1, amount_step=100.00,
+        )
+        with mock.patch.object(metrics, 'cache') as metrics_cache:
+            response = Client().post(
+                reverse('raffles:dolibarr_webhook'),
+                {'customer_identification': '0912345678', 'total_amount': 100.00, 'ref': 'FA-1'},
+                content_type='application/json', HTTP_AUTHORIZATION='Bearer key-hellbam',
+            )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(metrics_cache.mock_calls, [])
+        self.assertEqual(metrics.read()[metrics.CUSTOMER_CREATED], 1)
+
+    def test_flush_waits_for_another_worker(self):
+        metrics.incr(metrics.CUSTOMER_NOOP, 3)
+        cache.add(metrics._LOCK_KEY, 1, 5)
+        with mock.patch.object(metrics, '_LOCK_ATTEMPTS', 1):
+            self.assertFalse(metrics.flush())
+        self.assertIsNone(cache.get('raffles:metric:' + metrics.CUSTOMER_NOOP))
+        cache.delete(metrics._LOCK_KEY)
+        metrics.incr(metrics.CUSTOMER_NOOP)
+        self.assertEqual(metrics.read()[metrics.CUSTOMER_NOOP], 4)
@@ -0,0 +1,89 @@
+"""The Dolibarr client and the draw panel against the local REST simulator:
+real HTTP, status codes and the breaker, no mocks of the client."""
+from unittest import mock
+
+import requests
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+
+from raffles import breaker
+from raffles.dolibarr_client import invoice_statuses, is_invoice_paid, refresh_invoice_statuses
+from raffles.dolibarr_simulator import DolibarrSimulator
+from raffles.models import Customer, DolibarrInstance, DolibarrTransaction, Raffle, Ticket
+
+
+class DolibarrSimulatorTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.simulator = DolibarrSimulator(invoices=100, statuses={2: False}, api_key='K1').start()
+        self.addCleanup(self.simulator.stop)
+        self.instance = DolibarrInstance.objects.create(
+            name="Hellbam", slug="hellbam", inbound_api_key="key-hellbam",
+            outbound_api_url=self.simulator.url, outbound_api_key="K1",
+        )
+
+    def test_list_and_single_endpoints(self):
+        self.assertEqual(invoice_statuses(self.instance, [1, 2, 500]), {1: True, 2: False, 500: None})
+        self.assertEqual(self.simulator.requests, 1)
+
+        tx = DolibarrTransaction.objects.create(instance=self.instance, ref='R', facture_id=2, amount=1, tickets_count=1)
+        refresh_invoice_statuses(self.instance, [2])
+        tx = DolibarrTransaction.objects.select_related('instance', 'payment_status').get(pk=tx.pk)
+        ticket = Ticket(raffle=Raffle.objects.create(name="R", year=2024), ticket_number=1, dolibarr_transaction=tx)
+        self.assertFalse(is_invoice_paid(ticket))
+
+        # Dolibarr's list endpoint: default limit 100, 404 when nothing matched, 400 on a bad filter.
+        response = requests.get(
+            f"{self.simulator.url}/invoices",
+            params={'sqlfilters': f"(t.rowid:in:{','.join(map(str, range(1, 151)))})"},
+            headers={'DOLAPIKEY': 'K1'},
+        )
+        self.assertEqual(len(response.json()), 100)
+        self.assertEqual(
+            requests.get(f"{self.simulator.url}/invoices?sqlfilters=(t.rowid:in:900)", headers={'DOLAPIKEY': 'K1'}).status_code,
+            404,
+        )
+        self.assertEqual(
+            requests.get(f"{self.simulator.url}/invoices?sqlfilters=(t.ref:like:'FA%')", headers={'DOLAPIKEY': 'K1'}).status_code,
+            400,
+        )
+        self.assertEqual(requests.get(f"{self.simulator.url}/invoices/1").status_code, 401)
+
+    def test_paid_ratio_is_stable_per_invoice(self):
+        simulator = DolibarrSimulator(paid_ratio=0.5, seed=7)
+        try:
+            first = [simulator.invoice(n)['paye'] for n in range(1, 201)]
+            self.assertEqual(first, [simulator.invoice(n)['paye'] for n in range(1, 201)])
+            self.assertTrue(60 < first.count('1') < 140)
+        finally:
+            simulator.stop()
+
+    @override_settings(RAFFLES_BREAKER_FAILURES=2)
+    def test_server_errors_open_the_breaker(self):
+        self.simulator.error_rate = 1.0
+        for _ in range(3):
+            errors = {}
+            self.assertEqual(invoice_statuses(self.instance, [1], errors=errors), {1: None})
+        self.assertEqual(errors, {1: 'circuit open'})
+        self.assertEqual(self.simulator.requests, 2)
+        self.assertEqual(breaker.status(self.instance)['state'], breaker.OPEN)
+
+    @mock.patch('raffles.payment_refresh._spawn', lambda target: target())
+    def test_draw_panel_forced_refresh(self):
+        raffle = Raffle.objects.create(name="Rifa", year=2024, is_active=True)
+        customer = Customer.objects.create(first_name="Cliente")
+        for n in (1, 2, 3, 101):
+            tx = DolibarrTransaction.objects.create(
+                instance=self.instance, ref=f"R{n}", facture_id=n, amount=100, tickets_count=1,
+            )
+            Ticket.objects.create(raffle=raffle, customer=customer, ticket_number=n, price=0, dolibarr_transaction=tx)
+        get_user_model().objects.create_user(username='staffer', password='pwd1234', is_staff=True)
+        client = Client()
+        client.login(username='staffer', password='pwd1234')
+
+        r = client.get(reverse('raffles:raffle_draw_dashboard', args=[raffle.id]) + '?refresh=1', follow=True)
+        self.assertEqual(r.context['eligible_count'], 2)  # 2 is unpaid
+        self.assertEqual(r.context['unverified_count'], 1)  # 101 does not exist
+        self.assertEqual(self.simulator.requests, 1)
@@ -1,15 +1,24 @@
 """Tests for the new staff-only draw panel: aleatoriedad, exclusiones,
 descarte/resorteo, y comportamiento ante caída del API Dolibarr."""
-from unittest.mock import patch
+import threading
+import time
+from io import StringIO
+from unittest.mock import MagicMock, patch
 
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError
 from django.test import Client, TestCase
 from django.urls import reverse
+from django.utils import timezone
 
 from raffles.models import (
     Customer,
     DolibarrInstance,
     DolibarrTransaction,
+    DrawPoolSnapshot,
+    InvoicePaymentStatus,
     Prize,
     Raffle,
     Ticket,
@@ -63,20 +72,79 @@ class DrawPanelTest(TestCase):
         self.prize3 = Prize.objects.create(raffle=self.raffle, position=3, name="Premio 3")
         self.tickets = [make_ticket(self.raffle, self.instance, i, facture_id=100 + i) for i in range(1, 11)]
 
+    def _store_statuses(self, is_paid):
+        """Stored Dolibarr answer for every ticket's invoice; None = no row."""
+        if is_paid is None:
+            return
+        now = timezone.now()
+        InvoicePaymentStatus.objects.bulk_create([
+            InvoicePaymentStatus(
+                instance=self.instance, facture_id=ticket.dolibarr_transaction.facture_id, is_paid=is_paid,
+                checked_at=now, attempted_at=now,
+            )
+            for ticket in self.tickets
+        ])
+
     def _draw_url(self, prize):
         return reverse('raffles:execute_prize_draw', args=[self.raffle.id, prize.id])
 
     def _discard_url(self, prize):
         return reverse('raffles:discard_winner', args=[self.raffle.id, prize.id])
 
-    @patch('raffles.views.is_invoice_paid', return_value=True)
-    def test_only_staff_can_draw(self, _mock_paid):
+    def _add_prizes(self, count, first_position):
+        """``count`` prizes, each with a paid winner and a discarded ticket."""
+        now = timezone.now()
+        for position in range(first_position, first_position + count):
+            for facture_id in (200 + position, 400 + position):
+                InvoicePaymentStatus.objects.create(
+                    instance=self.instance, facture_id=facture_id, is_paid=True, checked_at=now, attempted_at=now,
+                )
+            prize = Prize.objects.create(
+                raffle=self.raffle, position=position, name=f"Premio {position}",
+                winning_ticket=make_ticket(self.raffle, self.instance, 100 + position, facture_id=200 + position),
+            )
+            WinnerDiscard.objects.create(
+                prize=prize, ticket=make_ticket(self.raffle, self.instance, 300 + position, facture_id=400 + position),
+                reason=WinnerDiscard.Reason.NO_CONTACT, discarded_by=self.staff,
+            )
+
+    @patch('raffles.payment_refresh._spawn', MagicMock())
+    def test_panel_and_winners_list_queries_do_not_grow_with_prizes(self):
+        """Discard histories are prefetched and winner statuses resolved in
+        one batch, so both pages cost the same with 5 prizes as with 20."""
+        cache.clear()
+        self._store_statuses(True)
+        WinnerDiscard.objects.create(
+            prize=self.prize1, ticket=self.tickets[0], reason=WinnerDiscard.Reason.UNPAID_INVOICE, discarded_by=self.staff,
+        )
+        self.client.login(username='staffer', password='pwd1234')
+        dashboard_url = reverse('raffles:raffle_draw_dashboard', args=[self.raffle.id])
+        winners_url = reverse('raffles:winners_list', args=[self.raffle.id])
+
+        for extra, first_position in ((2, 4), (15, 6)):
+            self._add_prizes(extra, first_position)
+            # Session, user, raffle, prizes, discards, pool counts, instances,
+            # freshness, refresh job, snapshot, site settings.
+            with self.assertNumQueries(11):
+                r = self.client.get(dashboard_url)
+            winners = Prize.objects.filter(raffle=self.raffle, winning_ticket__isnull=False).count()
+            self.assertEqual(len(r.context['prize_states']), Prize.objects.filter(raffle=self.raffle).count())
+            self.assertEqual(r.context['prize_states'][0]['discard_history'][0].ticket, self.tickets[0])
+            self.assertContains(r, 'Factura pagada', count=winners)
+
+            # Session, user, raffle, prizes with winners, site settings.
+            with self.assertNumQueries(5):
+                r = self.client.get(winners_url)
+            self.assertEqual([row['payment_status'] for row in r.context['rows']], [True] * winners)
+
+    def test_only_staff_can_draw(self):
+        self._store_statuses(True)
         self.client.login(username='lurker', password='pwd1234')
         r = self.client.post(self._draw_url(self.prize1))
         self.assertIn(r.status_code, (302, 403))  # @staff_member_required → redirect to login
 
-    @patch('raffles.views.is_invoice_paid', return_value=True)
-    def test_draw_excludes_other_prize_winners(self, _mock_paid):
+    def test_draw_excludes_other_prize_winners(self):
+        self._store_statuses(True)
         self.client.login(username='staffer', password='pwd1234')
 
         r1 = self.client.post(self._draw_url(self.prize1))
@@ -93,8 +161,8 @@ class DrawPanelTest(TestCase):
 
         self.assertEqual(len({winner1_id, winner2_id, winner3_id}), 3)
 
-    @patch('raffles.views.is_invoice_paid', return_value=True)
-    def test_draw_excludes_discarded(self, _mock_paid):
+    def test_draw_excludes_discarded(self):
+        self._store_statuses(True)
         self.client.login(username='staffer', password='pwd1234')
 
         r1 = self.client.post(self._draw_url(self.prize1))
@@ -115,17 +183,13 @@ class DrawPanelTest(TestCase):
             self.assertEqual(r.status_code, 200)
             self.assertNotEqual(r.json()['ticket_id'], first_winner_id)
 
-    @patch('raffles.views.is_invoice_paid')
-    def test_draw_excludes_unpaid_when_flag_on(self, mock_paid):
+    def test_draw_excludes_unpaid_when_flag_on(self):
         """Two of ten tickets are flagged unpaid → never selected."""
         self.client.login(username='staffer', password='pwd1234')
 
         unpaid_ids = {self.tickets[0].id, self.tickets[1].id}
-
-        def side_effect(ticket, force_refresh=False):
-            return False if ticket.id in unpaid_ids else True
-
-        mock_paid.side_effect = side_effect
+        self._store_statuses(True)
+        InvoicePaymentStatus.objects.filter(facture_id__in=[101, 102]).update(is_paid=False)
 
         for _ in range(10):
             self.prize1.winning_ticket = None
@@ -134,32 +198,88 @@ class DrawPanelTest(TestCase):
             self.assertEqual(r.status_code, 200)
             self.assertNotIn(r.json()['ticket_id'], unpaid_ids)
 
-    @patch('raffles.views.is_invoice_paid', return_value=None)
-    def test_unverified_payment_is_treated_as_excluded_when_flag_on(self, _mock_paid):
+    def test_unverified_payment_is_treated_as_excluded_when_flag_on(self):
         """If Dolibarr is down (all None), excluding unpaid drains the pool."""
+        self._store_statuses(None)
         self.client.login(username='staffer', password='pwd1234')
         r = self.client.post(self._draw_url(self.prize1), {'exclude_unpaid': '1'})
         self.assertEqual(r.status_code, 409)
         self.assertIn('elegibles', r.json()['error'])
 
-    @patch('raffles.views.is_invoice_paid', return_value=None)
-    def test_can_still_draw_when_unpaid_flag_off(self, _mock_paid):
+    def test_can_still_draw_when_unpaid_flag_off(self):
         """Operator can override and draw even with API down by clearing the flag."""
+        self._store_statuses(None)
         self.client.login(username='staffer', password='pwd1234')
         r = self.client.post(self._draw_url(self.prize1), {'exclude_unpaid': '0'})
         self.assertEqual(r.status_code, 200)
 
-    @patch('raffles.views.is_invoice_paid', return_value=True)
-    def test_cannot_redraw_without_discarding_first(self, _mock_paid):
+    def test_cannot_redraw_without_discarding_first(self):
+        self._store_statuses(True)
         self.client.login(username='staffer', password='pwd1234')
         self.client.post(self._draw_url(self.prize1))
         r2 = self.client.post(self._draw_url(self.prize1))
         self.assertEqual(r2.status_code, 409)
         self.assertIn('ya tiene un ganador', r2.json()['error'])
 
+    def test_draw_all_prizes_in_one_request(self):
+        self._store_statuses(True)
+        InvoicePaymentStatus.objects.filter(facture_id__in=[101, 102]).update(is_paid=False)
+        unpaid_ids = {self.tickets[0].id, self.tickets[1].id}
+        self.client.login(username='staffer', password='pwd1234')
+        first = self.client.post(self._draw_url(self.prize1)).json()['ticket_id']
+
+        r = self.client.post(reverse('raffles:draw_all_prizes', args=[self.raffle.id]))
+        self.assertEqual(r.status_code, 200)
+        winners = r.json()['winners']
+        self.assertEqual([w['prize_id'] for w in winners], [self.prize2.id, self.prize3.id])
+        drawn = {w['ticket_id'] for w in winners}
+        self.assertEqual(len(drawn), 2)
+        self.assertNotIn(first, drawn)
+        self.assertFalse(drawn & unpaid_ids)
+        self.prize3.refresh_from_db()
+        self.assertEqual(self.prize3.winning_ticket_id, winners[1]['ticket_id'])
+
+        # Nothing pending any more; discard and redraw a single prize still works.
+        self.assertEqual(self.client.post(reverse('raffles:draw_all_prizes', args=[self.raffle.id])).status_code, 409)
+        self.client.post(self._discard_url(self.prize2), {'reason': 'no_contact'})
+        r = self.client.post(self._draw_url(self.prize2))
+        self.assertNotIn(r.json()['ticket_id'], drawn | {first} | unpaid_ids)
+
+    def test_draw_all_subset_and_short_pool(self):
+        from raffles import draw
+        self._store_statuses(True)
+        InvoicePaymentStatus.objects.exclude(facture_id__in=[101, 102]).update(is_paid=False)
+        self.client.login(username='staffer', password='pwd1234')
+        url = reverse('raffles:draw_all_prizes', args=[self.raffle.id])
+
+        # Two paid tickets for three prizes: nothing is drawn.
+        self.assertEqual(self.client.post(url).status_code, 409)
+        self.assertFalse(Prize.objects.filter(winning_ticket__isnull=False).exists())
+
+        r = self.client.post(url, {'prize_id': [self.prize3.id, self.prize1.id]})
+        self.assertEqual([w['prize_position'] for w in r.json()['winners']], [1, 3])
+        self.assertEqual(
+            {w['ticket_id'] for w in r.json()['winners']}, {self.tickets[0].id, self.tickets[1].id},
+        )
+        self.assertIsNone(Prize.objects.get(pk=self.prize2.pk).winning_ticket_id)
+
+        # Count, one pass over the ids, the winning rows.
+        with self.assertNumQueries(3):
+            self.assertEqual(len(draw.pick_many(draw.eligible(self.raffle, exclude_unpaid=False), 5)), 5)
+
+    def test_draw_all_from_snapshot(self):
+        from raffles import draw
+        self._store_statuses(True)
+        snapshot = draw.freeze(self.raffle)
+        self.client.login(username='staffer', password='pwd1234')
+        r = self.client.post(reverse('raffles:draw_all_prizes', args=[self.raffle.id]))
+        self.assertEqual(r.json()['pool_sha256'], snapshot.sha256)
+        self.assertEqual(len({w['ticket_id'] for w in r.json()['winners']}), 3)
+
 
 class DolibarrClientTest(TestCase):
     def setUp(self):
+        cache.clear()
         self.raffle = Raffle.objects.create(name="X", year=2024)
         self.instance = DolibarrInstance.objects.create(
             name="Hellbam",
@@ -188,47 +308,403 @@ class DolibarrClientTest(TestCase):
         )
         self.assertIsNone(is_invoice_paid(ticket))
 
-    @patch('raffles.dolibarr_client._session.get')
-    def test_returns_none_when_api_raises(self, mock_get):
-        import requests
-        from raffles.dolibarr_client import is_invoice_paid
-        mock_get.side_effect = requests.ConnectionError("Dolibarr down")
-
+    def _refreshed_ticket(self, facture_id):
+        """A ticket of ``facture_id`` read back after a status refresh."""
+        from raffles.dolibarr_client import refresh_invoice_statuses
         customer = Customer.objects.create(first_name="X")
         tx = DolibarrTransaction.objects.create(
-            instance=self.instance, ref='R', facture_id=1, amount=100, tickets_count=1,
+            instance=self.instance, ref='R', facture_id=facture_id, amount=100, tickets_count=1,
         )
         ticket = Ticket.objects.create(
             raffle=self.raffle, customer=customer, ticket_number=1, price=0, dolibarr_transaction=tx,
         )
-        self.assertIsNone(is_invoice_paid(ticket, force_refresh=True))
+        refresh_invoice_statuses(self.instance, [facture_id])
+        return Ticket.objects.select_related(
+            'dolibarr_transaction__instance', 'dolibarr_transaction__payment_status',
+        ).get(pk=ticket.pk)
+
+    @patch('raffles.dolibarr_client.requests.Session.get')
+    def test_returns_none_when_api_raises(self, mock_get):
+        import requests
+        from raffles.dolibarr_client import is_invoice_paid
+        mock_get.side_effect = requests.ConnectionError("Dolibarr down")
+        self.assertIsNone(is_invoice_paid(self._refreshed_ticket(1)))
 
-    @patch('raffles.dolibarr_client._session.get')
+    @patch('raffles.dolibarr_client.requests.Session.get')
     def test_returns_true_when_dolibarr_says_paid(self, mock_get):
         from raffles.dolibarr_client import is_invoice_paid
         mock_get.return_value.ok = True
-        mock_get.return_value.json.return_value = {'paye': '1'}
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = [{'id': '99', 'paye': '1'}]
+        self.assertTrue(is_invoice_paid(self._refreshed_ticket(99)))
 
-        customer = Customer.objects.create(first_name="X")
-        tx = DolibarrTransaction.objects.create(
-            instance=self.instance, ref='R', facture_id=99, amount=100, tickets_count=1,
+    @patch('raffles.dolibarr_client.requests.Session.get')
+    def test_returns_false_when_dolibarr_says_unpaid(self, mock_get):
+        from raffles.dolibarr_client import is_invoice_paid
+        mock_get.return_value.ok = True
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = [{'id': '99', 'paye': '0'}]
+        self.assertFalse(is_invoice_paid(self._refreshed_ticket(99)))
+
+
+class DolibarrBatchStatusTest(TestCase):
+    """invoice_statuses / ticket_payment_statuses: one list request per chunk."""
+
+    def setUp(self):
+        cache.clear()
+        self.raffle = Raffle.objects.create(name="X", year=2024, is_active=True)
+        self.instance = DolibarrInstance.objects.create(
+            name="Hellbam",
+            slug="hellbam",
+            inbound_api_key="hellbam-key",
+            outbound_api_url="https://erp.hellbam.test/api/index.php",
+            outbound_api_key="DOLAPIKEY-X",
         )
-        ticket = Ticket.objects.create(
-            raffle=self.raffle, customer=customer, ticket_number=1, price=0, dolibarr_transaction=tx,
+
+    def _answer(self, mock_get, paid_ids, unpaid_ids=()):
+        invoices = [{'id': str(i), 'paye': '1'} for i in paid_ids] + [{'id': str(i), 'paye': '0'} for i in unpaid_ids]
+        mock_get.return_value.ok = True
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = invoices
+
+    @patch('raffles.dolibarr_client._BATCH_SIZE', 2)
+    @patch('raffles.dolibarr_client.requests.Session.get')
+    def test_one_list_request_per_chunk(self, mock_get):
+        from raffles.dolibarr_client import invoice_statuses
+        self._answer(mock_get, paid_ids=[1, 3], unpaid_ids=[2])
+
+        statuses = invoice_statuses(self.instance, [1, 2, 3, 4])
+        self.assertEqual(statuses, {1: True, 2: False, 3: True, 4: None})
+        self.assertEqual(
+            sorted(call.kwargs['params']['sqlfilters'] for call in mock_get.call_args_list),
+            ['(t.rowid:in:1,2)', '(t.rowid:in:3,4)'],
         )
-        self.assertTrue(is_invoice_paid(ticket, force_refresh=True))
+        self.assertTrue(mock_get.call_args.args[0].endswith('/invoices'))
 
-    @patch('raffles.dolibarr_client._session.get')
-    def test_returns_false_when_dolibarr_says_unpaid(self, mock_get):
+    @patch('raffles.dolibarr_client.requests.Session.get')
+    def test_failures_leave_invoices_unverified(self, mock_get):
+        import requests
+        from raffles.dolibarr_client import invoice_statuses
+        mock_get.side_effect = requests.ConnectionError("Dolibarr down")
+        self.assertEqual(invoice_statuses(self.instance, [1, 2]), {1: None, 2: None})
+
+        mock_get.side_effect = None
+        mock_get.return_value.ok = False
+        mock_get.return_value.status_code = 404  # Dolibarr: "No invoice found"
+        self.assertEqual(invoice_statuses(self.instance, [1]), {1: None})
+
+    @patch('raffles.payment_refresh._spawn', lambda target: target())
+    @patch('raffles.dolibarr_client.requests.Session.get')
+    def test_draw_panel_resolves_pool_in_one_request(self, mock_get):
+        self._answer(mock_get, paid_ids=range(101, 110), unpaid_ids=[110])
+        for i in range(1, 11):
+            make_ticket(self.raffle, self.instance, i, facture_id=100 + i)
+        Ticket.objects.create(
+            raffle=self.raffle, customer=Customer.objects.create(first_name="Manual"), ticket_number=11, price=0,
+        )
+        get_user_model().objects.create_user(username='staffer', password='pwd1234', is_staff=True)
+        client = Client()
+        client.login(username='staffer', password='pwd1234')
+
+        r = client.get(reverse('raffles:raffle_draw_dashboard', args=[self.raffle.id]) + '?refresh=1', follow=True)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.context['eligible_count'], 9)
+        self.assertEqual(r.context['unverified_count'], 1)
+        self.assertEqual(mock_get.call_count, 1)
+
+    @patch('raffles.payment_refresh._spawn', lambda target: target())
+    @patch('raffles.dolibarr_client.requests.Session.get')
+    def test_dashboard_checks_each_invoice_once(self, mock_get):
+        """50 tickets per invoice: one invoice id per invoice in the request,
+        and a query count that does not grow with the pool."""
+        self._answer(mock_get, paid_ids=[501], unpaid_ids=[502])
+        customer = Customer.objects.create(first_name="Cliente", identification="0911111111")
+        number = 0
+        for facture_id in (501, 502):
+            tx = DolibarrTransaction.objects.create(
+                instance=self.instance, ref=f"REF-{facture_id}", facture_id=facture_id, amount=5000, tickets_count=50,
+            )
+            for _ in range(50):
+                number += 1
+                Ticket.objects.create(
+                    raffle=self.raffle, customer=customer, ticket_number=number, price=0, dolibarr_transaction=tx,
+                )
+        get_user_model().objects.create_user(username='staffer', password='pwd1234', is_staff=True)
+        client = Client()
+        client.login(username='staffer', password='pwd1234')
+        url = reverse('raffles:raffle_draw_dashboard', args=[self.raffle.id])
+
+        client.get(url + '?refresh=1')
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(mock_get.call_args.kwargs['params']['sqlfilters'], '(t.rowid:in:501,502)')
+
+        # A plain load reads the stored statuses: no HTTP, and session, user,
+        # raffle, prizes, pool counts, instances, freshness, refresh job,
+        # snapshot, site settings.
+        mock_get.reset_mock()
+        with self.assertNumQueries(10):
+            r = client.get(url)
+        self.assertEqual(r.context['eligible_count'], 50)
+        self.assertEqual(r.context['total_pool_count'], 100)
+        self.assertEqual(mock_get.call_count, 0)
+
+    @patch('raffles.dolibarr_client._BATCH_SIZE', 1)
+    @patch('raffles.dolibarr_client.requests.Session.get')
+    def test_parallel_requests_respect_instance_limit(self, mock_get):
+        from raffles.dolibarr_client import invoice_statuses
+        other = DolibarrInstance.objects.create(
+            name="Otra", slug="otra", inbound_api_key="otra-key",
+            outbound_api_url="https://erp.otra.test/api/index.php", outbound_api_key="DOLAPIKEY-Y",
+            verification_concurrency=1,
+        )
+        self.instance.verification_concurrency = 2
+        self.instance.save()
+        lock = threading.Lock()
+        active = {'hellbam': 0, 'otra': 0}
+        peak = {'hellbam': 0, 'otra': 0}
+
+        def get(url, params=None, **kwargs):
+            slug = 'otra' if 'otra' in url else 'hellbam'
+            with lock:
+                active[slug] += 1
+                peak[slug] = max(peak[slug], active[slug])
+            time.sleep(0.02)
+            with lock:
+                active[slug] -= 1
+            facture_id = params['sqlfilters'][len('(t.rowid:in:'):-1]
+            response = MagicMock(ok=True, status_code=200)
+            response.json.return_value = [{'id': facture_id, 'paye': '1'}]
+            return response
+
+        mock_get.side_effect = get
+        statuses = {}
+        for instance, facture_ids in ((self.instance, range(1, 7)), (other, range(7, 10))):
+            statuses.update(invoice_statuses(instance, list(facture_ids)))
+        self.assertEqual(set(statuses.values()), {True})
+        self.assertEqual(mock_get.call_count, 9)
+        self.assertEqual(peak, {'hellbam': 2, 'otra': 1})
+
+
+class InvoicePaymentStatusStoreTest(TestCase):
+    """Stored statuses: refresh_invoice_status fills them, page reads use them."""
+
+    def setUp(self):
+        cache.clear()
+        self.raffle = Raffle.objects.create(name="X", year=2024, is_active=True)
+        self.instance = DolibarrInstance.objects.create(
+            name="Hellbam",
+            slug="hellbam",
+            inbound_api_key="hellbam-key",
+            outbound_api_url="https://erp.hellbam.test/api/index.php",
+            outbound_api_key="DOLAPIKEY-X",
+        )
+        self.tickets = [make_ticket(self.raffle, self.instance, i, facture_id=i) for i in (1, 2, 3)]
+
+    @patch('raffles.dolibarr_client.requests.Session.get')
+    def test_command_stores_statuses_and_keeps_last_answer_on_failure(self, mock_get):
+        import requests
         from raffles.dolibarr_client import is_invoice_paid
         mock_get.return_value.ok = True
-        mock_get.return_value.json.return_value = {'paye': '0'}
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = [{'id': '1', 'paye': '1'}, {'id': '2', 'paye': '0'}]
 
-        customer = Customer.objects.create(first_name="X")
-        tx = DolibarrTransaction.objects.create(
-            instance=self.instance, ref='R', facture_id=99, amount=100, tickets_count=1,
+        call_command('refresh_invoice_status', stdout=StringIO())
+        rows = {row.facture_id: row for row in InvoicePaymentStatus.objects.all()}
+        self.assertEqual({f: row.is_paid for f, row in rows.items()}, {1: True, 2: False, 3: None})
+        self.assertEqual(rows[3].last_error, 'not found in Dolibarr')
+
+        ticket = Ticket.objects.select_related('dolibarr_transaction__instance').get(pk=self.tickets[0].pk)
+        mock_get.reset_mock()
+        self.assertTrue(is_invoice_paid(ticket))
+        self.assertFalse(mock_get.called)
+
+        # Nothing is due right after a pass, except the invoice without answer.
+        call_command('refresh_invoice_status', stdout=StringIO())
+        self.assertEqual(mock_get.call_args.kwargs['params']['sqlfilters'], '(t.rowid:in:3)')
+
+        # Dolibarr down: the attempt is noted, the last answer kept.
+        mock_get.reset_mock()
+        mock_get.side_effect = requests.ConnectionError("Dolibarr down")
+        call_command('refresh_invoice_status', '--max-age', '0', '--paid-max-age', '0', stdout=StringIO())
+        self.assertEqual(mock_get.call_count, 1)
+        row = InvoicePaymentStatus.objects.get(facture_id=2)
+        self.assertFalse(row.is_paid)
+        self.assertIn('Dolibarr down', row.last_error)
+
+    def test_loop_survives_a_failed_pass(self):
+        passes = [OperationalError('connection reset'), {}, KeyboardInterrupt()]
+
+        def due_invoices(*args, **kwargs):
+            outcome = passes.pop(0)
+            if isinstance(outcome, BaseException):
+                raise outcome
+            return outcome
+
+        out = StringIO()
+        with patch('raffles.management.commands.refresh_invoice_status.due_invoices', due_invoices), \
+                self.assertLogs('raffles.management.commands.refresh_invoice_status', 'ERROR'):
+            call_command('refresh_invoice_status', '--loop', '--sleep', '0', stdout=out)
+        self.assertEqual(passes, [])
+        self.assertIn("Sin facturas por verificar.", out.getvalue())
+
+        with patch('raffles.management.commands.refresh_invoice_status.due_invoices', side_effect=OperationalError):
+            with self.assertRaises(OperationalError):
+                call_command('refresh_invoice_status', stdout=StringIO())
+
+    def test_draw_fetches_only_the_winning_row(self):
+        from raffles import draw
+        now = timezone.now()
+        InvoicePaymentStatus.objects.create(instance=self.instance, facture_id=1, is_paid=True, checked_at=now)
+        InvoicePaymentStatus.objects.create(instance=self.instance, facture_id=2, is_paid=False, checked_at=now)
+
+        with self.assertNumQueries(2):  # primary key range, then the drawn key
+            winner = draw.pick(draw.eligible(self.raffle))
+        self.assertEqual(winner.id, self.tickets[0].id)
+        self.assertEqual(winner.customer.first_name, "Cliente 1")  # select_related, no extra query
+        self.assertEqual(draw.eligible(self.raffle, exclude_unpaid=False).count(), 3)
+
+        # The drawn key comes from secrets, offset from the smallest eligible one.
+        with patch('raffles.draw.secrets.randbelow', return_value=2) as randbelow:
+            self.assertEqual(draw.pick(draw.eligible(self.raffle, exclude_unpaid=False)).id, self.tickets[2].id)
+        randbelow.assert_called_once_with(3)
+
+        Prize.objects.create(raffle=self.raffle, position=1, name="P1", winning_ticket=self.tickets[0])
+        self.assertIsNone(draw.pick(draw.eligible(self.raffle)))
+
+    def test_draw_redraws_keys_that_are_not_eligible(self):
+        from raffles import draw
+        now = timezone.now()
+        for facture_id, paid in ((1, True), (2, False), (3, True)):
+            InvoicePaymentStatus.objects.create(instance=self.instance, facture_id=facture_id, is_paid=paid, checked_at=now)
+
+        # Ticket 2 is unpaid: drawing its key costs one more lookup, never a win.
+        with patch('raffles.draw.secrets.randbelow', side_effect=[1, 2]), self.assertNumQueries(3):
+            self.assertEqual(draw.pick(draw.eligible(self.raffle)).id, self.tickets[2].id)
+
+        # A pool too sparse for the lookups falls back to count + OFFSET.
+        with patch('raffles.draw._KEYSET_ATTEMPTS', 2), \
+                patch('raffles.draw.secrets.randbelow', side_effect=[1, 1, 0]), self.assertNumQueries(5):
+            self.assertEqual(draw.pick(draw.eligible(self.raffle)).id, self.tickets[0].id)
+
+    def test_dashboard_counters_come_from_one_aggregate(self):
+        from raffles.views import _pool_counts
+        now = timezone.now()
+        InvoicePaymentStatus.objects.create(instance=self.instance, facture_id=1, is_paid=True, checked_at=now)
+        InvoicePaymentStatus.objects.create(instance=self.instance, facture_id=2, is_paid=False, checked_at=now)
+        no_api = DolibarrInstance.objects.create(name="Sin API", slug="sin-api", inbound_api_key="sin-api-key")
+        InvoicePaymentStatus.objects.create(instance=no_api, facture_id=9, is_paid=True, checked_at=now)
+        make_ticket(self.raffle, no_api, 9, facture_id=9)
+        Ticket.objects.create(raffle=self.raffle, customer=Customer.objects.create(first_name="M"), ticket_number=10, price=0)
+        winner = make_ticket(self.raffle, self.instance, 11, facture_id=11)
+        Prize.objects.create(raffle=self.raffle, position=1, name="P1", winning_ticket=winner)
+        discarded = make_ticket(self.raffle, self.instance, 12, facture_id=12)
+        prize = Prize.objects.create(raffle=self.raffle, position=2, name="P2")
+        WinnerDiscard.objects.create(prize=prize, ticket=discarded, reason=WinnerDiscard.Reason.NO_CONTACT)
+
+        with self.assertNumQueries(2):  # pool counts, instances
+            counts, _ = _pool_counts(self.raffle)
+        self.assertEqual(counts, {
+            self.instance.id: {True: 1, False: 1, None: 1},
+            no_api.id: {True: 0, False: 0, None: 1},  # stored, but no credentials to trust it
+            None: {True: 0, False: 0, None: 1},
+        })
+
+        get_user_model().objects.create_user(username='staffer', password='pwd1234', is_staff=True)
+        client = Client()
+        client.login(username='staffer', password='pwd1234')
+        with patch('raffles.payment_refresh._spawn'):
+            r = client.get(reverse('raffles:raffle_draw_dashboard', args=[self.raffle.id]))
+        self.assertEqual(
+            (r.context['eligible_count'], r.context['unverified_count'], r.context['total_pool_count']), (1, 3, 5),
         )
-        ticket = Ticket.objects.create(
-            raffle=self.raffle, customer=customer, ticket_number=1, price=0, dolibarr_transaction=tx,
+        self.assertEqual(r.context['instances_summary'], [('hellbam', 3), ('manual', 1), ('sin-api', 1)])
+
+
+class DrawPoolSnapshotTest(TestCase):
+    """Freeze the eligible pool once; draws then pick from the stored ids."""
+
+    def setUp(self):
+        cache.clear()
+        self.raffle = Raffle.objects.create(name="Rifa", year=2024, is_active=True)
+        self.instance = DolibarrInstance.objects.create(
+            name="Hellbam", slug="hellbam", inbound_api_key="hellbam-key",
+            outbound_api_url="https://erp.hellbam.test/api/index.php", outbound_api_key="DOLAPIKEY-X",
+        )
+        self.tickets = [make_ticket(self.raffle, self.instance, i, facture_id=i) for i in range(1, 6)]
+        now = timezone.now()
+        for facture_id in (1, 2, 3, 4):
+            InvoicePaymentStatus.objects.create(
+                instance=self.instance, facture_id=facture_id, is_paid=facture_id != 4, checked_at=now,
+            )
+        self.prizes = [Prize.objects.create(raffle=self.raffle, position=n, name=f"P{n}") for n in (1, 2, 3, 4)]
+        get_user_model().objects.create_user(username='staffer', password='pwd1234', is_staff=True)
+        self.client = Client()
+        self.client.login(username='staffer', password='pwd1234')
+
+    def _draw(self, prize):
+        return self.client.post(reverse('raffles:execute_prize_draw', args=[self.raffle.id, prize.id]))
+
+    def test_freeze_stores_sorted_ids_and_hash(self):
+        import hashlib
+        import struct
+        r = self.client.post(reverse('raffles:freeze_draw_pool', args=[self.raffle.id]), {'exclude_unpaid': '1'})
+        self.assertEqual(r.status_code, 302)
+
+        snapshot = DrawPoolSnapshot.objects.get()
+        paid = sorted(ticket.id for ticket in self.tickets[:3])
+        expected = struct.pack(f'<{len(paid)}I', *paid)
+        self.assertEqual((snapshot.ticket_count, snapshot.id_width), (3, 4))
+        self.assertEqual(bytes(snapshot.ticket_ids), expected)
+        self.assertEqual(snapshot.sha256, hashlib.sha256(expected).hexdigest())
+
+        with patch('raffles.payment_refresh._spawn'):
+            r = self.client.get(reverse('raffles:raffle_draw_dashboard', args=[self.raffle.id]))
+        self.assertContains(r, snapshot.sha256)
+
+        # Freezing again replaces the active snapshot.
+        self.client.post(reverse('raffles:freeze_draw_pool', args=[self.raffle.id]), {'exclude_unpaid': '0'})
+        active = DrawPoolSnapshot.objects.get(released_at__isnull=True)
+        self.assertEqual(active.ticket_count, 5)
+
+    def test_draws_use_the_snapshot_until_released(self):
+        from raffles import draw
+        snapshot = draw.freeze(self.raffle)
+        frozen = {ticket.id for ticket in self.tickets[:3]}
+        # Paid after the freeze: not part of this draw event.
+        InvoicePaymentStatus.objects.filter(facture_id=4).update(is_paid=True)
+
+        # The snapshot was frozen with only paid tickets: asking for the
+        # unpaid ones too is refused instead of silently ignored.
+        url = reverse('raffles:execute_prize_draw', args=[self.raffle.id, self.prizes[0].id])
+        r = self.client.post(url, {'exclude_unpaid': '0'})
+        self.assertEqual(r.status_code, 400)
+        self.assertTrue(r.json()['exclude_unpaid'])
+        r = self.client.post(reverse('raffles:draw_all_prizes', args=[self.raffle.id]), {'exclude_unpaid': '0'})
+        self.assertEqual(r.status_code, 400)
+        self.assertFalse(Prize.objects.filter(winning_ticket__isnull=False).exists())
+
+        first = self.client.post(url, {'exclude_unpaid': '1'}).json()
+        self.assertIn(first['ticket_id'], frozen)
+        self.assertEqual(first['pool_sha256'], snapshot.sha256)
+        self.assertTrue(first['exclude_unpaid'])
+
+        # Discard and redraw: neither the discarded nor other winners come back.
+        self.client.post(
+            reverse('raffles:discard_winner', args=[self.raffle.id, self.prizes[0].id]), {'reason': 'no_contact'},
         )
-        self.assertFalse(is_invoice_paid(ticket, force_refresh=True))
+        second = self._draw(self.prizes[1]).json()
+        third = self._draw(self.prizes[2]).json()
+        self.assertEqual({first['ticket_id'], second['ticket_id'], third['ticket_id']}, frozen)
+        r = self._draw(self.prizes[0])
+        self.assertEqual(r.status_code, 409)
+
+        # Warm snapshot: the active snapshot, the exclusions, the winning row.
+        Prize.objects.filter(pk=self.prizes[2].pk).update(winning_ticket=None)
+        with self.assertNumQueries(3):
+            self.assertEqual(draw.pick_from_snapshot(draw.active_snapshot(self.raffle)).id, third['ticket_id'])
+
+        self.client.post(reverse('raffles:release_draw_pool', args=[self.raffle.id]))
+        self.assertIsNone(draw.active_snapshot(self.raffle))
+        r = self._draw(self.prizes[3])
+        self.assertIn(r.json()['ticket_id'], {third['ticket_id'], self.tickets[3].id})
+        self.assertIsNone(r.json()['pool_sha256'])
@@ -0,0 +1,185 @@
+"""Stale-while-revalidate payment statuses: the draw panel renders what is
+stored and refreshes the due invoices in a background job."""
+import json
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from raffles import payment_refresh
+from raffles.models import (
+    Customer,
+    DolibarrInstance,
+    DolibarrTransaction,
+    InvoicePaymentStatus,
+    PaymentRefreshJob,
+    Raffle,
+    Ticket,
+)
+
+
+class PaymentRefreshTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.raffle = Raffle.objects.create(name="Rifa", year=2024, is_active=True)
+        self.instance = DolibarrInstance.objects.create(
+            name="Hellbam", slug="hellbam", inbound_api_key="key-hellbam",
+            outbound_api_url="https://erp.hellbam.test/api/index.php", outbound_api_key="K1",
+        )
+        customer = Customer.objects.create(first_name="Cliente")
+        for n in (1, 2, 3):
+            tx = DolibarrTransaction.objects.create(
+                instance=self.instance, ref=f"R{n}", facture_id=n, amount=100, tickets_count=1,
+            )
+            Ticket.objects.create(
+                raffle=self.raffle, customer=customer, ticket_number=n, price=0, dolibarr_transaction=tx,
+            )
+        get_user_model().objects.create_user(username='staffer', password='pwd1234', is_staff=True)
+        self.client = Client()
+        self.client.login(username='staffer', password='pwd1234')
+        self.url = reverse('raffles:raffle_draw_dashboard', args=[self.raffle.id])
+        self.status_url = reverse('raffles:payment_refresh_status', args=[self.raffle.id])
+        self.stream_url = reverse('raffles:payment_refresh_stream', args=[self.raffle.id])
+
+    def _answer(self, mock_get):
+        mock_get.return_value.ok = True
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = [{'id': '1', 'paye': '1'}, {'id': '2', 'paye': '0'}]
+
+    def _events(self, response):
+        """``[(event, data), ...]`` of a server-sent events response."""
+        events = []
+        for block in b''.join(response.streaming_content).decode().split('\n\n'):
+            fields = dict(line.split(': ', 1) for line in block.splitlines())
+            if 'event' in fields:
+                events.append((fields['event'], json.loads(fields['data'])))
+        return events
+
+    def _store(self, facture_id, is_paid, age):
+        checked = timezone.now() - age
+        InvoicePaymentStatus.objects.create(
+            instance=self.instance, facture_id=facture_id, is_paid=is_paid, checked_at=checked, attempted_at=checked,
+        )
+
+    @mock.patch('raffles.payment_refresh._spawn')
+    @mock.patch('raffles.dolibarr_client.requests.Session.get')
+    def test_page_serves_stored_statuses_and_starts_job_when_due(self, mock_get, mock_spawn):
+        self._store(1, True, timedelta(hours=2))
+        self._store(2, False, timedelta(hours=2))
+        self._store(3, True, timedelta(minutes=1))
+
+        r = self.client.get(self.url)
+        self.assertEqual(r.context['eligible_count'], 2)
+        self.assertEqual(r.context['stale_count'], 1)  # the unpaid one; paid rows last a day
+        self.assertEqual(r.context['refresh_job']['state'], payment_refresh.RUNNING)
+        self.assertContains(r, 'Verificando pagos en Dolibarr')
+        self.assertFalse(mock_get.called)
+        self.assertEqual(mock_spawn.call_count, 1)
+
+        # A second load while the job runs does not start another one.
+        self.client.get(self.url)
+        self.assertEqual(mock_spawn.call_count, 1)
+
+        # The job itself: only the due invoice goes to Dolibarr.
+        self._answer(mock_get)
+        mock_spawn.call_args.args[0]()
+        self.assertEqual(mock_get.call_args.kwargs['params']['sqlfilters'], '(t.rowid:in:2)')
+        job = self.client.get(self.status_url).json()
+        self.assertEqual(job['state'], payment_refresh.DONE)
+        self.assertEqual(job['instances']['hellbam'], {'total': 1, 'checked': 1, 'paid': 0, 'unpaid': 1, 'errors': 0})
+
+    @mock.patch('raffles.payment_refresh._spawn', lambda target: target())
+    @mock.patch('raffles.dolibarr_client.requests.Session.get')
+    def test_forced_refresh_checks_every_invoice_and_failures_wait_for_retry(self, mock_get):
+        self.assertEqual(self.client.get(self.status_url).json()['state'], 'idle')
+        self._answer(mock_get)
+
+        r = self.client.get(self.url + '?refresh=1')
+        self.assertRedirects(r, self.url)
+        self.assertEqual(mock_get.call_args.kwargs['params']['sqlfilters'], '(t.rowid:in:1,2,3)')
+        job = self.client.get(self.status_url).json()
+        self.assertEqual((job['total'], job['checked']), (3, 3))
+        self.assertEqual(job['instances']['hellbam']['errors'], 1)
+
+        # Invoice 3 got no answer, but it was just attempted: no new job.
+        mock_get.reset_mock()
+        r = self.client.get(self.url)
+        self.assertEqual(r.context['stale_count'], 1)
+        self.assertFalse(mock_get.called)
+        self.assertEqual(r.context['refresh_job']['id'], job['id'])
+
+    @mock.patch('raffles.payment_refresh._spawn')
+    def test_job_of_a_dead_worker_is_replaced(self, mock_spawn):
+        job = payment_refresh.start(self.raffle.id, force=True)
+        self.assertEqual(payment_refresh.start(self.raffle.id, force=True)['id'], job['id'])
+        self.assertEqual(mock_spawn.call_count, 1)
+
+        # The worker running it was killed: the heartbeat stops.
+        PaymentRefreshJob.objects.update(heartbeat_at=timezone.now() - timedelta(minutes=2))
+        self.assertEqual(payment_refresh.status(self.raffle.id)['state'], payment_refresh.FAILED)
+        r = self.client.get(self.url + '?refresh=1')
+        self.assertRedirects(r, self.url)
+        self.assertEqual(mock_spawn.call_count, 2)
+        new_job = PaymentRefreshJob.objects.get()
+        self.assertNotEqual(new_job.pk, job['id'])
+        self.assertEqual(new_job.state, payment_refresh.RUNNING)
+
+        # A late write from the lost thread does not revive a replaced job.
+        PaymentRefreshJob.objects.update(heartbeat_at=timezone.now() - timedelta(minutes=2))
+        payment_refresh.status(self.raffle.id)
+        new_job.state = payment_refresh.DONE
+        payment_refresh._save(new_job)
+        self.assertEqual(PaymentRefreshJob.objects.get().state, payment_refresh.FAILED)
+
+    def test_status_requires_staff(self):
+        self.client.logout()
+        r = self.client.get(self.status_url)
+        self.assertEqual(r.status_code, 302)
+
+    @mock.patch('raffles.payment_refresh._spawn')
+    @mock.patch('raffles.dolibarr_client.requests.Session.get')
+    def test_stream_reports_progress_then_counters(self, mock_get, mock_spawn):
+        job = payment_refresh.start(self.raffle.id, force=True)
+
+        # While the job runs the stream reports it and closes at its deadline.
+        with override_settings(RAFFLES_PAYMENT_STREAM_SECONDS=0):
+            r = self.client.get(self.stream_url)
+            self.assertEqual(r['Content-Type'], 'text/event-stream')
+            self.assertEqual(self._events(r), [('progress', job)])
+
+        self._answer(mock_get)
+        mock_spawn.call_args.args[0]()
+        [(event, data)] = self._events(self.client.get(self.stream_url))
+        self.assertEqual(event, 'done')
+        self.assertEqual(data['instances']['hellbam'], {'total': 3, 'checked': 3, 'paid': 1, 'unpaid': 1, 'errors': 1})
+        self.assertEqual(data['summary']['eligible_count'], 1)
+        self.assertEqual(data['summary']['unverified_count'], 1)  # invoice 3 got no answer
+        self.assertEqual(data['summary']['instances_summary'], [['hellbam', 3]])
+        self.assertEqual(data['summary']['stale_count'], 1)
+
+        # The JSON status carries the same counters once the job is over.
+        self.assertEqual(self.client.get(self.status_url).json()['summary'], data['summary'])
+
+        # Without a job the stream says so, it does not pretend one finished.
+        PaymentRefreshJob.objects.all().delete()
+        self.assertEqual(self._events(self.client.get(self.stream_url)), [('idle', {'state': 'idle'})])
+
+        self.client.logout()
+        self.assertEqual(self.client.get(self.stream_url).status_code, 302)
+
+    @mock.patch('raffles.payment_refresh._spawn')
+    def test_streams_are_limited_across_workers(self, mock_spawn):
+        payment_refresh.start(self.raffle.id, force=True)
+        with override_settings(RAFFLES_PAYMENT_STREAM_SECONDS=0, RAFFLES_PAYMENT_STREAM_MAX=1):
+            open_stream = self.client.get(self.stream_url)
+            # The one slot is taken until that stream ends: the next panel polls.
+            self.assertEqual(self.client.get(self.stream_url).status_code, 204)
+            self.assertEqual(self.client.get(self.status_url).json()['state'], payment_refresh.RUNNING)
+
+            self._events(open_stream)
+            open_stream.close()
+            self.assertEqual(self.client.get(self.stream_url)['Content-Type'], 'text/event-stream')
@@ -0,0 +1,93 @@
+"""Per-instance token bucket on the webhook: 429 + Retry-After past the burst."""
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import Client, TestCase
+from django.urls import reverse
+
+from raffles import metrics, ratelimit
+from raffles.models import DolibarrInstance, Raffle, Ticket
+
+
+class RateLimitTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset([ratelimit.counter_name(slug, outcome)
+                       for slug in ('hellbam', 'bambino') for outcome in ('admitted', 'throttled')])
+        self.client = Client()
+        self.url = reverse('raffles:dolibarr_webhook')
+        Raffle.objects.create(name="Rifa Límite", year=2024, is_active=True)
+        self.noisy = DolibarrInstance.objects.create(
+            name="Hellbam", slug="hellbam", inbound_api_key="key-hellbam",
+            tickets_per_amount=1, amount_step=100.00,
+            rate_limit_burst=3, rate_limit_per_minute=6,
+        )
+        DolibarrInstance.objects.create(
+            name="Bambino", slug="bambino", inbound_api_key="key-bambino",
+            tickets_per_amount=1, amount_step=100.00,
+        )
+        self.n = 0
+
+    def _post(self, key='key-hellbam', url=None):
+        self.n += 1
+        return self.client.post(
+            url or self.url,
+            {'customer_identification': '0912345678', 'total_amount': 100.00, 'ref': f'FA-{self.n}', 'facture_id': self.n},
+            content_type='application/json',
+            HTTP_AUTHORIZATION=f'Bearer {key}',
+        )
+
+    def test_burst_then_429_with_retry_after(self):
+        now = 1_000_000.0
+        with mock.patch('raffles.ratelimit.time.time', return_value=now):
+            self.assertEqual([self._post().status_code for _ in range(3)], [201, 201, 201])
+            r = self._post()
+        self.assertEqual(r.status_code, 429)
+        self.assertEqual(r['Retry-After'], '10')
+        self.assertEqual(r.json()['retry_after'], 10)
+        self.assertEqual(Ticket.objects.count(), 3)
+
+        # One token refills every 10 s at 6/min.
+        with mock.patch('raffles.ratelimit.time.time', return_value=now + 10):
+            self.assertEqual(self._post().status_code, 201)
+            self.assertEqual(self._post().status_code, 429)
+
+        counts = ratelimit.read_counters(['hellbam'])['hellbam']
+        self.assertEqual(counts, {'admitted': 4, 'throttled': 2})
+
+    def test_other_instances_are_not_affected(self):
+        with mock.patch('raffles.ratelimit.time.time', return_value=1_000_000.0):
+            for _ in range(4):
+                self._post()
+            self.assertEqual(self._post().status_code, 429)
+            self.assertEqual(self._post(key='key-bambino').status_code, 201)
+
+    def test_batch_costs_one_token_per_invoice(self):
+        batch_url = reverse('raffles:dolibarr_webhook_batch')
+        invoices = [
+            {'customer_identification': '0912345678', 'total_amount': 100.00, 'ref': f'FB-{i}', 'facture_id': 100 + i}
+            for i in range(2)
+        ]
+        with mock.patch('raffles.ratelimit.time.time', return_value=1_000_000.0):
+            r = self.client.post(
+                batch_url, {'invoices': invoices}, content_type='application/json',
+                HTTP_AUTHORIZATION='Bearer key-hellbam',
+            )
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(self._post().status_code, 201)
+            self.assertEqual(self._post().status_code, 429)
+
+    def test_disabled_by_default(self):
+        for _ in range(10):
+            self.assertEqual(self._post(key='key-bambino').status_code, 201)
+
+    def test_async_view_applies_the_same_limit(self):
+        async_url = reverse('raffles:dolibarr_webhook_async')
+        with mock.patch('raffles.ratelimit.time.time', return_value=1_000_000.0):
+            for _ in range(3):
+                self.assertEqual(self._post(url=async_url).status_code, 201)
+            r = self._post(url=async_url)
+            self.assertEqual(r.status_code, 429)
+            self.assertIn('Retry-After', r)
+            self.assertEqual(self._post(key='key-bambino', url=async_url).status_code, 201)
+        self.assertEqual(ratelimit.read_counters(['hellbam'])['hellbam'], {'admitted': 3, 'throttled': 1})
@@ -0,0 +1,92 @@
+"""In-memory recent-invoice filter in front of the webhook duplicate check."""
+from unittest import mock
+
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from raffles import recent_invoices, resolver
+from raffles.models import DolibarrInstance, DolibarrTransaction, Raffle, Ticket
+
+
+class RecentInvoicesTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.url = reverse('raffles:dolibarr_webhook')
+        Raffle.objects.create(name="Rifa Duplicados", year=2024, is_active=True)
+        self.instance = DolibarrInstance.objects.create(
+            name="Hellbam", slug="hellbam", inbound_api_key="key-hellbam",
+            tickets_per_amount=1, amount_step=100.00,
+        )
+        DolibarrInstance.objects.create(
+            name="Bambino", slug="bambino", inbound_api_key="key-bambino",
+            tickets_per_amount=1, amount_step=100.00,
+        )
+
+    def _post(self, ref, facture_id, key='key-hellbam'):
+        return self.client.post(
+            self.url,
+            {'customer_identification': '0912345678', 'total_amount': 200.00, 'ref': ref, 'facture_id': facture_id},
+            content_type='application/json',
+            HTTP_AUTHORIZATION=f'Bearer {key}',
+        )
+
+    def _transaction_queries(self, ctx):
+        return [q['sql'] for q in ctx.captured_queries if 'raffles_dolibarrtransaction' in q['sql']]
+
+    def test_repeat_is_answered_without_querying_transactions(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self._post('FA-1', 1).status_code, 201)
+
+        with CaptureQueriesContext(connection) as ctx:
+            r = self._post('FA-1', 1)
+        self.assertEqual(r.status_code, 409)
+        self.assertEqual(r.json()['tickets_previously_generated'], 2)
+        self.assertEqual(self._transaction_queries(ctx), [])
+
+    def test_facture_id_match_reports_original_ref(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self._post('FA-1', 1)
+        r = self._post('FA-1-BIS', 1)
+        self.assertEqual(r.status_code, 409)
+        self.assertEqual(r.json()['ref'], 'FA-1')
+
+    def test_database_hit_is_remembered(self):
+        # Not executing on_commit callbacks: the first repeat must hit the database.
+        self._post('FA-1', 1)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self._post('FA-1', 1).status_code, 409)
+        self.assertEqual(len(self._transaction_queries(ctx)), 1)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self._post('FA-1', 1).status_code, 409)
+        self.assertEqual(self._transaction_queries(ctx), [])
+
+    def test_filter_is_per_instance(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self._post('FA-1', 1)
+        self.assertEqual(self._post('FA-1', 1, key='key-bambino').status_code, 201)
+
+    def test_deleting_the_transaction_allows_reprocessing(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self._post('FA-1', 1)
+        Ticket.objects.all().delete()
+        DolibarrTransaction.objects.all().delete()
+        self.assertEqual(self._post('FA-1', 1).status_code, 201)
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'raffles_cache'},
+    }, RAFFLES_CONFIG_GENERATION_SECONDS=0)
+    def test_delete_in_another_worker_allows_reprocessing(self):
+        call_command('createcachetable', verbosity=0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self._post('FA-1', 1)
+        # Another worker deletes the transaction: its filter and its cache
+        # connection are its own, only the database cache is shared.
+        with mock.patch.object(resolver, 'cache', caches.create_connection('default')), \
+                mock.patch.object(recent_invoices.recent, 'clear'):
+            Ticket.objects.all().delete()
+            DolibarrTransaction.objects.all().delete()
+        self.assertEqual(self._post('FA-1', 1).status_code, 201)
@@ -0,0 +1,141 @@
+"""Cached API key -> DolibarrInstance and active-raffle resolution for the webhook."""
+from unittest import mock
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from raffles import checks, resolver
+from raffles.models import DolibarrInstance, Raffle, Ticket
+
+
+class ResolverTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.url = reverse('raffles:dolibarr_webhook')
+        self.raffle = Raffle.objects.create(name="Rifa Cache", year=2024, is_active=True)
+        self.instance = DolibarrInstance.objects.create(
+            name="Hellbam",
+            slug="hellbam",
+            inbound_api_key="key-hellbam",
+            tickets_per_amount=1,
+            amount_step=100.00,
+        )
+
+    def _post(self, n, amount=100.00, key='key-hellbam'):
+        return self.client.post(
+            self.url,
+            {'customer_identification': f'09{n:08d}', 'total_amount': amount, 'ref': f'FA-{n}', 'facture_id': n},
+            content_type='application/json',
+            HTTP_AUTHORIZATION=f'Bearer {key}',
+        )
+
+    def test_warm_requests_do_not_query_configuration(self):
+        self.assertEqual(self._post(1).status_code, 201)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self._post(2).status_code, 201)
+        sql = [q['sql'] for q in ctx.captured_queries]
+        self.assertFalse([s for s in sql if 'FROM "raffles_dolibarrinstance"' in s], sql)
+        self.assertFalse([s for s in sql if 'FROM "raffles_raffle"' in s], sql)
+        self.assertEqual(Ticket.objects.filter(raffle=self.raffle).count(), 2)
+
+    def test_instance_changes_invalidate_the_cache(self):
+        self._post(1)
+        self.instance.amount_step = 50.00
+        self.instance.save()
+        self.assertEqual(self._post(2).json()['tickets_generated'], 2)
+
+        self.instance.is_active = False
+        self.instance.save()
+        self.assertEqual(self._post(3).status_code, 401)
+
+    def test_raffle_changes_invalidate_the_cache(self):
+        self._post(1)
+        self.raffle.is_active = False
+        self.raffle.save()
+        self.assertEqual(self._post(2).status_code, 500)
+
+        other = Raffle.objects.create(name="Rifa Nueva", year=2025, is_active=True)
+        r = self._post(3)
+        self.assertEqual(r.json()['raffle'], "Rifa Nueva")
+        self.assertTrue(Ticket.objects.filter(raffle=other).exists())
+
+    @override_settings(RAFFLES_CONFIG_GENERATION_SECONDS=0)
+    def test_generation_bump_from_another_worker_clears_local_snapshots(self):
+        self.assertIsNotNone(resolver.instance_for_key('key-hellbam', resolver.generation()))
+        # Simulate another process saving the instance: the row changes without
+        # signals firing here, only the shared generation number moves.
+        DolibarrInstance.objects.filter(pk=self.instance.pk).update(is_active=False)
+        self.assertIsNotNone(resolver.instance_for_key('key-hellbam', resolver.generation()))
+        cache.incr('raffles:config_generation')
+        self.assertIsNone(resolver.instance_for_key('key-hellbam', resolver.generation()))
+
+    def test_unknown_keys_are_not_cached(self):
+        self.assertEqual(self._post(1, key='nope').status_code, 401)
+        self.assertNotIn('nope', str(resolver._instances))
+
+
+DATABASE_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'raffles_cache'}}
+
+
+@override_settings(CACHES=DATABASE_CACHE)
+class GenerationReadTest(TestCase):
+    """How often a webhook reads the shared generation under the database cache."""
+
+    def setUp(self):
+        call_command('createcachetable', verbosity=0)
+        cache.clear()
+        Raffle.objects.create(name="Rifa Cache", year=2024, is_active=True)
+        DolibarrInstance.objects.create(name="Hellbam", slug="hellbam", inbound_api_key="key-hellbam")
+        self.url = reverse('raffles:dolibarr_webhook')
+
+    def _generation_reads(self, n):
+        with CaptureQueriesContext(connection) as ctx:
+            r = Client().post(
+                self.url, {'customer_identification': '0912345678', 'total_amount': 10, 'ref': f'FA-{n}'},
+                content_type='application/json', HTTP_AUTHORIZATION='Bearer key-hellbam',
+            )
+        self.assertLess(r.status_code, 500)
+        return len([q for q in ctx.captured_queries if 'config_generation' in q['sql']])
+
+    def test_generation_is_read_once_per_interval(self):
+        self.assertEqual(self._generation_reads(1), 1)
+        self.assertEqual(self._generation_reads(1), 0)  # duplicate, everything warm
+        self.assertEqual(self._generation_reads(2), 0)
+        with mock.patch.object(resolver.time, 'monotonic', return_value=resolver._generation_expiry + 1):
+            self.assertEqual(self._generation_reads(1), 1)
+
+
+
+@override_settings(RAFFLES_CONFIG_GENERATION_SECONDS=0)
+class SharedCacheTest(TestCase):
+    """Invalidation between gunicorn workers, each with its own snapshots."""
+
+    def setUp(self):
+        self.instance = DolibarrInstance.objects.create(name="Hellbam", slug="hellbam", inbound_api_key="key-hellbam")
+
+    def _save_in_other_worker(self, other_cache):
+        # The other worker's snapshots are its own: nothing is cleared here,
+        # only what it writes to its cache can reach this process.
+        with mock.patch.object(resolver, 'cache', other_cache), mock.patch.object(resolver, '_clear_local'):
+            self.instance.is_active = False
+            self.instance.save()
+
+    @override_settings(CACHES=DATABASE_CACHE)
+    def test_revoked_key_stops_working_in_every_worker(self):
+        call_command('createcachetable', verbosity=0)
+        cache.clear()
+        self.assertIsNotNone(resolver.instance_for_key('key-hellbam', resolver.generation()))
+        self._save_in_other_worker(caches.create_connection('default'))
+        self.assertIsNone(resolver.instance_for_key('key-hellbam', resolver.generation()))
+        self.assertEqual(checks.check_shared_cache(None), [])
+
+    def test_process_local_cache_fails_the_deploy_check(self):
+        self.assertIsNotNone(resolver.instance_for_key('key-hellbam', resolver.generation()))
+        self._save_in_other_worker(LocMemCache('other-worker', {}))
+        self.assertIsNotNone(resolver.instance_for_key('key-hellbam', resolver.generation()))  # still cached here
+        self.assertEqual([error.id for error in checks.check_shared_cache(None)], ['raffles.E001'])
@@ -0,0 +1,121 @@
+"""Per-raffle ticket number allocator: contiguous blocks from a counter row
+instead of a Max(ticket_number) scan on every purchase."""
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from raffles.models import Customer, DolibarrInstance, Raffle, RaffleTicketCounter, Ticket
+from raffles.ticket_numbers import allocate_ticket_numbers, from_ranges, sync_ticket_counter, to_ranges
+
+
+class TicketNumberAllocatorTest(TestCase):
+    def setUp(self):
+        self.raffle = Raffle.objects.create(name="Rifa Contador", year=2024, is_active=True)
+        self.customer = Customer.objects.create(first_name="X", identification="0911111111")
+
+    def test_blocks_are_contiguous_and_do_not_overlap(self):
+        with transaction.atomic():
+            first = allocate_ticket_numbers(self.raffle.id, 3)
+            second = allocate_ticket_numbers(self.raffle.id, 5)
+        self.assertEqual(list(first), [1, 2, 3])
+        self.assertEqual(list(second), [4, 5, 6, 7, 8])
+        self.assertEqual(RaffleTicketCounter.objects.get(raffle=self.raffle).last_number, 8)
+
+    def test_counter_is_seeded_from_existing_tickets(self):
+        Ticket.objects.create(raffle=self.raffle, customer=self.customer, ticket_number=41, price=0)
+        RaffleTicketCounter.objects.filter(raffle=self.raffle).delete()
+        with transaction.atomic():
+            numbers = allocate_ticket_numbers(self.raffle.id, 2)
+        self.assertEqual(list(numbers), [42, 43])
+
+    def test_counters_are_per_raffle(self):
+        other = Raffle.objects.create(name="Otra", year=2024)
+        with transaction.atomic():
+            allocate_ticket_numbers(self.raffle.id, 10)
+            numbers = allocate_ticket_numbers(other.id, 1)
+        self.assertEqual(list(numbers), [1])
+
+    def test_update_returning_is_only_used_where_supported(self):
+        # MariaDB sets can_return_columns_from_insert but has no UPDATE ... RETURNING.
+        with transaction.atomic():
+            allocate_ticket_numbers(self.raffle.id, 1)
+        with mock.patch.object(connection, 'vendor', 'mysql'), CaptureQueriesContext(connection) as ctx:
+            with transaction.atomic():
+                numbers = allocate_ticket_numbers(self.raffle.id, 2)
+        self.assertEqual(list(numbers), [2, 3])
+        self.assertFalse([q['sql'] for q in ctx.captured_queries if 'RETURNING' in q['sql']])
+
+    def test_sync_never_moves_counter_backwards(self):
+        with transaction.atomic():
+            allocate_ticket_numbers(self.raffle.id, 10)
+        sync_ticket_counter(self.raffle.id, 4)
+        self.assertEqual(RaffleTicketCounter.objects.get(raffle=self.raffle).last_number, 10)
+        sync_ticket_counter(self.raffle.id, 25)
+        self.assertEqual(RaffleTicketCounter.objects.get(raffle=self.raffle).last_number, 25)
+
+    def test_webhook_continues_after_counter(self):
+        DolibarrInstance.objects.create(name="Default", slug="default", inbound_api_key="k-1")
+        with transaction.atomic():
+            allocate_ticket_numbers(self.raffle.id, 100)
+        response = Client().post(
+            reverse('raffles:dolibarr_webhook'),
+            {'customer_identification': '0912345678', 'total_amount': 200.00, 'ref': 'INV-1'},
+            content_type='application/json',
+            HTTP_AUTHORIZATION='Bearer k-1',
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['ticket_ranges'], [[101, 102]])
+        self.assertNotIn('ticket_numbers', response.json())
+
+    def test_webhook_lists_numbers_on_request(self):
+        DolibarrInstance.objects.create(name="Default", slug="default", inbound_api_key="k-1")
+        with self.assertLogs('raffles.webhook', level='INFO') as logs:
+            response = Client().post(
+                reverse('raffles:dolibarr_webhook') + '?ticket_numbers=1',
+                {'customer_identification': '0912345678', 'total_amount': 300.00, 'ref': 'INV-1'},
+                content_type='application/json',
+                HTTP_AUTHORIZATION='Bearer k-1',
+            )
+        self.assertEqual(response.json()['ticket_ranges'], [[1, 3]])
+        self.assertEqual(response.json()['ticket_numbers'], [1, 2, 3])
+        self.assertTrue(any('[[1, 3]]' in line for line in logs.output))
+
+    def test_ranges_round_trip(self):
+        self.assertEqual(to_ranges(range(1001, 1501)), [[1001, 1500]])
+        self.assertEqual(to_ranges(range(0)), [])
+        self.assertEqual(to_ranges([7, 3, 4, 5, 9]), [[3, 5], [7, 7], [9, 9]])
+        self.assertEqual(from_ranges([[3, 5], [9, 9]]), [3, 4, 5, 9])
+
+    def test_admin_assigns_next_number_when_left_blank(self):
+        User = get_user_model()
+        User.objects.create_superuser(username='admin', password='pwd1234', email='a@b.c')
+        client = Client()
+        client.login(username='admin', password='pwd1234')
+        with transaction.atomic():
+            allocate_ticket_numbers(self.raffle.id, 7)
+
+        response = client.post(reverse('admin:raffles_ticket_add'), {
+            'raffle': self.raffle.id,
+            'customer': self.customer.id,
+            'ticket_number': '',
+            'price': '0',
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Ticket.objects.get(raffle=self.raffle).ticket_number, 8)
+
+    def test_rebuild_command_repairs_stale_counter(self):
+        Ticket.objects.create(raffle=self.raffle, customer=self.customer, ticket_number=500, price=0)
+        RaffleTicketCounter.objects.update_or_create(raffle=self.raffle, defaults={'last_number': 3})
+
+        out = StringIO()
+        call_command('rebuild_ticket_counters', '--dry-run', stdout=out)
+        self.assertEqual(RaffleTicketCounter.objects.get(raffle=self.raffle).last_number, 3)
+
+        call_command('rebuild_ticket_counters', stdout=out)
+        self.assertEqual(RaffleTicketCounter.objects.get(raffle=self.raffle).last_number, 500)
@@ -0,0 +1,123 @@
+"""Batch webhook: many invoices per request with the per-invoice idempotency
+rules of the single endpoint and one ticket-number block for the batch."""
+from django.test import Client, TestCase
+from django.urls import reverse
+
+from raffles.models import Customer, DolibarrInstance, DolibarrTransaction, Raffle, RaffleTicketCounter, Ticket
+
+
+class DolibarrWebhookBatchTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.url = reverse('raffles:dolibarr_webhook_batch')
+        self.raffle = Raffle.objects.create(name="Rifa Lote", year=2024, is_active=True)
+        self.instance = DolibarrInstance.objects.create(
+            name="Hellbam",
+            slug="hellbam",
+            inbound_api_key="key-hellbam",
+            tickets_per_amount=1,
+            amount_step=100.00,
+        )
+
+    def _post(self, invoices, key="key-hellbam"):
+        return self.client.post(
+            self.url, {'invoices': invoices}, content_type='application/json',
+            HTTP_AUTHORIZATION=f'Bearer {key}',
+        )
+
+    def _invoice(self, n, amount=100.00, **extra):
+        data = {
+            'customer_identification': f'09{n:08d}',
+            'customer_name': f'Cliente {n}',
+            'total_amount': amount,
+            'ref': f'FA-{n}',
+            'facture_id': n,
+        }
+        data.update(extra)
+        return data
+
+    def test_requires_auth(self):
+        self.assertEqual(self._post([self._invoice(1)], key='nope').status_code, 401)
+
+    def test_batch_creates_contiguous_numbers_in_input_order(self):
+        r = self._post([self._invoice(1, 200.00), self._invoice(2, 100.00), self._invoice(3, 300.00)])
+        self.assertEqual(r.status_code, 200)
+        body = r.json()
+        self.assertEqual(body['tickets_generated'], 6)
+        self.assertEqual([res['status'] for res in body['results']], [201, 201, 201])
+        self.assertEqual(
+            [res['ticket_ranges'] for res in body['results']],
+            [[[1, 2]], [[3, 3]], [[4, 6]]],
+        )
+        self.assertEqual(Ticket.objects.count(), 6)
+        self.assertEqual(DolibarrTransaction.objects.count(), 3)
+
+    def test_per_item_results_and_idempotency(self):
+        self.assertEqual(self._post([self._invoice(1)]).status_code, 200)
+
+        r = self._post([
+            self._invoice(1),                                  # already processed
+            self._invoice(2, amount=50.00),                    # insufficient amount
+            self._invoice(3, customer_identification=''),      # missing identification
+            self._invoice(4, total_amount='abc'),              # invalid amount
+            'not-an-object',
+            self._invoice(5, ref='FA-5-bis', facture_id=1),    # same facture_id, new ref
+            self._invoice(6),
+        ])
+        results = r.json()['results']
+        self.assertEqual([res['status'] for res in results], [409, 200, 400, 400, 400, 409, 201])
+        self.assertEqual(results[0]['tickets_previously_generated'], 1)
+        self.assertEqual(results[6]['ticket_ranges'], [[2, 2]])
+        self.assertEqual(Ticket.objects.count(), 2)
+
+    def test_ticket_number_collision_resyncs_the_counter(self):
+        """A counter behind a ticket added out of band is not a duplicate: the
+        batch is retried with a resynced counter instead of answered 409."""
+        self._post([self._invoice(1)])
+        RaffleTicketCounter.objects.filter(raffle=self.raffle).update(last_number=0)
+        Ticket.objects.create(
+            raffle=self.raffle, customer=Customer.objects.create(first_name="Manual"), ticket_number=2, price=0,
+        )
+
+        r = self._post([self._invoice(2), self._invoice(3, 200.00)])
+        results = r.json()['results']
+        self.assertEqual([res['status'] for res in results], [201, 201])
+        self.assertEqual([res['ticket_ranges'] for res in results], [[[3, 3]], [[4, 5]]])
+        self.assertEqual(DolibarrTransaction.objects.count(), 3)
+
+    def test_numbers_listed_on_request(self):
+        r = self.client.post(
+            self.url + '?ticket_numbers=true', {'invoices': [self._invoice(1, 300.00), self._invoice(1)]},
+            content_type='application/json', HTTP_AUTHORIZATION='Bearer key-hellbam',
+        )
+        results = r.json()['results']
+        self.assertEqual(results[0]['ticket_numbers'], [1, 2, 3])
+        self.assertNotIn('ticket_numbers', results[1])
+
+    def test_duplicate_inside_same_batch_is_rejected(self):
+        r = self._post([self._invoice(1), self._invoice(1)])
+        statuses = [res['status'] for res in r.json()['results']]
+        self.assertEqual(statuses, [201, 409])
+        self.assertEqual(Ticket.objects.count(), 1)
+
+    def test_no_active_raffle_fails_every_pending_item(self):
+        self.raffle.is_active = False
+        self.raffle.save()
+        r = self._post([self._invoice(1), self._invoice(2)])
+        self.assertEqual([res['status'] for res in r.json()['results']], [500, 500])
+        self.assertEqual(Ticket.objects.count(), 0)
+
+    def test_rejects_non_array_and_oversized_batches(self):
+        r = self.client.post(
+            self.url, {'ref': 'x'}, content_type='application/json', HTTP_AUTHORIZATION='Bearer key-hellbam',
+        )
+        self.assertEqual(r.status_code, 400)
+        self.assertIn('parse;', r['Server-Timing'])
+        r = self.client.post(
+            self.url, 'not json', content_type='application/json', HTTP_AUTHORIZATION='Bearer key-hellbam',
+        )
+        self.assertEqual(r.status_code, 400)
+        self.assertIn('total;', r['Server-Timing'])
+        r = self._post([self._invoice(n) for n in range(501)])
+        self.assertEqual(r.status_code, 413)
+        self.assertIn('total;', r['Server-Timing'])
@@ -0,0 +1,179 @@
+"""Durable webhook inbox: 202 on receipt, tickets generated by the
+process_webhook_inbox worker with retries, backoff and dead-letter."""
+import datetime as dt
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import Client, TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from raffles import inbox
+from raffles.models import (
+    Customer,
+    DolibarrInstance,
+    DolibarrTransaction,
+    Raffle,
+    RaffleTicketCounter,
+    Ticket,
+    WebhookInboxItem,
+)
+
+
+class WebhookInboxTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.url = reverse('raffles:dolibarr_webhook')
+        self.raffle = Raffle.objects.create(name="Rifa Inbox", year=2024, is_active=True)
+        self.instance = DolibarrInstance.objects.create(
+            name="Hellbam",
+            slug="hellbam",
+            inbound_api_key="key-hellbam",
+            tickets_per_amount=1,
+            amount_step=100.00,
+            use_inbox=True,
+        )
+
+    def _post(self, payload):
+        return self.client.post(
+            self.url, payload, content_type='application/json', HTTP_AUTHORIZATION='Bearer key-hellbam',
+        )
+
+    def _payload(self, n, amount=200.00):
+        return {
+            'customer_identification': f'09{n:08d}',
+            'customer_name': f'Cliente {n}',
+            'total_amount': amount,
+            'ref': f'FA-{n}',
+            'facture_id': n,
+        }
+
+    def _drain(self, **options):
+        call_command('process_webhook_inbox', stdout=StringIO(), **options)
+
+    def test_webhook_returns_202_without_creating_tickets(self):
+        r = self._post(self._payload(1))
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(WebhookInboxItem.objects.get().id, r.json()['inbox_id'])
+        self.assertEqual(Ticket.objects.count(), 0)
+        self.assertEqual(DolibarrTransaction.objects.count(), 0)
+
+    def test_invalid_json_is_still_rejected_synchronously(self):
+        r = self.client.post(
+            self.url, 'not json', content_type='application/json', HTTP_AUTHORIZATION='Bearer key-hellbam',
+        )
+        self.assertEqual(r.status_code, 400)
+        self.assertFalse(WebhookInboxItem.objects.exists())
+
+    def test_worker_generates_tickets_and_keeps_idempotency(self):
+        self._post(self._payload(1))
+        self._post(self._payload(2, amount=100.00))
+        self._post(self._payload(1))  # Dolibarr retry of the same invoice
+
+        self._drain()
+
+        rows = list(WebhookInboxItem.objects.order_by('id'))
+        self.assertEqual([row.status for row in rows], ['done', 'done', 'done'])
+        self.assertEqual([row.result_status for row in rows], [201, 201, 409])
+        self.assertEqual(rows[0].result['ticket_ranges'], [[1, 2]])
+        self.assertEqual(rows[1].result['ticket_ranges'], [[3, 3]])
+        self.assertEqual(Ticket.objects.count(), 3)
+
+    def test_loop_survives_database_errors(self):
+        self._post(self._payload(1))
+        claims = iter([OperationalError('server closed the connection unexpectedly'), None, KeyboardInterrupt()])
+
+        def claim_batch(*args):
+            outcome = next(claims)
+            if outcome is not None:
+                raise outcome
+            return inbox.claim_batch(*args)
+
+        with mock.patch('raffles.management.commands.process_webhook_inbox.claim_batch', claim_batch), \
+                self.assertLogs('raffles.management.commands.process_webhook_inbox', 'ERROR'):
+            self._drain(loop=True, sleep=0)
+        self.assertEqual(WebhookInboxItem.objects.get().status, WebhookInboxItem.Status.DONE)
+
+        # Without --loop the error still stops the command.
+        with mock.patch('raffles.management.commands.process_webhook_inbox.claim_batch', side_effect=OperationalError):
+            with self.assertRaises(OperationalError):
+                self._drain()
+
+    def test_transient_failure_is_retried_with_backoff(self):
+        self.raffle.is_active = False
+        self.raffle.save()
+        self._post(self._payload(1))
+
+        self._drain()
+        row = WebhookInboxItem.objects.get()
+        self.assertEqual(row.status, WebhookInboxItem.Status.PENDING)
+        self.assertEqual(row.attempts, 1)
+        self.assertEqual(row.result_status, 500)
+        self.assertGreater(row.next_attempt_at, timezone.now())
+
+        # Not due yet: a second run leaves it alone.
+        self._drain()
+        self.assertEqual(WebhookInboxItem.objects.get().attempts, 1)
+
+        self.raffle.is_active = True
+        self.raffle.save()
+        WebhookInboxItem.objects.update(next_attempt_at=timezone.now())
+        self._drain()
+        row.refresh_from_db()
+        self.assertEqual(row.status, WebhookInboxItem.Status.DONE)
+        self.assertEqual(Ticket.objects.count(), 2)
+
+    @mock.patch('raffles.webhook.rebuild_ticket_counters')
+    def test_ticket_number_collision_stays_retryable(self, mock_rebuild):
+        Ticket.objects.create(
+            raffle=self.raffle, customer=Customer.objects.create(first_name="Manual"), ticket_number=1, price=0,
+        )
+        RaffleTicketCounter.objects.update_or_create(raffle=self.raffle, defaults={'last_number': 0})
+        self._post(self._payload(1))
+
+        self._drain()
+        row = WebhookInboxItem.objects.get()
+        self.assertEqual(row.status, WebhookInboxItem.Status.PENDING)
+        self.assertEqual(row.result_status, 503)
+        self.assertEqual(mock_rebuild.call_count, 1)
+        self.assertEqual(DolibarrTransaction.objects.count(), 0)
+
+    def test_exhausted_retries_go_to_dead_letter(self):
+        self.raffle.is_active = False
+        self.raffle.save()
+        self._post(self._payload(1))
+        self._drain(max_attempts=1)
+        self.assertEqual(WebhookInboxItem.objects.get().status, WebhookInboxItem.Status.DEAD)
+
+    def test_permanent_errors_go_straight_to_dead_letter(self):
+        self._post({'total_amount': 100.00, 'ref': 'NO-ID'})
+        self._drain()
+        row = WebhookInboxItem.objects.get()
+        self.assertEqual(row.status, WebhookInboxItem.Status.DEAD)
+        self.assertEqual(row.attempts, 1)
+        self.assertEqual(row.result_status, 400)
+
+    def test_claimed_rows_are_not_taken_twice_until_lease_expires(self):
+        self._post(self._payload(1))
+        first = inbox.claim_batch('worker-a', 10)
+        self.assertEqual(len(first), 1)
+        self.assertEqual(inbox.claim_batch('worker-b', 10), [])
+
+        WebhookInboxItem.objects.update(claimed_at=timezone.now() - dt.timedelta(seconds=600))
+        stolen = inbox.claim_batch('worker-b', 10, lease_seconds=300)
+        self.assertEqual([row.id for row in stolen], [first[0].id])
+        self.assertEqual(stolen[0].attempts, 2)
+
+    def test_batch_endpoint_queues_each_invoice(self):
+        r = self.client.post(
+            reverse('raffles:dolibarr_webhook_batch'),
+            {'invoices': [self._payload(1), self._payload(2)]},
+            content_type='application/json',
+            HTTP_AUTHORIZATION='Bearer key-hellbam',
+        )
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(len(r.json()['inbox_ids']), 2)
+        self._drain()
+        self.assertEqual(Ticket.objects.count(), 4)
@@ -0,0 +1,70 @@
+"""Per-stage latency of the webhook: Server-Timing header, log line and staff histograms."""
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import Client, TestCase
+from django.urls import reverse
+
+from raffles import metrics, timing
+from raffles.models import DolibarrInstance, Raffle
+
+
+class WebhookTimingTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.url = reverse('raffles:dolibarr_webhook')
+        Raffle.objects.create(name="Rifa Timing", year=2024, is_active=True)
+        DolibarrInstance.objects.create(
+            name="Hellbam", slug="hellbam", inbound_api_key="key-hellbam",
+            tickets_per_amount=1, amount_step=100.00,
+        )
+        timing.reset_histograms()
+
+    def _post(self, n):
+        return self.client.post(
+            self.url,
+            {'customer_identification': '0912345678', 'total_amount': 300.00, 'ref': f'FA-{n}', 'facture_id': n},
+            content_type='application/json',
+            HTTP_AUTHORIZATION='Bearer key-hellbam',
+        )
+
+    def test_server_timing_header_lists_every_stage(self):
+        with self.assertLogs('raffles.timing', level='INFO') as logs:
+            r = self._post(1)
+        self.assertEqual(r.status_code, 201)
+        stages = [part.split(';')[0] for part in r['Server-Timing'].split(', ')]
+        self.assertEqual(stages, list(timing.STAGES) + [timing.TOTAL])
+        self.assertIn('instance=hellbam status=201 invoices=1', logs.output[0])
+        self.assertIn(' lock=', logs.output[0])
+
+    def test_duplicate_stops_after_dedupe(self):
+        self._post(1)
+        r = self._post(1)
+        self.assertEqual(r.status_code, 409)
+        self.assertNotIn('insert;', r['Server-Timing'])
+        self.assertIn('dedupe;', r['Server-Timing'])
+
+    def test_histograms_never_reach_the_cache_during_the_request(self):
+        with mock.patch.object(metrics, 'cache') as metrics_cache:
+            for n in range(1, 4):
+                self.assertEqual(self._post(n).status_code, 201)
+        self.assertEqual(metrics_cache.mock_calls, [])
+        self.assertEqual(timing.read_histograms()['total']['count'], 3)
+
+    def test_histograms_accumulate_and_page_is_staff_only(self):
+        self._post(1)
+        self._post(2)
+        histograms = timing.read_histograms()
+        self.assertEqual(histograms['total']['count'], 2)
+        self.assertEqual(histograms['insert']['count'], 2)
+        self.assertEqual(sum(histograms['total']['buckets']), 2)
+
+        page = reverse('raffles:webhook_timings')
+        self.assertEqual(self.client.get(page).status_code, 302)
+        User.objects.create_user('staff', password='x', is_staff=True)
+        self.client.login(username='staff', password='x')
+        r = self.client.get(page)
+        self.assertContains(r, 'insert')
+
+        self.client.post(page)
+        self.assertEqual(timing.read_histograms(), {})
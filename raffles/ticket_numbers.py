@@ -0,0 +1,140 @@
+"""Per-raffle ticket number allocator.
+
+Numbers come from one `RaffleTicketCounter` row per raffle instead of a
+`Max(ticket_number)` scan over the raffle's tickets. A single
+``UPDATE ... RETURNING`` bumps the counter by N and yields the end of the
+block, so concurrent webhooks only serialize on that one short statement.
+
+Callers MUST allocate inside ``transaction.atomic()``: the counter row stays
+locked until commit, and a rollback gives the block back instead of leaving
+a gap in the numbering.
+"""
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Max
+
+from .models import Raffle, RaffleTicketCounter, Ticket
+
+
+def allocate_ticket_numbers(raffle_id, count):
+    """Reserve ``count`` contiguous numbers for the raffle and return them as
+    a ``range``. The counter row is created lazily (seeded from the current
+    highest ticket) the first time a raffle allocates."""
+    if count <= 0:
+        return range(0)
+
+    last = _bump(raffle_id, count)
+    if last is None:
+        _ensure_counter(raffle_id)
+        last = _bump(raffle_id, count)
+    return range(last - count + 1, last + 1)
+
+
+def sync_ticket_counter(raffle_id, ticket_number):
+    """Make sure the counter never falls behind a number assigned by hand
+    (admin edits, manual imports), so the next allocation does not collide."""
+    _ensure_counter(raffle_id)
+    RaffleTicketCounter.objects.filter(
+        raffle_id=raffle_id,
+        last_number__lt=ticket_number,
+    ).update(last_number=ticket_number)
+
+
+def rebuild_ticket_counters(raffle_ids=None):
+    """Recompute every counter from the existing Ticket rows.
+
+    Returns a list of ``(raffle, previous_last_number, new_last_number)``;
+    ``previous_last_number`` is None when the counter did not exist yet.
+    """
+    raffles = Raffle.objects.order_by('id')
+    if raffle_ids is not None:
+        raffles = raffles.filter(id__in=raffle_ids)
+
+    max_by_raffle = dict(
+        Ticket.objects
+        .filter(raffle__in=raffles)
+        .values_list('raffle_id')
+        .annotate(max_number=Max('ticket_number'))
+    )
+    previous = dict(
+        RaffleTicketCounter.objects
+        .filter(raffle__in=raffles)
+        .values_list('raffle_id', 'last_number')
+    )
+
+    changes = []
+    for raffle in raffles:
+        new_last = max_by_raffle.get(raffle.id) or 0
+        RaffleTicketCounter.objects.update_or_create(
+            raffle=raffle,
+            defaults={'last_number': new_last},
+        )
+        changes.append((raffle, previous.get(raffle.id), new_last))
+    return changes
+
+
+def to_ranges(numbers):
+    """Compact ``numbers`` into inclusive ``[first, last]`` pairs, e.g.
+    ``[1001, 1002, 1003, 1007]`` -> ``[[1001, 1003], [1007, 1007]]``.
+
+    Webhook blocks are contiguous, so a ``range`` costs O(1) regardless of
+    how many tickets an invoice bought."""
+    if isinstance(numbers, range) and numbers.step == 1:
+        return [[numbers.start, numbers.stop - 1]] if numbers else []
+    ranges = []
+    for number in sorted(numbers):
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ranges
+
+
+def from_ranges(ranges):
+    """Inverse of ``to_ranges``: the flat list of numbers."""
+    return [number for first, last in ranges for number in range(first, last + 1)]
+
+
+def _bump(raffle_id, count):
+    """Add ``count`` to the counter and return the new value, or None when the
+    raffle has no counter row yet."""
+    if _can_update_returning():
+        qn = connection.ops.quote_name
+        table = qn(RaffleTicketCounter._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET {qn('last_number')} = {qn('last_number')} + %s "
+                f"WHERE {qn('raffle_id')} = %s RETURNING {qn('last_number')}",
+                [count, raffle_id],
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    updated = RaffleTicketCounter.objects.filter(raffle_id=raffle_id).update(
+        last_number=F('last_number') + count,
+    )
+    if not updated:
+        return None
+    return RaffleTicketCounter.objects.values_list('last_number', flat=True).get(raffle_id=raffle_id)
+
+
+def _can_update_returning():
+    # PostgreSQL and SQLite >= 3.35 support UPDATE ... RETURNING. Django only
+    # has a flag for INSERT ... RETURNING, which MariaDB 10.5+ also sets
+    # without supporting it on UPDATE, hence the vendor check.
+    if connection.vendor == 'postgresql':
+        return True
+    return connection.vendor == 'sqlite' and connection.features.can_return_columns_from_insert
+
+
+def _ensure_counter(raffle_id):
+    if RaffleTicketCounter.objects.filter(raffle_id=raffle_id).exists():
+        return
+    current_max = Ticket.objects.filter(raffle_id=raffle_id).aggregate(
+        max_number=Max('ticket_number'),
+    )['max_number'] or 0
+    try:
+        with transaction.atomic():
+            RaffleTicketCounter.objects.create(raffle_id=raffle_id, last_number=current_max)
+    except IntegrityError:
+        # Another worker seeded it first; its value is just as good.
+        pass
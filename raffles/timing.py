@@ -0,0 +1,146 @@
+"""Stage-level latency of the Dolibarr webhook.
+
+A ``StageTimer`` travels with one request through the view and the pipeline
+in ``webhook``; each stage adds its wall time with ``perf_counter``. When the
+response is ready the view:
+
+- sends the durations in a ``Server-Timing`` header (visible in browser dev
+  tools and in curl -v from the Dolibarr host),
+- writes one ``DolibarrWebhookTiming:`` log line with ``stage=ms`` pairs,
+- adds them to histogram counters in ``raffles.metrics``, which only buffers
+  them in memory; its background thread pushes them to the cache, so the
+  request never waits on it.
+
+Stages:
+
+- ``auth``: API key resolution
+- ``parse``: JSON decoding
+- ``dedupe``: idempotency check (recent-invoice filter + DolibarrTransaction)
+- ``upsert``: DolibarrTransaction insert and customer upsert
+- ``lock``: the counter ``UPDATE``; this is where a webhook waits while another
+  one holds the raffle's counter row
+- ``alloc``: assigning the numbers and building the Ticket objects
+- ``insert``: ticket ``INSERT`` statements
+- ``commit``: COMMIT of the transaction
+- ``response``: JSON serialization of the response body
+"""
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('auth', 'parse', 'dedupe', 'upsert', 'lock', 'alloc', 'insert', 'commit', 'response')
+TOTAL = 'total'
+
+# Upper bounds in milliseconds; the last bucket catches everything above.
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class StageTimer:
+    """Accumulates milliseconds per stage for one request."""
+
+    __slots__ = ('durations', '_started')
+
+    def __init__(self):
+        self.durations = {}
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - started) * 1000)
+
+    def add(self, name, ms):
+        self.durations[name] = self.durations.get(name, 0.0) + ms
+
+    @property
+    def total_ms(self):
+        return (time.perf_counter() - self._started) * 1000
+
+    def header(self, total_ms=None):
+        total_ms = self.total_ms if total_ms is None else total_ms
+        parts = [f"{name};dur={self.durations[name]:.2f}" for name in STAGES if name in self.durations]
+        parts.append(f"{TOTAL};dur={total_ms:.2f}")
+        return ', '.join(parts)
+
+
+def finish(response, timer, instance_slug, invoices):
+    """Attach the Server-Timing header, log the breakdown and record it."""
+    total_ms = timer.total_ms
+    response['Server-Timing'] = timer.header(total_ms)
+    logger.info(
+        "DolibarrWebhookTiming: instance=%s status=%s invoices=%s total=%.2f %s",
+        instance_slug, response.status_code, invoices, total_ms,
+        ' '.join(f"{name}={timer.durations[name]:.2f}" for name in STAGES if name in timer.durations),
+    )
+    _observe(dict(timer.durations, **{TOTAL: total_ms}))
+    return response
+
+
+def counter_names(stage):
+    """Metric names of one stage's histogram: one per bucket plus count and sum."""
+    return [_bucket_name(stage, index) for index in range(len(BUCKETS_MS) + 1)] + [
+        f'timing.{stage}.count', f'timing.{stage}.sum_us',
+    ]
+
+
+def read_histograms():
+    """``{stage: {'count', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'buckets'}}``
+    for every stage with observations, from the shared counters."""
+    names = [name for stage in STAGES + (TOTAL,) for name in counter_names(stage)]
+    values = metrics.read(names)
+    result = {}
+    for stage in STAGES + (TOTAL,):
+        count = values[f'timing.{stage}.count']
+        if not count:
+            continue
+        buckets = [values[_bucket_name(stage, index)] for index in range(len(BUCKETS_MS) + 1)]
+        result[stage] = {
+            'count': count,
+            'mean_ms': round(values[f'timing.{stage}.sum_us'] / count / 1000, 2),
+            'p50_ms': _bucket_percentile(buckets, count, 50),
+            'p90_ms': _bucket_percentile(buckets, count, 90),
+            'p99_ms': _bucket_percentile(buckets, count, 99),
+            'buckets': buckets,
+        }
+    return result
+
+
+def reset_histograms():
+    metrics.reset([name for stage in STAGES + (TOTAL,) for name in counter_names(stage)])
+
+
+def bucket_labels():
+    return [f"≤{bound} ms" for bound in BUCKETS_MS] + [f">{BUCKETS_MS[-1]} ms"]
+
+
+def _observe(durations):
+    counts = {}
+    for stage, ms in durations.items():
+        counts[_bucket_name(stage, bisect.bisect_left(BUCKETS_MS, ms))] = 1
+        counts[f'timing.{stage}.count'] = 1
+        counts[f'timing.{stage}.sum_us'] = int(ms * 1000)
+    metrics.incr_many(counts)
+
+
+def _bucket_name(stage, index):
+    return f'timing.{stage}.bucket_{index}'
+
+
+def _bucket_percentile(buckets, count, pct):
+    """Upper bound (ms) of the bucket holding the pct-th observation; None
+    when it falls in the open-ended last bucket."""
+    target = pct / 100 * count
+    seen = 0
+    for index, n in enumerate(buckets):
+        seen += n
+        if seen >= target:
+            return BUCKETS_MS[index] if index < len(BUCKETS_MS) else None
+    return None
@@ -8,9 +8,17 @@ urlpatterns = [
     path('ticket/<int:ticket_id>/', views.generate_ticket, name='generate_ticket'),
     path('verify/<uuid:qr_code>/', views.verify_ticket, name='verify_ticket'),
     path('api/dolibarr/webhook/', views.DolibarrWebhookView.as_view(), name='dolibarr_webhook'),
+    path('api/dolibarr/webhook/async/', views.AsyncDolibarrWebhookView.as_view(), name='dolibarr_webhook_async'),
+    path('api/dolibarr/webhook/batch/', views.DolibarrWebhookBatchView.as_view(), name='dolibarr_webhook_batch'),
+    path('api/dolibarr/webhook/timings/', views.webhook_timings, name='webhook_timings'),
 
     # Draw panel (staff only)
     path('<int:raffle_id>/draw/', views.raffle_draw_dashboard, name='raffle_draw_dashboard'),
+    path('<int:raffle_id>/draw/payment-refresh/', views.payment_refresh_status, name='payment_refresh_status'),
+    path('<int:raffle_id>/draw/payment-refresh/stream/', views.payment_refresh_stream, name='payment_refresh_stream'),
+    path('<int:raffle_id>/draw/freeze/', views.freeze_draw_pool, name='freeze_draw_pool'),
+    path('<int:raffle_id>/draw/release/', views.release_draw_pool, name='release_draw_pool'),
+    path('<int:raffle_id>/draw/all/', views.draw_all_prizes, name='draw_all_prizes'),
     path('<int:raffle_id>/prize/<int:prize_id>/draw/', views.execute_prize_draw, name='execute_prize_draw'),
     path('<int:raffle_id>/prize/<int:prize_id>/discard/', views.discard_winner, name='discard_winner'),
     path('<int:raffle_id>/winners/', views.winners_list, name='winners_list'),
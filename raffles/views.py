@@ -1,31 +1,37 @@
 import json
 import logging
-import secrets
+import time
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
-from django.db import IntegrityError, transaction
-from django.db.models import Max
-from django.http import JsonResponse
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Prefetch
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.decorators import method_decorator
+from django.utils.timesince import timesince
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.views.generic import TemplateView
 
-from .dolibarr_client import is_invoice_paid
+from . import breaker, draw, inbox, metrics, payment_refresh, ratelimit, resolver, timing
+from .dolibarr_client import ticket_payment_statuses
 from .models import (
-    Customer,
     DolibarrInstance,
-    DolibarrTransaction,
     Prize,
     Raffle,
     Ticket,
     WinnerDiscard,
 )
+from .ticket_numbers import from_ranges
+from .timing import StageTimer
+from .webhook import InvoiceItem, aprocess_invoices, process_invoices
 
 logger = logging.getLogger(__name__)
 
@@ -118,277 +124,365 @@ def _parse_bearer(request):
     return None
 
 
+def _authenticate(request, generation):
+    """Resolve the DolibarrInstance behind the request's bearer token.
+    Returns ``(instance, None)`` or ``(None, error_response)``; ``instance``
+    is a cached ``resolver.InstanceSnapshot``, not a model object.
+    ``generation`` is the request's ``resolver.generation()``."""
+    token = _parse_bearer(request)
+    if not token:
+        logger.warning("DolibarrWebhook: No authorization token provided")
+        return None, JsonResponse({'error': 'Unauthorized - No token provided'}, status=401)
+
+    instance = resolver.instance_for_key(token, generation)
+    if instance is None:
+        logger.warning(
+            "DolibarrWebhook: Unknown or inactive inbound_api_key (received length=%s)",
+            len(token),
+        )
+        return None, JsonResponse({'error': 'Unauthorized - Invalid API key'}, status=401)
+
+    logger.info("DolibarrWebhook: Authentication successful - instance=%s", instance.slug)
+    return instance, None
+
+
+def _response_body(request, body):
+    """Tickets are reported as ``ticket_ranges`` (``[[first, last], ...]``);
+    clients that still need every number ask for it with ``?ticket_numbers=1``."""
+    if request.GET.get('ticket_numbers') in ('1', 'true') and 'ticket_ranges' in body:
+        body = dict(body, ticket_numbers=from_ranges(body['ticket_ranges']))
+    return body
+
+
+def _throttled(retry_after):
+    response = JsonResponse({'error': 'Rate limit exceeded', 'retry_after': retry_after}, status=429)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class DolibarrWebhookView(View):
     def post(self, request, *args, **kwargs):
         logger.info("DolibarrWebhook: Received request")
+        timer = StageTimer()
 
-        token = _parse_bearer(request)
-        if not token:
-            logger.warning("DolibarrWebhook: No authorization token provided")
-            return JsonResponse({'error': 'Unauthorized - No token provided'}, status=401)
+        with timer.stage('auth'):
+            generation = resolver.generation()
+            instance, error_response = _authenticate(request, generation)
+        if error_response is not None:
+            return error_response
+        admitted, retry_after = ratelimit.admit(instance)
+        if not admitted:
+            return _throttled(retry_after)
 
         try:
-            instance = DolibarrInstance.objects.get(inbound_api_key=token, is_active=True)
-        except DolibarrInstance.DoesNotExist:
-            logger.warning(
-                "DolibarrWebhook: Unknown or inactive inbound_api_key (received length=%s)",
-                len(token),
-            )
-            return JsonResponse({'error': 'Unauthorized - Invalid API key'}, status=401)
-
-        logger.info("DolibarrWebhook: Authentication successful - instance=%s", instance.slug)
-
-        try:
-            data = json.loads(request.body)
+            with timer.stage('parse'):
+                data = json.loads(request.body)
         except json.JSONDecodeError as e:
             logger.error(f"DolibarrWebhook: Invalid JSON - {str(e)}")
-            return JsonResponse({'error': 'Invalid JSON'}, status=400)
-
-        identification = data.get('customer_identification') or data.get('customer_id')
-        name = data.get('customer_name', 'Unknown')
-        amount_raw = data.get('total_amount', 0)
-        external_id = data.get('customer_id', '')
-        ref = data.get('ref', '')
-        facture_id = data.get('facture_id')
+            return timing.finish(JsonResponse({'error': 'Invalid JSON'}, status=400), timer, instance.slug, 1)
+
+        if instance.use_inbox:
+            row, = inbox.enqueue(instance, [request.body.decode('utf-8', errors='replace')])
+            logger.info("DolibarrWebhook: Queued in inbox - instance=%s inbox_id=%s", instance.slug, row.id)
+            with timer.stage('response'):
+                response = JsonResponse({
+                    'message': 'Invoice queued for processing',
+                    'inbox_id': row.id,
+                    'instance': instance.slug,
+                }, status=202)
+            return timing.finish(response, timer, instance.slug, 1)
+
+        item = InvoiceItem(data)
+        process_invoices(instance, [item], generation, timer)
+        with timer.stage('response'):
+            response = JsonResponse(_response_body(request, item.body), status=item.status)
+        return timing.finish(response, timer, instance.slug, 1)
+
+
+async def _aauthenticate(request, generation):
+    """``_authenticate`` for async views."""
+    token = _parse_bearer(request)
+    if not token:
+        logger.warning("DolibarrWebhook: No authorization token provided")
+        return None, JsonResponse({'error': 'Unauthorized - No token provided'}, status=401)
+
+    instance = await resolver.ainstance_for_key(token, generation)
+    if instance is None:
+        logger.warning(
+            "DolibarrWebhook: Unknown or inactive inbound_api_key (received length=%s)",
+            len(token),
+        )
+        return None, JsonResponse({'error': 'Unauthorized - Invalid API key'}, status=401)
 
-        try:
-            facture_id = int(facture_id) if facture_id else None
-        except (ValueError, TypeError):
-            facture_id = None
+    logger.info("DolibarrWebhook: Authentication successful - instance=%s", instance.slug)
+    return instance, None
 
-        logger.info(
-            "DolibarrWebhook: Processing request - instance=%s ref=%s facture_id=%s customer=%s amount=%s",
-            instance.slug, ref, facture_id, name, amount_raw,
-        )
 
-        if not identification:
-            logger.warning("DolibarrWebhook: Missing customer identification")
-            return JsonResponse({'error': 'Missing customer identification'}, status=400)
-
-        # Idempotency: per-instance match on ref or facture_id
-        existing_transaction = None
-        if ref or facture_id is not None:
-            qs = DolibarrTransaction.objects.filter(instance=instance)
-            if ref and facture_id is not None:
-                existing_transaction = qs.filter(ref=ref).first() or qs.filter(facture_id=facture_id).first()
-            elif ref:
-                existing_transaction = qs.filter(ref=ref).first()
-            else:
-                existing_transaction = qs.filter(facture_id=facture_id).first()
-
-        if existing_transaction:
-            logger.info(
-                "DolibarrWebhook: Transaction already processed - instance=%s ref=%s facture_id=%s existing_ref=%s tickets_count=%s",
-                instance.slug, ref, facture_id, existing_transaction.ref, existing_transaction.tickets_count,
-            )
-            return JsonResponse({
-                'error': 'Transaction already processed',
-                'ref': existing_transaction.ref,
-                'tickets_previously_generated': existing_transaction.tickets_count,
-            }, status=409)
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncDolibarrWebhookView(View):
+    """Same contract as DolibarrWebhookView for ASGI deployments (uvicorn,
+    daphne). Lookups use the async ORM, so a webhook only holds a worker
+    thread while it records the transaction and allocates and inserts its
+    tickets. Under WSGI Django runs it through async_to_sync, which works but
+    gains nothing over the sync view."""
+
+    async def post(self, request, *args, **kwargs):
+        logger.info("DolibarrWebhook: Received request (async)")
+        timer = StageTimer()
+
+        with timer.stage('auth'):
+            generation = await resolver.ageneration()
+            instance, error_response = await _aauthenticate(request, generation)
+        if error_response is not None:
+            return error_response
+        admitted, retry_after = await ratelimit.aadmit(instance)
+        if not admitted:
+            return _throttled(retry_after)
 
         try:
-            amount = float(amount_raw)
-        except (ValueError, TypeError):
-            logger.error(f"DolibarrWebhook: Invalid amount value - {amount_raw}")
-            return JsonResponse({'error': 'Invalid amount'}, status=400)
+            with timer.stage('parse'):
+                data = json.loads(request.body)
+        except json.JSONDecodeError as e:
+            logger.error(f"DolibarrWebhook: Invalid JSON - {str(e)}")
+            response = JsonResponse({'error': 'Invalid JSON'}, status=400)
+            return timing.finish(response, timer, instance.slug, 1)
+
+        if instance.use_inbox:
+            row, = await sync_to_async(inbox.enqueue)(instance, [request.body.decode('utf-8', errors='replace')])
+            logger.info("DolibarrWebhook: Queued in inbox - instance=%s inbox_id=%s", instance.slug, row.id)
+            with timer.stage('response'):
+                response = JsonResponse({
+                    'message': 'Invoice queued for processing',
+                    'inbox_id': row.id,
+                    'instance': instance.slug,
+                }, status=202)
+        else:
+            item = InvoiceItem(data)
+            await aprocess_invoices(instance, [item], generation, timer)
+            with timer.stage('response'):
+                response = JsonResponse(_response_body(request, item.body), status=item.status)
+
+        return timing.finish(response, timer, instance.slug, 1)
 
-        active_raffle = Raffle.objects.filter(is_active=True).first()
-        if not active_raffle:
-            logger.error("DolibarrWebhook: No active raffle configured (set Raffle.is_active=True on one row)")
-            return JsonResponse({'error': 'No active raffle configured'}, status=500)
 
-        amount_step = float(instance.amount_step)
-        if amount_step <= 0:
-            logger.error(f"DolibarrWebhook: Invalid amount_step configuration on instance={instance.slug} - {amount_step}")
-            return JsonResponse({'error': 'Invalid configuration (amount_step)'}, status=500)
+@method_decorator(csrf_exempt, name='dispatch')
+class DolibarrWebhookBatchView(View):
+    """Many invoices in one request: ``{"invoices": [{...}, {...}]}``.
+
+    Authenticates once, applies the per-invoice idempotency rules of the
+    single webhook and allocates ticket numbers for the whole batch in one
+    block. Answers 200 with one result per invoice, in input order; each
+    result carries the HTTP status the single webhook would have used.
+    Instances with ``use_inbox`` get a 202 and the invoices are queued instead.
+    """
+    max_invoices = 500
 
-        tickets_to_generate = int(amount / amount_step) * instance.tickets_per_amount
+    def post(self, request, *args, **kwargs):
+        logger.info("DolibarrWebhookBatch: Received request")
+        timer = StageTimer()
 
-        logger.info(
-            "DolibarrWebhook: Calculated tickets - instance=%s amount=%s amount_step=%s tickets_per_amount=%s tickets_to_generate=%s",
-            instance.slug, amount, amount_step, instance.tickets_per_amount, tickets_to_generate,
-        )
+        with timer.stage('auth'):
+            generation = resolver.generation()
+            instance, error_response = _authenticate(request, generation)
+        if error_response is not None:
+            return error_response
 
-        if tickets_to_generate <= 0:
-            logger.info(
-                "DolibarrWebhook: No tickets to generate (amount insufficient) - instance=%s amount=%s required=%s",
-                instance.slug, amount, amount_step,
+        try:
+            with timer.stage('parse'):
+                data = json.loads(request.body)
+        except json.JSONDecodeError as e:
+            logger.error(f"DolibarrWebhookBatch: Invalid JSON - {str(e)}")
+            return timing.finish(JsonResponse({'error': 'Invalid JSON'}, status=400), timer, instance.slug, 0)
+
+        invoices = data.get('invoices') if isinstance(data, dict) else None
+        if not isinstance(invoices, list):
+            response = JsonResponse({'error': "Expected an 'invoices' array"}, status=400)
+            return timing.finish(response, timer, instance.slug, 0)
+        if len(invoices) > self.max_invoices:
+            response = JsonResponse(
+                {'error': f'Too many invoices in one batch (max {self.max_invoices})'},
+                status=413,
             )
-            return JsonResponse({
-                'message': 'No tickets generated (amount insufficient)',
-                'tickets_generated': 0,
-                'amount_received': amount,
-                'amount_required': amount_step,
+            return timing.finish(response, timer, instance.slug, len(invoices))
+        admitted, retry_after = ratelimit.admit(instance, cost=len(invoices))
+        if not admitted:
+            return _throttled(retry_after)
+
+        if instance.use_inbox:
+            rows = inbox.enqueue(instance, [json.dumps(invoice) for invoice in invoices])
+            logger.info("DolibarrWebhookBatch: Queued %s invoices in inbox - instance=%s", len(rows), instance.slug)
+            with timer.stage('response'):
+                response = JsonResponse({
+                    'message': 'Invoices queued for processing',
+                    'instance': instance.slug,
+                    'count': len(rows),
+                    'inbox_ids': [row.id for row in rows],
+                }, status=202)
+            return timing.finish(response, timer, instance.slug, len(rows))
+
+        items = process_invoices(instance, [InvoiceItem(invoice) for invoice in invoices], generation, timer)
+        results = [
+            {
+                'index': index, 'status': item.status, 'ref': item.ref, 'facture_id': item.facture_id,
+                **_response_body(request, item.body),
+            }
+            for index, item in enumerate(items)
+        ]
+        logger.info(
+            "DolibarrWebhookBatch: Processed %s invoices - instance=%s created=%s duplicates=%s",
+            len(items), instance.slug,
+            sum(1 for item in items if item.status == 201),
+            sum(1 for item in items if item.status == 409),
+        )
+        with timer.stage('response'):
+            response = JsonResponse({
+                'instance': instance.slug,
+                'count': len(results),
+                'tickets_generated': sum(item.body.get('tickets_generated', 0) for item in items),
+                'results': results,
             }, status=200)
+        return timing.finish(response, timer, instance.slug, len(items))
 
-        try:
-            with transaction.atomic():
-                tx = None
-                if ref or facture_id is not None:
-                    tx = DolibarrTransaction.objects.create(
-                        instance=instance,
-                        ref=ref or '',
-                        facture_id=facture_id,
-                        amount=amount,
-                        tickets_count=tickets_to_generate,
-                    )
-                    logger.info(
-                        "DolibarrWebhook: Created transaction record - instance=%s ref=%s facture_id=%s",
-                        instance.slug, ref, facture_id,
-                    )
 
-                customer_defaults = {
-                    'first_name': name,
-                    'email': data.get('customer_email', ''),
-                    'phone': data.get('customer_phone', ''),
-                    'address': data.get('customer_address', ''),
-                    'additional_info': f"Imported from Dolibarr (instance={instance.slug}, ID: {external_id})",
-                }
-
-                customer, created = Customer.objects.get_or_create(
-                    identification=identification,
-                    defaults=customer_defaults,
-                )
-
-                if created:
-                    logger.info(f"DolibarrWebhook: Created new customer - identification={identification}")
-                else:
-                    customer.first_name = name
-                    customer.email = data.get('customer_email', customer.email)
-                    customer.phone = data.get('customer_phone', customer.phone)
-                    customer.address = data.get('customer_address', customer.address)
-                    customer.save()
-                    logger.info(f"DolibarrWebhook: Updated existing customer - identification={identification}")
-
-                raffle = Raffle.objects.select_for_update().get(pk=active_raffle.pk)
-
-                max_ticket = Ticket.objects.filter(raffle=raffle).aggregate(Max('ticket_number'))['ticket_number__max']
-                current_number = (max_ticket or 0) + 1
-
-                logger.info(
-                    "DolibarrWebhook: Starting ticket creation - instance=%s raffle=%s starting_number=%s",
-                    instance.slug, raffle.name, current_number,
-                )
-
-                created_tickets = []
-                for _ in range(tickets_to_generate):
-                    ticket = Ticket.objects.create(
-                        raffle=raffle,
-                        customer=customer,
-                        ticket_number=current_number,
-                        price=instance.default_ticket_price,
-                        dolibarr_transaction=tx,
-                    )
-                    created_tickets.append(ticket.ticket_number)
-                    current_number += 1
-
-                logger.info(
-                    "DolibarrWebhook: Successfully created %s tickets - instance=%s numbers=%s",
-                    len(created_tickets), instance.slug, created_tickets,
-                )
-
-            return JsonResponse({
-                'message': 'Tickets generated successfully',
-                'customer': customer.first_name,
-                'tickets_generated': len(created_tickets),
-                'ticket_numbers': created_tickets,
-                'raffle': raffle.name,
-                'instance': instance.slug,
-                'ref': ref,
-            }, status=201)
-
-        except IntegrityError as e:
-            # Race: another concurrent webhook for the same (instance, ref/facture_id) won
-            logger.warning(
-                "DolibarrWebhook: IntegrityError (race or duplicate) - instance=%s ref=%s facture_id=%s - %s",
-                instance.slug, ref, facture_id, e,
+@staff_member_required
+def webhook_timings(request):
+    """Staff page with the webhook's per-stage latency histograms (see
+    ``raffles.timing``), the operational counters from ``raffles.metrics`` and
+    the admitted/throttled counts of each instance's rate limiter."""
+    instances = list(DolibarrInstance.objects.order_by('name'))
+    if request.method == 'POST':
+        timing.reset_histograms()
+        metrics.reset()
+        metrics.reset([
+            ratelimit.counter_name(instance.slug, outcome)
+            for instance in instances for outcome in ('admitted', 'throttled')
+        ])
+        messages.success(request, "Histogramas y contadores reiniciados.")
+        return redirect('raffles:webhook_timings')
+
+    histograms = timing.read_histograms()
+    rows = [
+        {'stage': stage, **histograms[stage]}
+        for stage in timing.STAGES + (timing.TOTAL,)
+        if stage in histograms
+    ]
+    context = {
+        'rows': rows,
+        'bucket_labels': timing.bucket_labels(),
+        'counters': metrics.read(),
+        'rate_limits': [
+            {'instance': instance, **counts}
+            for instance, counts in zip(
+                instances, ratelimit.read_counters([instance.slug for instance in instances]).values(),
             )
-            return JsonResponse({'error': 'Transaction already processed (race)'}, status=409)
-
-        except Exception as e:
-            logger.error(f"DolibarrWebhook: Error creating tickets - {str(e)}", exc_info=True)
-            return JsonResponse({'error': f'Error creating tickets: {str(e)}'}, status=500)
+        ],
+    }
+    return render(request, 'raffles/webhook_timings.html', context)
 
 
 # -----------------------------------------------------------------------------
 # Draw panel (staff only)
 # -----------------------------------------------------------------------------
 
-def _eligible_pool(raffle, exclude_unpaid=True, force_refresh=False):
-    """Build the queryset of tickets eligible for the next draw and a parallel
-    list of unverified-payment tickets so the UI can show counters.
-
-    Exclusions:
-    - already winners in another Prize of the same raffle,
-    - any ticket present in a WinnerDiscard for prizes of this raffle,
-    - optionally, tickets whose source invoice is not paid in Dolibarr.
-    """
-    locked_winner_ids = list(
-        raffle.prizes.exclude(winning_ticket__isnull=True).values_list('winning_ticket_id', flat=True)
+def _pool_counts(raffle):
+    """The dashboard counters in one GROUP BY over the pool, without loading
+    tickets: ``(counts, instances)`` where ``counts`` is ``{instance_id or
+    None: {True: n, False: n, None: n}}`` by stored payment status, with the
+    same None cases as `ticket_payment_statuses`, and ``instances`` the
+    DolibarrInstances by id."""
+    rows = (
+        draw.pool(raffle)
+        .values('dolibarr_transaction__instance_id', 'dolibarr_transaction__payment_status__is_paid')
+        .annotate(tickets=Count('pk'))
+        .order_by()
     )
-    discarded_ids = list(
-        WinnerDiscard.objects.filter(prize__raffle=raffle).values_list('ticket_id', flat=True)
+    counts = {}
+    for row in rows:
+        by_status = counts.setdefault(row['dolibarr_transaction__instance_id'], {True: 0, False: 0, None: 0})
+        by_status[row['dolibarr_transaction__payment_status__is_paid']] += row['tickets']
+
+    instances = DolibarrInstance.objects.in_bulk([instance_id for instance_id in counts if instance_id is not None])
+    for instance_id, instance in instances.items():
+        if not instance.outbound_api_url or not instance.outbound_api_key:
+            # A stored answer is not trusted once the credentials are gone.
+            by_status = counts[instance_id]
+            counts[instance_id] = {True: 0, False: 0, None: sum(by_status.values())}
+    return counts, instances
+
+
+def _pool_summary(counts, instances):
+    """The pool counters of the draw panel from `_pool_counts`."""
+    instances_summary = sorted(
+        (instances[instance_id].slug if instance_id is not None else 'manual', sum(by_status.values()))
+        for instance_id, by_status in counts.items()
     )
-
-    qs = (
-        Ticket.objects
-        .filter(raffle=raffle)
-        .exclude(id__in=locked_winner_ids)
-        .exclude(id__in=discarded_ids)
-        .select_related('customer', 'dolibarr_transaction__instance')
-    )
-
-    if not exclude_unpaid:
-        return list(qs), []
-
-    eligible = []
-    unverified = []
-    for ticket in qs:
-        status = is_invoice_paid(ticket, force_refresh=force_refresh)
-        if status is True:
-            eligible.append(ticket)
-        elif status is None:
-            unverified.append(ticket)
-        # status is False -> dropped
-    return eligible, unverified
+    return {
+        'eligible_count': sum(by_status[True] for by_status in counts.values()),
+        'unverified_count': sum(by_status[None] for by_status in counts.values()),
+        'total_pool_count': sum(count for _, count in instances_summary),
+        'instances_summary': instances_summary,
+    }
 
 
 @staff_member_required
 def raffle_draw_dashboard(request, raffle_id):
     raffle = get_object_or_404(Raffle, pk=raffle_id)
-    force = request.GET.get('refresh') == '1'
-
-    prizes = list(raffle.prizes.select_related('winning_ticket__customer', 'winning_ticket__dolibarr_transaction__instance').order_by('position'))
-
-    eligible, unverified = _eligible_pool(raffle, exclude_unpaid=True, force_refresh=force)
-    all_pool, _ = _eligible_pool(raffle, exclude_unpaid=False, force_refresh=False)
-
-    instances_summary = {}
-    for ticket in all_pool:
-        slug = ticket.dolibarr_transaction.instance.slug if ticket.dolibarr_transaction_id and ticket.dolibarr_transaction.instance_id else 'manual'
-        instances_summary[slug] = instances_summary.get(slug, 0) + 1
+    if request.GET.get('refresh') == '1':
+        payment_refresh.start(raffle.id, force=True)
+        messages.info(request, "Verificando los pagos contra Dolibarr en segundo plano; los contadores se actualizan al terminar.")
+        return redirect('raffles:raffle_draw_dashboard', raffle_id=raffle.id)
 
+    prizes = list(raffle.prizes.select_related(
+        'winning_ticket__customer',
+        'winning_ticket__dolibarr_transaction__instance',
+        'winning_ticket__dolibarr_transaction__payment_status',
+    ).prefetch_related(
+        # Every prize's discards in one query instead of one per prize.
+        Prefetch(
+            'discards',
+            queryset=WinnerDiscard.objects.select_related('ticket', 'discarded_by').order_by('-created_at'),
+            to_attr='discard_history',
+        ),
+    ).order_by('position'))
+
+    counts, instances = _pool_counts(raffle)
+    winners = [prize.winning_ticket for prize in prizes if prize.winning_ticket_id]
+
+    # Serve the stored statuses as they are and refresh the due ones behind.
+    freshness = payment_refresh.raffle_freshness(raffle.id)
+    refresh_job = payment_refresh.status(raffle.id)
+    if freshness['refresh_due'] and not (refresh_job and refresh_job['state'] == payment_refresh.RUNNING):
+        refresh_job = payment_refresh.start(raffle.id)
+
+    # Instances whose Dolibarr is failing: their tickets stay unverified.
+    breakers = []
+    for instance in sorted(instances.values(), key=lambda instance: instance.slug):
+        state = breaker.status(instance)
+        if state['state'] != breaker.CLOSED:
+            breakers.append(dict(state, instance=instance))
+
+    winner_statuses = ticket_payment_statuses(winners)
     prize_states = []
     for prize in prizes:
-        payment_status = None
-        if prize.winning_ticket_id:
-            payment_status = is_invoice_paid(prize.winning_ticket, force_refresh=force)
         prize_states.append({
             'prize': prize,
-            'payment_status': payment_status,
+            'payment_status': winner_statuses.get(prize.winning_ticket_id),
             'discard_reasons': WinnerDiscard.Reason.choices,
-            'discard_history': list(prize.discards.select_related('ticket', 'discarded_by').order_by('-created_at')),
+            'discard_history': prize.discard_history,
         })
 
     context = {
         'raffle': raffle,
         'prize_states': prize_states,
-        'eligible_count': len(eligible),
-        'unverified_count': len(unverified),
-        'total_pool_count': len(all_pool),
-        'instances_summary': sorted(instances_summary.items()),
+        **_pool_summary(counts, instances),
+        'breakers': breakers,
+        'pool_snapshot': draw.active_snapshot(raffle),
+        'oldest_check': freshness['oldest_check'],
+        'stale_count': freshness['stale'],
+        'refresh_job': refresh_job,
+        'refresh_stream_url': reverse('raffles:payment_refresh_stream', args=[raffle.id]),
+        'refresh_status_url': reverse('raffles:payment_refresh_status', args=[raffle.id]),
         'force_refresh_url': f"{reverse('raffles:raffle_draw_dashboard', args=[raffle.id])}?refresh=1",
         'all_drawn': all(p.winning_ticket_id for p in prizes) and bool(prizes),
         'no_prizes_yet': not prizes,
@@ -396,6 +490,96 @@ def raffle_draw_dashboard(request, raffle_id):
     return render(request, 'raffles/draw_dashboard.html', context)
 
 
+@staff_member_required
+def payment_refresh_status(request, raffle_id):
+    """Progress of the raffle's payment refresh job as JSON, with the fresh
+    pool counters once it is no longer running. The panel polls it when no
+    `payment_refresh_stream` slot is free."""
+    raffle = get_object_or_404(Raffle, pk=raffle_id)
+    job = payment_refresh.status(raffle.id) or {'state': 'idle'}
+    if job['state'] != payment_refresh.RUNNING:
+        job = dict(job, summary=_refresh_summary(raffle))
+    return JsonResponse(job)
+
+
+_STREAM_POLL_SECONDS = 0.5
+_STREAM_RETRY_MS = 1000
+_STREAM_SLOT_KEY = 'raffles:payment_refresh_stream:{}'
+
+
+@staff_member_required
+def payment_refresh_stream(request, raffle_id):
+    """Server-sent events with the progress of the raffle's payment refresh
+    job: a ``progress`` event whenever the job changes and, once it is no
+    longer running, a ``done`` event carrying the fresh pool counters (or
+    ``idle`` when the raffle has no job at all).
+
+    Each open stream holds a sync gunicorn worker, so at most
+    ``RAFFLES_PAYMENT_STREAM_MAX`` (default 1) are open across all workers
+    and each lasts at most ``RAFFLES_PAYMENT_STREAM_SECONDS`` (default 15);
+    the browser's EventSource then reconnects. When every slot is taken the
+    answer is 204, which stops the EventSource, and the panel polls
+    `payment_refresh_status` instead."""
+    raffle = get_object_or_404(Raffle, pk=raffle_id)
+    seconds = getattr(settings, 'RAFFLES_PAYMENT_STREAM_SECONDS', 15)
+    slot = _take_stream_slot(seconds)
+    if slot is None:
+        return HttpResponse(status=204)
+    response = StreamingHttpResponse(_refresh_events(raffle, slot, seconds), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx would hold the events back
+    return response
+
+
+def _take_stream_slot(seconds):
+    """A free stream slot key, taken in the shared cache, or None. Slots
+    expire shortly after the longest stream in case one is never released."""
+    for n in range(getattr(settings, 'RAFFLES_PAYMENT_STREAM_MAX', 1)):
+        key = _STREAM_SLOT_KEY.format(n)
+        if cache.add(key, 1, seconds + 10):
+            return key
+    return None
+
+
+def _refresh_events(raffle, slot, seconds):
+    deadline = time.monotonic() + seconds
+    try:
+        yield f"retry: {_STREAM_RETRY_MS}\n\n"
+        last = None
+        while True:
+            job = payment_refresh.status(raffle.id)
+            if job is None:
+                yield _sse('idle', {'state': 'idle'})
+                return
+            if job['state'] != payment_refresh.RUNNING:
+                yield _sse('done', dict(job, summary=_refresh_summary(raffle)))
+                return
+            if job != last:
+                yield _sse('progress', job)
+                last = job
+            if time.monotonic() >= deadline:
+                return
+            time.sleep(_STREAM_POLL_SECONDS)
+    finally:
+        cache.delete(slot)
+
+
+def _refresh_summary(raffle):
+    """The pool counters of the panel, as the page updates them in place."""
+    counts, instances = _pool_counts(raffle)
+    summary = _pool_summary(counts, instances)
+    freshness = payment_refresh.raffle_freshness(raffle.id)
+    summary.update(
+        oldest_check=timesince(freshness['oldest_check']) if freshness['oldest_check'] else None,
+        stale_count=freshness['stale'],
+    )
+    return summary
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
 @staff_member_required
 @require_POST
 def execute_prize_draw(request, raffle_id, prize_id):
@@ -414,21 +598,92 @@ def execute_prize_draw(request, raffle_id, prize_id):
                 'error': 'Este premio ya tiene un ganador. Descártalo antes de re-sortear.',
             }, status=409)
 
-        eligible, _ = _eligible_pool(raffle, exclude_unpaid=exclude_unpaid, force_refresh=False)
-        if not eligible:
+        snapshot = draw.active_snapshot(raffle)
+        if snapshot is not None:
+            if _snapshot_mismatch(request, snapshot):
+                return _snapshot_mismatch_response(snapshot)
+            winner = draw.pick_from_snapshot(snapshot)
+        else:
+            winner = draw.pick(draw.eligible(raffle, exclude_unpaid=exclude_unpaid))
+        if winner is None:
             return JsonResponse({
                 'error': 'No quedan boletos elegibles en el pool (¿factura impaga, descartes previos?).',
             }, status=409)
 
-        winner = secrets.choice(eligible)  # CSPRNG, not Mersenne Twister
         prize.winning_ticket = winner
         prize.drawn_at = timezone.now()
         prize.save(update_fields=['winning_ticket', 'drawn_at'])
 
-    tx = winner.dolibarr_transaction
-    instance_slug = tx.instance.slug if tx and tx.instance_id else None
+    return JsonResponse(_winner_body(prize, winner, snapshot, exclude_unpaid))
+
+
+@staff_member_required
+@require_POST
+def draw_all_prizes(request, raffle_id):
+    """Draw every undrawn prize of the raffle, or the ``prize_id`` ones, in
+    one transaction: a single pool computation, sampled without replacement,
+    winners assigned in position order. Nothing is drawn if the pool is
+    smaller than the prize list."""
+    raffle = get_object_or_404(Raffle, pk=raffle_id)
+    exclude_unpaid = request.POST.get('exclude_unpaid', '1') == '1'
+    try:
+        prize_ids = [int(prize_id) for prize_id in request.POST.getlist('prize_id')]
+    except ValueError:
+        return JsonResponse({'error': 'prize_id inválido.'}, status=400)
+
+    with transaction.atomic():
+        prizes = Prize.objects.select_for_update().filter(raffle=raffle, winning_ticket__isnull=True)
+        if prize_ids:
+            prizes = prizes.filter(pk__in=prize_ids)
+        prizes = list(prizes.order_by('position'))
+        if not prizes:
+            return JsonResponse({'error': 'No hay premios pendientes de sortear.'}, status=409)
+
+        snapshot = draw.active_snapshot(raffle)
+        if snapshot is not None:
+            if _snapshot_mismatch(request, snapshot):
+                return _snapshot_mismatch_response(snapshot)
+            winners = draw.pick_many_from_snapshot(snapshot, len(prizes))
+        else:
+            winners = draw.pick_many(draw.eligible(raffle, exclude_unpaid=exclude_unpaid), len(prizes))
+        if winners is None:
+            return JsonResponse({
+                'error': f'No quedan boletos elegibles suficientes para {len(prizes)} premio(s).',
+            }, status=409)
+
+        drawn_at = timezone.now()
+        for prize, winner in zip(prizes, winners):
+            prize.winning_ticket = winner
+            prize.drawn_at = drawn_at
+        Prize.objects.bulk_update(prizes, ['winning_ticket', 'drawn_at'])
 
     return JsonResponse({
+        'winners': [_winner_body(prize, winner, snapshot, exclude_unpaid) for prize, winner in zip(prizes, winners)],
+        'pool_sha256': snapshot.sha256 if snapshot is not None else None,
+        'exclude_unpaid': snapshot.exclude_unpaid if snapshot is not None else exclude_unpaid,
+    })
+
+
+def _snapshot_mismatch(request, snapshot):
+    """True when the request explicitly asks for an ``exclude_unpaid`` other
+    than the one the active snapshot was frozen with."""
+    posted = request.POST.get('exclude_unpaid')
+    return posted is not None and (posted == '1') != snapshot.exclude_unpaid
+
+
+def _snapshot_mismatch_response(snapshot):
+    return JsonResponse({
+        'error': 'El pool está congelado {}: libérelo para sortear con otro criterio.'.format(
+            'solo con pagados' if snapshot.exclude_unpaid else 'incluyendo impagos',
+        ),
+        'exclude_unpaid': snapshot.exclude_unpaid,
+        'pool_sha256': snapshot.sha256,
+    }, status=400)
+
+
+def _winner_body(prize, winner, snapshot, exclude_unpaid):
+    tx = winner.dolibarr_transaction
+    return {
         'prize_id': prize.id,
         'prize_name': prize.name,
         'prize_position': prize.position,
@@ -438,9 +693,34 @@ def execute_prize_draw(request, raffle_id, prize_id):
         'customer_phone': winner.customer.phone or '',
         'customer_email': winner.customer.email or '',
         'customer_identification': winner.customer.identification or '',
-        'instance_slug': instance_slug,
+        'instance_slug': tx.instance.slug if tx and tx.instance_id else None,
         'drawn_at': prize.drawn_at.isoformat(),
-    })
+        'pool_sha256': snapshot.sha256 if snapshot is not None else None,
+        'exclude_unpaid': snapshot.exclude_unpaid if snapshot is not None else exclude_unpaid,
+    }
+
+
+@staff_member_required
+@require_POST
+def freeze_draw_pool(request, raffle_id):
+    """Freeze the eligible pool for the draw event and show its hash."""
+    raffle = get_object_or_404(Raffle, pk=raffle_id)
+    exclude_unpaid = request.POST.get('exclude_unpaid', '1') == '1'
+    snapshot = draw.freeze(raffle, exclude_unpaid=exclude_unpaid, user=request.user)
+    messages.success(
+        request,
+        f"Pool congelado: {snapshot.ticket_count} boletos. SHA-256 {snapshot.sha256}",
+    )
+    return redirect('raffles:raffle_draw_dashboard', raffle_id=raffle.id)
+
+
+@staff_member_required
+@require_POST
+def release_draw_pool(request, raffle_id):
+    raffle = get_object_or_404(Raffle, pk=raffle_id)
+    if draw.release(raffle):
+        messages.info(request, "Pool liberado: los sorteos vuelven a usar el pool actual.")
+    return redirect('raffles:raffle_draw_dashboard', raffle_id=raffle.id)
 
 
 @staff_member_required
@@ -482,21 +762,22 @@ def discard_winner(request, raffle_id, prize_id):
 @staff_member_required
 def winners_list(request, raffle_id):
     raffle = get_object_or_404(Raffle, pk=raffle_id)
-    rows = []
-    for prize in raffle.prizes.select_related(
+    prizes = list(raffle.prizes.select_related(
         'winning_ticket__customer',
         'winning_ticket__dolibarr_transaction__instance',
-    ).order_by('position'):
+        'winning_ticket__dolibarr_transaction__payment_status',
+    ).filter(winning_ticket__isnull=False).order_by('position'))
+    statuses = ticket_payment_statuses([prize.winning_ticket for prize in prizes])
+    rows = []
+    for prize in prizes:
         ticket = prize.winning_ticket
-        if ticket is None:
-            continue
         tx = ticket.dolibarr_transaction
         rows.append({
             'prize': prize,
             'ticket': ticket,
             'customer': ticket.customer,
             'instance_name': tx.instance.name if tx and tx.instance_id else 'Manual',
-            'payment_status': is_invoice_paid(ticket),
+            'payment_status': statuses[ticket.id],
         })
     context = {
         'raffle': raffle,
@@ -0,0 +1,440 @@
+"""Processing pipeline for invoices pushed by the Dolibarr Raffles module.
+
+The single-invoice webhook and the batch endpoint run every invoice through
+the same stages, so both keep identical validation and idempotency rules:
+
+1. ``InvoiceItem`` normalizes one JSON payload.
+2. ``process_invoices`` validates each item, marks the ones this instance
+   already processed (same ``ref`` or ``facture_id``) and prices the rest.
+   ``aprocess_invoices`` does the same for the async view.
+3. ``issue_tickets`` records each DolibarrTransaction + customer inside its
+   own savepoint, allocates ONE contiguous number block for all surviving
+   items and bulk-inserts their tickets.
+
+Each item ends with ``status``/``body`` set, ready to be serialized by the
+view; nothing here knows about HTTP requests.
+"""
+import logging
+import time
+import uuid
+from collections import Counter
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+from . import metrics, recent_invoices, resolver
+from .models import Customer, DolibarrTransaction, Ticket
+from .ticket_numbers import allocate_ticket_numbers, rebuild_ticket_counters, to_ranges
+from .timing import StageTimer
+
+logger = logging.getLogger(__name__)
+
+# Rows per INSERT when tickets are created. Bounded so a huge invoice never
+# builds one giant statement (Django lowers it further when the backend caps
+# bound parameters, e.g. older SQLite).
+TICKET_BATCH_SIZE = 500
+
+
+class InvoiceItem:
+    """One invoice payload on its way through the pipeline."""
+
+    def __init__(self, data):
+        if not isinstance(data, dict):
+            data = {}
+            self.malformed = True
+        else:
+            self.malformed = False
+        self.data = data
+        self.identification = data.get('customer_identification') or data.get('customer_id')
+        self.name = data.get('customer_name', 'Unknown')
+        self.amount_raw = data.get('total_amount', 0)
+        self.external_id = data.get('customer_id', '')
+        self.ref = data.get('ref', '')
+
+        facture_id = data.get('facture_id')
+        try:
+            self.facture_id = int(facture_id) if facture_id else None
+        except (ValueError, TypeError):
+            self.facture_id = None
+
+        self.amount = None
+        self.tickets_count = 0
+        self.transaction = None
+        self.customer = None
+        self.ticket_numbers = range(0)
+        self.status = None
+        self.body = None
+
+    @property
+    def is_done(self):
+        return self.status is not None
+
+    @property
+    def is_tracked(self):
+        """Only invoices with a ref or facture_id get a DolibarrTransaction."""
+        return bool(self.ref) or self.facture_id is not None
+
+    def finish(self, status, body):
+        self.status = status
+        self.body = body
+
+
+def process_invoices(instance, items, generation, timer=None):
+    """Run ``items`` (InvoiceItem) for an authenticated ``instance`` to
+    completion. Per-item failures never affect the other items.
+
+    ``generation`` is the ``resolver.generation()`` read once for the request;
+    ``timer`` (a ``timing.StageTimer``) collects the per-stage durations."""
+    if timer is None:
+        timer = StageTimer()
+    _validate(instance, items)
+
+    with timer.stage('dedupe'):
+        mark_duplicates(instance, _pending(items), generation)
+
+    _parse_amounts(items)
+    if not _pending(items):
+        return items
+
+    raffle = resolver.active_raffle(generation)
+    pending = _price(instance, raffle, items)
+    if pending:
+        _issue_or_fail(instance, raffle, pending, timer)
+    return items
+
+
+async def aprocess_invoices(instance, items, generation, timer=None):
+    """``process_invoices`` for async views: the lookups use the async ORM
+    and only the atomic record/allocate/insert section runs as one sync unit
+    in a worker thread."""
+    if timer is None:
+        timer = StageTimer()
+    _validate(instance, items)
+
+    with timer.stage('dedupe'):
+        await amark_duplicates(instance, _pending(items), generation)
+
+    _parse_amounts(items)
+    if not _pending(items):
+        return items
+
+    raffle = await resolver.aactive_raffle(generation)
+    pending = _price(instance, raffle, items)
+    if pending:
+        await sync_to_async(_issue_or_fail)(instance, raffle, pending, timer)
+    return items
+
+
+def mark_duplicates(instance, items, generation):
+    """Finish with 409 every item whose ref or facture_id this instance has
+    already processed. A ref match wins over a facture_id match.
+
+    Repeats this process saw recently are answered from
+    ``recent_invoices.recent``; the rest need a single combined query."""
+    tracked = [item for item in items if item.is_tracked]
+    if not tracked:
+        return
+    recent_invoices.recent.sync(generation)
+    tracked = _recent_duplicates(instance, tracked)
+    if tracked:
+        _apply_duplicates(instance, tracked, list(_existing_transactions(instance, tracked)))
+
+
+async def amark_duplicates(instance, items, generation):
+    tracked = [item for item in items if item.is_tracked]
+    if not tracked:
+        return
+    recent_invoices.recent.sync(generation)
+    tracked = _recent_duplicates(instance, tracked)
+    if tracked:
+        _apply_duplicates(instance, tracked, [tx async for tx in _existing_transactions(instance, tracked)])
+
+
+def _recent_duplicates(instance, tracked):
+    """Finish the items the recent-invoice filter knows; return the rest."""
+    recent = recent_invoices.recent
+    for item in tracked:
+        hit = recent.lookup(instance.id, item.ref, item.facture_id)
+        if hit is not None:
+            _finish_duplicate(instance, item, *hit)
+    return _pending(tracked)
+
+
+def _existing_transactions(instance, tracked):
+    refs = {item.ref for item in tracked if item.ref}
+    facture_ids = {item.facture_id for item in tracked if item.facture_id is not None}
+    condition = Q()
+    if refs:
+        condition |= Q(ref__in=refs)
+    if facture_ids:
+        condition |= Q(facture_id__in=facture_ids)
+    return DolibarrTransaction.objects.filter(condition, instance_id=instance.id).order_by('id')
+
+
+def _apply_duplicates(instance, tracked, transactions):
+    by_ref = {}
+    by_facture = {}
+    for tx in transactions:
+        by_ref.setdefault(tx.ref, tx)
+        if tx.facture_id is not None:
+            by_facture.setdefault(tx.facture_id, tx)
+
+    for item in tracked:
+        existing = (by_ref.get(item.ref) if item.ref else None) or (
+            by_facture.get(item.facture_id) if item.facture_id is not None else None
+        )
+        if existing is None:
+            continue
+        recent_invoices.recent.remember(instance.id, existing.ref, existing.facture_id, existing.tickets_count)
+        _finish_duplicate(instance, item, existing.ref, existing.tickets_count)
+
+
+def _finish_duplicate(instance, item, existing_ref, tickets_count):
+    logger.info(
+        "DolibarrWebhook: Transaction already processed - instance=%s ref=%s facture_id=%s existing_ref=%s tickets_count=%s",
+        instance.slug, item.ref, item.facture_id, existing_ref, tickets_count,
+    )
+    item.finish(409, {
+        'error': 'Transaction already processed',
+        'ref': existing_ref,
+        'tickets_previously_generated': tickets_count,
+    })
+
+
+def issue_tickets(instance, raffle, items, timer=None):
+    """Record transactions and customers, then allocate and insert tickets for
+    every item that got recorded, all in one database transaction."""
+    if timer is None:
+        timer = StageTimer()
+    recorded = []
+    upserts = Counter()
+    with transaction.atomic():
+        with timer.stage('upsert'):
+            for item in items:
+                try:
+                    with transaction.atomic():
+                        _record_transaction(instance, item)
+                        outcome = _upsert_customer(instance, item)
+                except IntegrityError as e:
+                    logger.warning(
+                        "DolibarrWebhook: IntegrityError (race or duplicate) - instance=%s ref=%s facture_id=%s - %s",
+                        instance.slug, item.ref, item.facture_id, e,
+                    )
+                    item.finish(409, {'error': 'Transaction already processed (race)'})
+                    continue
+                upserts[outcome] += 1
+                recorded.append(item)
+
+        if not recorded:
+            return
+
+        with timer.stage('lock'):
+            block = allocate_ticket_numbers(raffle.id, sum(item.tickets_count for item in recorded))
+        alloc_started = time.perf_counter()
+        offset = 0
+        tickets = []
+        for item in recorded:
+            item.ticket_numbers = block[offset:offset + item.tickets_count]
+            offset += item.tickets_count
+            logger.info(
+                "DolibarrWebhook: Starting ticket creation - instance=%s raffle=%s starting_number=%s",
+                instance.slug, raffle.name, item.ticket_numbers[0],
+            )
+            tickets.extend(
+                Ticket(
+                    raffle_id=raffle.id,
+                    customer=item.customer,
+                    ticket_number=number,
+                    qr_code=uuid.uuid4(),
+                    price=instance.default_ticket_price,
+                    dolibarr_transaction=item.transaction,
+                )
+                for number in item.ticket_numbers
+            )
+        timer.add('alloc', (time.perf_counter() - alloc_started) * 1000)
+        with timer.stage('insert'):
+            insert_tickets(tickets)
+        commit_started = time.perf_counter()
+
+    timer.add('commit', (time.perf_counter() - commit_started) * 1000)
+    metrics.incr_many(upserts)
+    for item in recorded:
+        logger.info(
+            "DolibarrWebhook: Successfully created %s tickets - instance=%s numbers=%s",
+            len(item.ticket_numbers), instance.slug, to_ranges(item.ticket_numbers),
+        )
+        if item.transaction is not None:
+            # Runs now in autocommit mode, or when an enclosing atomic block commits.
+            transaction.on_commit(partial(
+                recent_invoices.recent.remember,
+                instance.id, item.ref, item.facture_id, item.tickets_count,
+            ))
+        item.finish(201, {
+            'message': 'Tickets generated successfully',
+            'customer': item.customer.first_name,
+            'tickets_generated': len(item.ticket_numbers),
+            'ticket_ranges': to_ranges(item.ticket_numbers),
+            'raffle': raffle.name,
+            'instance': instance.slug,
+            'ref': item.ref,
+        })
+
+
+def insert_tickets(tickets):
+    """Write unsaved Ticket objects with bounded bulk INSERTs. QR UUIDs are
+    set by the caller so no row needs a read-back."""
+    Ticket.objects.bulk_create(tickets, batch_size=TICKET_BATCH_SIZE)
+
+
+def _record_transaction(instance, item):
+    if not item.is_tracked:
+        return
+    item.transaction = DolibarrTransaction.objects.create(
+        instance_id=instance.id,
+        ref=item.ref or '',
+        facture_id=item.facture_id,
+        amount=item.amount,
+        tickets_count=item.tickets_count,
+    )
+    logger.info(
+        "DolibarrWebhook: Created transaction record - instance=%s ref=%s facture_id=%s",
+        instance.slug, item.ref, item.facture_id,
+    )
+
+
+def _upsert_customer(instance, item):
+    """Get or create the customer and refresh its contact data. Returns the
+    metrics counter describing what happened; unchanged rows are not written."""
+    data = item.data
+    customer_defaults = {
+        'first_name': item.name,
+        'email': data.get('customer_email', ''),
+        'phone': data.get('customer_phone', ''),
+        'address': data.get('customer_address', ''),
+        'additional_info': f"Imported from Dolibarr (instance={instance.slug}, ID: {item.external_id})",
+    }
+
+    customer, created = Customer.objects.get_or_create(
+        identification=item.identification,
+        defaults=customer_defaults,
+    )
+    item.customer = customer
+
+    if created:
+        logger.info(f"DolibarrWebhook: Created new customer - identification={item.identification}")
+        return metrics.CUSTOMER_CREATED
+
+    incoming = {
+        'first_name': item.name,
+        'email': data.get('customer_email', customer.email),
+        'phone': data.get('customer_phone', customer.phone),
+        'address': data.get('customer_address', customer.address),
+    }
+    changed = []
+    for field, value in incoming.items():
+        # to_python() so e.g. a numeric phone in the JSON compares equal to the stored string.
+        value = Customer._meta.get_field(field).to_python(value)
+        if getattr(customer, field) != value:
+            setattr(customer, field, value)
+            changed.append(field)
+
+    if not changed:
+        logger.info(f"DolibarrWebhook: Existing customer unchanged - identification={item.identification}")
+        return metrics.CUSTOMER_NOOP
+
+    customer.save(update_fields=changed)
+    logger.info(f"DolibarrWebhook: Updated existing customer - identification={item.identification} fields={changed}")
+    return metrics.CUSTOMER_UPDATED
+
+
+def _validate(instance, items):
+    for item in items:
+        if item.malformed:
+            logger.warning("DolibarrWebhook: Invoice payload is not a JSON object - instance=%s", instance.slug)
+            item.finish(400, {'error': 'Invalid invoice payload'})
+            continue
+
+        logger.info(
+            "DolibarrWebhook: Processing request - instance=%s ref=%s facture_id=%s customer=%s amount=%s",
+            instance.slug, item.ref, item.facture_id, item.name, item.amount_raw,
+        )
+        if not item.identification:
+            logger.warning("DolibarrWebhook: Missing customer identification")
+            item.finish(400, {'error': 'Missing customer identification'})
+
+
+def _parse_amounts(items):
+    for item in _pending(items):
+        try:
+            item.amount = float(item.amount_raw)
+        except (ValueError, TypeError):
+            logger.error(f"DolibarrWebhook: Invalid amount value - {item.amount_raw}")
+            item.finish(400, {'error': 'Invalid amount'})
+
+
+def _price(instance, raffle, items):
+    """Compute tickets_count for the pending items; return those that get tickets."""
+    if not raffle:
+        logger.error("DolibarrWebhook: No active raffle configured (set Raffle.is_active=True on one row)")
+        _finish_pending(items, 500, {'error': 'No active raffle configured'})
+        return []
+
+    amount_step = float(instance.amount_step)
+    if amount_step <= 0:
+        logger.error(f"DolibarrWebhook: Invalid amount_step configuration on instance={instance.slug} - {amount_step}")
+        _finish_pending(items, 500, {'error': 'Invalid configuration (amount_step)'})
+        return []
+
+    for item in _pending(items):
+        item.tickets_count = int(item.amount / amount_step) * instance.tickets_per_amount
+        logger.info(
+            "DolibarrWebhook: Calculated tickets - instance=%s amount=%s amount_step=%s tickets_per_amount=%s tickets_to_generate=%s",
+            instance.slug, item.amount, amount_step, instance.tickets_per_amount, item.tickets_count,
+        )
+        if item.tickets_count <= 0:
+            logger.info(
+                "DolibarrWebhook: No tickets to generate (amount insufficient) - instance=%s amount=%s required=%s",
+                instance.slug, item.amount, amount_step,
+            )
+            item.finish(200, {
+                'message': 'No tickets generated (amount insufficient)',
+                'tickets_generated': 0,
+                'amount_received': item.amount,
+                'amount_required': amount_step,
+            })
+    return _pending(items)
+
+
+def _issue_or_fail(instance, raffle, items, timer):
+    # Duplicate transactions are answered 409 inside issue_tickets' per-item
+    # savepoints. An IntegrityError that escapes it is a ticket number (or QR)
+    # collision, e.g. a counter behind a ticket added by hand: nothing was
+    # written, so resync the counter and try once more, then answer 503 so
+    # Dolibarr's queue and the inbox send the invoices again.
+    for attempt in range(2):
+        try:
+            issue_tickets(instance, raffle, _pending(items), timer)
+            return
+        except IntegrityError as e:
+            logger.warning(
+                "DolibarrWebhook: Ticket number collision - instance=%s raffle=%s refs=%s attempt=%s - %s",
+                instance.slug, raffle.id, [item.ref for item in _pending(items)], attempt + 1, e,
+            )
+            if attempt == 0:
+                rebuild_ticket_counters([raffle.id])
+        except Exception as e:
+            logger.error(f"DolibarrWebhook: Error creating tickets - {str(e)}", exc_info=True)
+            _finish_pending(items, 500, {'error': f'Error creating tickets: {str(e)}'})
+            return
+    _finish_pending(items, 503, {'error': 'Ticket number collision, retry later'})
+
+
+def _pending(items):
+    return [item for item in items if not item.is_done]
+
+
+def _finish_pending(items, status, body):
+    for item in _pending(items):
+        item.finish(status, dict(body))
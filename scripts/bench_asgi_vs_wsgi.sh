@@ -0,0 +1,90 @@
+#!/usr/bin/env bash
+# bench_asgi_vs_wsgi.sh - Compare webhook throughput: gunicorn sync workers
+# (DolibarrWebhookView) vs uvicorn (AsyncDolibarrWebhookView)
+#
+# Usage:
+#   DB_NAME=raffles_bench ./scripts/bench_asgi_vs_wsgi.sh [workers] [concurrency] [requests]
+#
+#   workers:      worker processes for BOTH servers (default 4)
+#   concurrency:  simultaneous clients for BOTH runs (default 32)
+#   requests:     POSTs per run (default 2000)
+#
+# Requirements:
+#   - A PostgreSQL database used ONLY for this benchmark (DB_NAME, plus DB_USER,
+#     DB_PASSWORD, DB_HOST as in .env). It gets migrated, every raffle in it is
+#     deactivated and a bench raffle + DolibarrInstance are created.
+#   - uvicorn installed in the virtualenv (pip install uvicorn). It is not in
+#     requirements.txt because production runs gunicorn.
+#
+# Both runs use `manage.py bench_webhook --url`, so the report has the same
+# format: throughput, latency percentiles, lock wait and numbering checks.
+
+set -euo pipefail
+
+ROOT_DIR="$(cd "$(dirname "$0")/.." && pwd)"
+WORKERS="${1:-4}"
+CONCURRENCY="${2:-32}"
+REQUESTS="${3:-2000}"
+PORT_WSGI=8801
+PORT_ASGI=8802
+KEY="bench-$(date +%s)"
+
+if [[ -z "${DB_NAME:-}" ]]; then
+    echo "Error: set DB_NAME to a database dedicated to the benchmark"
+    exit 1
+fi
+if ! command -v uvicorn >/dev/null 2>&1; then
+    echo "Error: uvicorn not found (pip install uvicorn)"
+    exit 1
+fi
+
+cd "$ROOT_DIR"
+export DEBUG=False
+
+python manage.py migrate --noinput >/dev/null
+python manage.py shell -c "
+from raffles.models import DolibarrInstance, Raffle
+Raffle.objects.update(is_active=False)
+Raffle.objects.create(name='Bench ASGI vs WSGI', year=2024, is_active=True)
+DolibarrInstance.objects.create(name='$KEY', slug='$KEY', inbound_api_key='$KEY', tickets_per_amount=1, amount_step=1)
+"
+
+SERVER_PID=""
+cleanup() {
+    if [[ -n "$SERVER_PID" ]]; then
+        kill "$SERVER_PID" 2>/dev/null || true
+        wait "$SERVER_PID" 2>/dev/null || true
+    fi
+}
+trap cleanup EXIT
+
+wait_for_port() {
+    for _ in $(seq 1 50); do
+        if curl -s -o /dev/null "http://127.0.0.1:$1/"; then
+            return 0
+        fi
+        sleep 0.2
+    done
+    echo "Error: server on port $1 did not start"
+    exit 1
+}
+
+run_bench() {
+    local label="$1" url="$2"
+    echo ""
+    echo "=== $label · $WORKERS workers · $CONCURRENCY clientes ==="
+    python manage.py bench_webhook --url "$url" --key "$KEY" \
+        --concurrency "$CONCURRENCY" --requests "$REQUESTS"
+}
+
+gunicorn config.wsgi:application -w "$WORKERS" -b "127.0.0.1:$PORT_WSGI" --log-level warning &
+SERVER_PID=$!
+wait_for_port "$PORT_WSGI"
+run_bench "gunicorn (sync)" "http://127.0.0.1:$PORT_WSGI/raffles/api/dolibarr/webhook/"
+cleanup
+SERVER_PID=""
+
+uvicorn config.asgi:application --workers "$WORKERS" --host 127.0.0.1 --port "$PORT_ASGI" --log-level warning &
+SERVER_PID=$!
+wait_for_port "$PORT_ASGI"
+run_bench "uvicorn (async)" "http://127.0.0.1:$PORT_ASGI/raffles/api/dolibarr/webhook/async/"